@@ -1,20 +1,205 @@
-from flask import Flask, request, jsonify, session, redirect, url_for, render_template
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, make_response, session, redirect, url_for, render_template, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_cors import CORS
+from sqlalchemy import func, and_, bindparam, case, delete, literal, literal_column, or_, select, text, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, OperationalError
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+import base64
+import binascii
+import io
+import click
+import json
 import os
+import re
+from collections import defaultdict
+from functools import partial, wraps
+from itertools import islice
 import secrets
-from datetime import datetime
-import uuid
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////app/data/referral_program.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+from click_buffer import ClickBuffer
+from click_filter import RECORDED, ClickFilter
+from codes import DEFAULT_ALPHABET, CodeAllocator
+from counters import CounterService
+from exports import EXPORT_FORMATS, encode_rows, write_gzip
+from imports import IMPORT_FORMATS, RowError, chunked, decode_rows, text_field, time_field
+from kpi_cache import KpiCache
+from leaderboard import ScoreHistogram
+from link_cache import LinkCodeCache, ResolvedLink
+from live_events import RETRY_AFTER, STREAM_HEADERS, LiveEvents, TooManyStreams
+import migrations
+from password_hasher import HasherBusy, PasswordHasher
+from request_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestMetrics
+from response_cache import ResponseCache
+from sqlite_tuning import configure_engine, database_url, install_sqlite_pragmas, reclaim_free_pages
+from user_agents import MAX_USER_AGENT_LENGTH, UserAgentCache
 
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-CORS(app, origins=['http://localhost:3000', 'http://frontend:3000', 'https://lacasacowork.com'], supports_credentials=True)
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+password_hasher = PasswordHasher(bcrypt=bcrypt)
+cors = CORS()
+click_filter = ClickFilter()
+request_metrics = RequestMetrics()
+
+# Routes and CLI commands live on this blueprint; create_app() registers it
+api = Blueprint('api', __name__, cli_group=None)
+
+# Browser origins allowed to call the API with credentials (also used by asgi.py)
+CORS_ORIGINS = ['http://localhost:3000', 'http://frontend:3000', 'https://lacasacowork.com']
+
+def create_app(config=None):
+    # Builds and configures the app without touching the database; schema
+    # and seed data are set up once by `flask --app app bootstrap`
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'your-secret-key-here'
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url(os.environ.get('DATABASE_URL', 'sqlite:////app/data/referral_program.db'))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    
+    # Click ingestion: when enabled, clicks are queued per worker and written in batches
+    app.config['CLICK_BUFFER_ENABLED'] = os.environ.get('CLICK_BUFFER_ENABLED', 'false').lower() == 'true'
+    app.config['CLICK_BUFFER_MAX_SIZE'] = int(os.environ.get('CLICK_BUFFER_MAX_SIZE', 500))
+    app.config['CLICK_BUFFER_FLUSH_INTERVAL'] = float(os.environ.get('CLICK_BUFFER_FLUSH_INTERVAL', 1.0))
+    app.config['CLICK_BUFFER_SPILL_DIR'] = os.environ.get('CLICK_BUFFER_SPILL_DIR', '/app/data/click-spill')
+    app.config['CLICK_BUFFER_FSYNC'] = os.environ.get('CLICK_BUFFER_FSYNC', 'false').lower() == 'true'
+    
+    # Reverse proxies in front of the app (Traefik in docker-compose.yml):
+    # X-Forwarded-For/-Proto hops to trust. The client address they give is
+    # what click dedup keys on and clicks record; 0 when clients connect
+    # directly, since the headers could then be forged
+    app.config['TRUSTED_PROXY_HOPS'] = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+    
+    # Click filtering (per worker): repeats of the same link, client IP and
+    # User-Agent within the window, and known bots, are answered but not recorded
+    app.config['CLICK_DEDUP_WINDOW'] = float(os.environ.get('CLICK_DEDUP_WINDOW', 1800))
+    app.config['CLICK_DEDUP_CAPACITY'] = int(os.environ.get('CLICK_DEDUP_CAPACITY', 100000))
+    app.config['CLICK_DEDUP_ERROR_RATE'] = float(os.environ.get('CLICK_DEDUP_ERROR_RATE', 0.001))
+    app.config['CLICK_DEDUP_SLICES'] = int(os.environ.get('CLICK_DEDUP_SLICES', 4))
+    app.config['CLICK_FILTER_BOTS'] = os.environ.get('CLICK_FILTER_BOTS', 'true').lower() == 'true'
+    
+    # Link code resolution cache (per worker)
+    app.config['LINK_CACHE_SIZE'] = int(os.environ.get('LINK_CACHE_SIZE', 10000))
+    app.config['LINK_CACHE_TTL'] = float(os.environ.get('LINK_CACHE_TTL', 60))
+    app.config['LINK_CACHE_NEGATIVE_TTL'] = float(os.environ.get('LINK_CACHE_NEGATIVE_TTL', 10))
+    
+    # Interned User-Agent ids kept per worker
+    app.config['USER_AGENT_CACHE_SIZE'] = int(os.environ.get('USER_AGENT_CACHE_SIZE', 1000))
+    
+    # Async click service (asgi.py): threads per process that run database work
+    app.config['ASYNC_DB_THREADS'] = int(os.environ.get('ASYNC_DB_THREADS', 8))
+    
+    # Referral and link codes: 'random' (retry on conflict) or 'sequence' (block-reserved, permuted)
+    app.config['CODE_STRATEGY'] = os.environ.get('CODE_STRATEGY', 'random')
+    app.config['CODE_ALPHABET'] = os.environ.get('CODE_ALPHABET', DEFAULT_ALPHABET)
+    app.config['CODE_BLOCK_SIZE'] = int(os.environ.get('CODE_BLOCK_SIZE', 1000))
+    app.config['CODE_SECRET'] = os.environ.get('CODE_SECRET')
+    app.config['LINK_CODE_LENGTH'] = int(os.environ.get('LINK_CODE_LENGTH', 8))
+    app.config['REFERRAL_CODE_LENGTH'] = int(os.environ.get('REFERRAL_CODE_LENGTH', 10))
+    
+    # Activity rollups: raw rows folded per pass, and how often trend reads catch up inline
+    app.config['ROLLUP_BATCH_SIZE'] = int(os.environ.get('ROLLUP_BATCH_SIZE', 50000))
+    app.config['ROLLUP_REFRESH_INTERVAL'] = float(os.environ.get('ROLLUP_REFRESH_INTERVAL', 30))
+    app.config['ROLLUP_INLINE_BATCHES'] = int(os.environ.get('ROLLUP_INLINE_BATCHES', 2))
+    # PostgreSQL: longest a rollup pass waits for in-flight click/conversion
+    # inserts (new ones queue meanwhile) before leaving it to the next pass
+    app.config['ROLLUP_LOCK_TIMEOUT_MS'] = int(os.environ.get('ROLLUP_LOCK_TIMEOUT_MS', 200))
+    
+    # Global admin KPIs: seconds a snapshot is fresh, then how long it may be served stale while refreshing
+    app.config['KPI_CACHE_TTL'] = float(os.environ.get('KPI_CACHE_TTL', 30))
+    app.config['KPI_CACHE_MAX_STALE'] = float(os.environ.get('KPI_CACHE_MAX_STALE', 300))
+    
+    # Windowed leaderboards: seconds a ranked snapshot is served before one
+    # worker rebuilds it in the background
+    app.config['LEADERBOARD_WINDOW_TTL'] = float(os.environ.get('LEADERBOARD_WINDOW_TTL', 300))
+    
+    # Dashboard responses kept per worker, keyed by the user's data version
+    app.config['RESPONSE_CACHE_MAX_BYTES'] = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+    
+    # Live event streams: how often each process reads new activity (and
+    # rows per read), the least seconds between updates on one stream,
+    # heartbeat seconds, users listed per firehose update, and open streams
+    # per async service process / per gunicorn worker (each holds a thread)
+    app.config['EVENTS_POLL_INTERVAL'] = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.5))
+    app.config['EVENTS_READ_BATCH'] = int(os.environ.get('EVENTS_READ_BATCH', 10000))
+    app.config['EVENTS_MIN_INTERVAL'] = float(os.environ.get('EVENTS_MIN_INTERVAL', 1.0))
+    app.config['EVENTS_HEARTBEAT'] = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+    app.config['EVENTS_FIREHOSE_MAX_USERS'] = int(os.environ.get('EVENTS_FIREHOSE_MAX_USERS', 1000))
+    app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', 10000))
+    app.config['EVENTS_THREAD_STREAMS'] = int(os.environ.get('EVENTS_THREAD_STREAMS', 2))
+    # Seconds a stream's write may stay blocked on a client that stopped reading
+    app.config['EVENTS_SEND_TIMEOUT'] = float(os.environ.get('EVENTS_SEND_TIMEOUT', 30))
+    
+    # Password hashing: bcrypt cost, and the per-worker hash pool with its admission limit
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 1))
+    app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 2))
+    app.config['PASSWORD_HASH_RETRY_AFTER'] = int(os.environ.get('PASSWORD_HASH_RETRY_AFTER', 1))
+    
+    # Click retention: raw clicks older than this many days are archived and
+    # deleted in small batches by `flask compact-clicks`
+    app.config['CLICK_RETENTION_DAYS'] = int(os.environ.get('CLICK_RETENTION_DAYS', 90))
+    app.config['CLICK_ARCHIVE_DIR'] = os.environ.get('CLICK_ARCHIVE_DIR', '/app/data/click-archive')
+    app.config['CLICK_RETENTION_BATCH_SIZE'] = int(os.environ.get('CLICK_RETENTION_BATCH_SIZE', 5000))
+    app.config['CLICK_RETENTION_BATCH_PAUSE'] = float(os.environ.get('CLICK_RETENTION_BATCH_PAUSE', 0.05))
+    
+    # Data exports: rows fetched per cursor batch
+    app.config['EXPORT_YIELD_PER'] = int(os.environ.get('EXPORT_YIELD_PER', 5000))
+    
+    # Bulk imports: rows validated and written per transaction, rows accepted
+    # per HTTP request (larger files go through `flask import`) and rejected
+    # rows listed in a report
+    app.config['IMPORT_CHUNK_SIZE'] = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+    app.config['IMPORT_MAX_ROWS'] = int(os.environ.get('IMPORT_MAX_ROWS', 10000))
+    app.config['IMPORT_MAX_ERRORS'] = int(os.environ.get('IMPORT_MAX_ERRORS', 1000))
+    # Largest request body any endpoint reads; an IMPORT_MAX_ROWS import of
+    # the widest rows fits well within the default
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+    
+    # Request metrics: per-worker totals are shared through METRICS_DIR so
+    # /api/metrics covers every gunicorn worker; requests issuing more than
+    # QUERY_BUDGET SQL statements are logged (0 disables)
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'referral-metrics'))
+    app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 20))
+    
+    # Initial admin account created by `bootstrap` / `create-admin`
+    app.config['ADMIN_USERNAME'] = os.environ.get('ADMIN_USERNAME', 'admin')
+    app.config['ADMIN_EMAIL'] = os.environ.get('ADMIN_EMAIL', 'admin@elantar.com')
+    app.config['ADMIN_PASSWORD'] = os.environ.get('ADMIN_PASSWORD', 'admin123')
+    
+    app.config.update(config or {})
+    
+    # Pool options and SQLite PRAGMAs (WAL, busy timeout, caches) from the environment
+    configure_engine(app)
+    
+    db.init_app(app)
+    with app.app_context():
+        install_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
+    bcrypt.init_app(app)
+    password_hasher.init_app(app, bcrypt)
+    link_cache.init_app(app)
+    user_agent_cache.init_app(app)
+    code_allocator.init_app(app)
+    kpi_cache.init_app(app)
+    response_cache.init_app(app)
+    live_events.init_app(app)
+    click_buffer.init_app(app)
+    click_filter.init_app(app)
+    request_metrics.init_app(app)
+    cors.init_app(app, origins=CORS_ORIGINS, supports_credentials=True, expose_headers=['X-Next-Cursor'])
+    app.register_blueprint(api)
+    
+    hops = app.config['TRUSTED_PROXY_HOPS']
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+    
+    return app
 
 # Database Models
 class User(db.Model):
@@ -25,11 +210,16 @@ class User(db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     referral_code = db.Column(db.String(20), unique=True, nullable=False)
     referred_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # Relationships
     referrals = db.relationship('User', backref=db.backref('referrer', remote_side=[id]))
     referral_links = db.relationship('ReferralLink', backref='user', lazy=True)
+    
+    __table_args__ = (
+        # Referral lookups, and downline walks in id order without a sort
+        db.Index('ix_user_referred_by_id', 'referred_by', 'id'),
+    )
 
 class ReferralLink(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -37,25 +227,1225 @@ class ReferralLink(db.Model):
     link_code = db.Column(db.String(50), unique=True, nullable=False)
     clicks = db.Column(db.Integer, default=0)
     conversions = db.Column(db.Integer, default=0)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     is_active = db.Column(db.Boolean, default=True)
+    
+    __table_args__ = (
+        db.Index('ix_referral_link_user_active', 'user_id', 'is_active'),
+    )
+
+class UserAgent(db.Model):
+    # Distinct User-Agent headers, referenced by id from ReferralClick
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(MAX_USER_AGENT_LENGTH), unique=True, nullable=False)
 
 class ReferralClick(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     link_id = db.Column(db.Integer, db.ForeignKey('referral_link.id'), nullable=False)
     ip_address = db.Column(db.String(45), nullable=False)
-    user_agent = db.Column(db.String(500), nullable=True)
-    clicked_at = db.Column(db.DateTime, default=datetime.utcnow)
+    user_agent_id = db.Column(db.Integer, db.ForeignKey('user_agent.id'), nullable=True)
+    clicked_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    __table_args__ = (
+        db.Index('ix_referral_click_link_clicked_at', 'link_id', 'clicked_at'),
+    )
+
+class UserStats(db.Model):
+    # Per-user dashboard totals, maintained incrementally by the write paths
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    referrals_count = db.Column(db.Integer, default=0, nullable=False)
+    links_count = db.Column(db.Integer, default=0, nullable=False)
+    active_links_count = db.Column(db.Integer, default=0, nullable=False)
+    total_clicks = db.Column(db.Integer, default=0, nullable=False)
+    total_conversions = db.Column(db.Integer, default=0, nullable=False)
+    earnings = db.Column(db.Integer, default=0, nullable=False)
+    # Moves with every change to the summary, the user's network or their
+    # rolled-up activity; the dashboard ETags are built from it
+    version = db.Column(db.Integer, default=0, nullable=False)
+    
+    # The top of each leaderboard, read without a sort
+    __table_args__ = (
+        db.Index('ix_user_stats_referrals_rank', referrals_count.desc(), user_id),
+        db.Index('ix_user_stats_clicks_rank', total_clicks.desc(), user_id),
+        db.Index('ix_user_stats_conversions_rank', total_conversions.desc(), user_id),
+    )
+
+class ConversionEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    link_id = db.Column(db.Integer, db.ForeignKey('referral_link.id'), nullable=False, index=True)
+    converted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ActivityRollup(db.Model):
+    # Hourly and daily click/conversion counts per link, folded in from
+    # ReferralClick and ConversionEvent by refresh_activity_rollups()
+    granularity = db.Column(db.String(4), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    link_id = db.Column(db.Integer, db.ForeignKey('referral_link.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    clicks = db.Column(db.Integer, default=0, nullable=False)
+    conversions = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_activity_rollup_user_bucket', 'user_id', 'granularity', 'bucket_start'),
+    )
+
+class CodeSequence(db.Model):
+    # Next unreserved number per code kind, for CODE_STRATEGY=sequence
+    kind = db.Column(db.String(20), primary_key=True)
+    next_value = db.Column(db.BigInteger, default=0, nullable=False)
+
+class LeaderboardScore(db.Model):
+    # Users holding each score on an overall leaderboard, kept in step with
+    # UserStats by score_histogram
+    board = db.Column(db.String(20), primary_key=True)
+    score = db.Column(db.Integer, primary_key=True)
+    users = db.Column(db.Integer, default=0, nullable=False)
+
+class LeaderboardEntry(db.Model):
+    # Ranked snapshot of a windowed leaderboard; users without activity in
+    # the window are left out and share the last rank
+    window_days = db.Column(db.Integer, primary_key=True)
+    board = db.Column(db.String(20), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score = db.Column(db.Integer, nullable=False)
+    rank = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_leaderboard_entry_rank', 'window_days', 'board', 'rank', 'user_id'),
+    )
+
+class LeaderboardSnapshot(db.Model):
+    # When each windowed board was built, and when a worker claimed its rebuild
+    window_days = db.Column(db.Integer, primary_key=True)
+    board = db.Column(db.String(20), primary_key=True)
+    ranked_users = db.Column(db.Integer, default=0, nullable=False)
+    built_at = db.Column(db.DateTime, nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+
+class RollupWatermark(db.Model):
+    # Highest source row id already folded into ActivityRollup
+    source = db.Column(db.String(20), primary_key=True)
+    last_id = db.Column(db.Integer, default=0, nullable=False)
+
+# Example payout: $15 per conversion
+EARNINGS_PER_CONVERSION = 15
+
+# Example revenue for the admin dashboard: $10 per click
+REVENUE_PER_CLICK = 10
+
+TREND_DAYS = 7
+
+USER_STATS_FIELDS = (
+    'referrals_count', 'links_count', 'active_links_count',
+    'total_clicks', 'total_conversions', 'earnings'
+)
+
+# Overall leaderboards rank these UserStats columns
+LEADERBOARD_BOARDS = {'referrals': 'referrals_count', 'clicks': 'total_clicks', 'conversions': 'total_conversions'}
+
+# metric -> (board, score multiplier): earnings are conversions times
+# EARNINGS_PER_CONVERSION, so they rank exactly like conversions
+LEADERBOARD_METRICS = {
+    'referrals': ('referrals', 1),
+    'clicks': ('clicks', 1),
+    'conversions': ('conversions', 1),
+    'earnings': ('conversions', EARNINGS_PER_CONVERSION)
+}
+
+# window -> days; windowed boards are ranked snapshots built from the daily rollups
+LEADERBOARD_WINDOWS = {'all': None, '7d': 7, '30d': 30}
 
 # Helper functions
-def generate_referral_code():
-    return secrets.token_urlsafe(8)
+def write_click_batch(clicks, active_only=False):
+    # Bulk insert the raw clicks, then one counter UPDATE per link. Buffered
+    # clicks carry the User-Agent header; it is interned here, off the request.
+    # With active_only (the click buffer), clicks on links deactivated since
+    # they were buffered are dropped, as track_click() refuses them
+    link_ids = {row['link_id'] for row in clicks}
+    owners = db.session.query(ReferralLink.id, ReferralLink.user_id).filter(ReferralLink.id.in_(link_ids))
+    if active_only:
+        owners = owners.filter(ReferralLink.is_active == True)
+    owners = dict(owners)
+    clicks = [row for row in clicks if row['link_id'] in owners]
+    if not clicks:
+        db.session.commit()
+        return
+    
+    db.session.execute(ReferralClick.__table__.insert(), [
+        {
+            'link_id': row['link_id'],
+            'ip_address': row['ip_address'],
+            'user_agent_id': user_agent_cache.get_id(row['user_agent']),
+            'clicked_at': row['clicked_at']
+        }
+        for row in clicks
+    ])
+
+    pending = link_counters.pending()
+    pending_stats = user_stats_counters.pending()
+    for row in clicks:
+        pending.add(row['link_id'], clicks=1)
+        pending_stats.add(owners[row['link_id']], total_clicks=1, version=1)
+    
+    pending.apply()
+    score_histogram.moved(pending_stats.apply())
+
+    db.session.commit()
+
+link_counters = CounterService(db, ReferralLink, ('clicks', 'conversions'))
+user_stats_counters = CounterService(db, UserStats, USER_STATS_FIELDS + ('version',), key='user_id')
+
+def bump_user_stats(user_id, **deltas):
+    if deltas.get('total_conversions'):
+        deltas['earnings'] = deltas['total_conversions'] * EARNINGS_PER_CONVERSION
+    user_stats_counters.increment(user_id, version=1, **deltas)
+    score_histogram.moved({user_id: deltas})
+
+def touch_referrers(user_ids):
+    # A user's referral count is listed on their referrer's /api/network, so
+    # new referrals move the version of the referrer's referrer too
+    user_stats_counters.increment_where(
+        UserStats.user_id.in_(select(User.referred_by).where(User.id.in_(user_ids), User.referred_by.isnot(None))),
+        version=1
+    )
+
+def compute_user_stats(user_ids=None):
+    # Recompute summaries from the source tables with two grouped queries
+    links = db.session.query(
+        ReferralLink.user_id,
+        func.count(ReferralLink.id),
+        func.sum(case((ReferralLink.is_active == True, 1), else_=0)),
+        func.sum(ReferralLink.clicks),
+        func.sum(ReferralLink.conversions)
+    ).group_by(ReferralLink.user_id)
+    referrals = db.session.query(
+        User.referred_by, func.count(User.id)
+    ).filter(User.referred_by.isnot(None)).group_by(User.referred_by)
+    
+    if user_ids is not None:
+        links = links.filter(ReferralLink.user_id.in_(user_ids))
+        referrals = referrals.filter(User.referred_by.in_(user_ids))
+    else:
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+    
+    summaries = {user_id: dict.fromkeys(USER_STATS_FIELDS, 0) for user_id in user_ids}
+    for user_id, links_count, active_links, clicks, conversions in links:
+        summaries[user_id].update(
+            links_count=links_count,
+            active_links_count=active_links or 0,
+            total_clicks=clicks or 0,
+            total_conversions=conversions or 0,
+            earnings=(conversions or 0) * EARNINGS_PER_CONVERSION
+        )
+    for user_id, referrals_count in referrals:
+        summaries[user_id]['referrals_count'] = referrals_count
+    
+    return summaries
+
+def user_stats_rows():
+    # The same totals as compute_user_stats() as one SELECT of
+    # (user_id, *USER_STATS_FIELDS), so a rebuild can run inside the database
+    links = select(
+        ReferralLink.user_id,
+        func.count(ReferralLink.id).label('links_count'),
+        func.sum(case((ReferralLink.is_active == True, 1), else_=0)).label('active_links_count'),
+        func.sum(ReferralLink.clicks).label('total_clicks'),
+        func.sum(ReferralLink.conversions).label('total_conversions')
+    ).group_by(ReferralLink.user_id).subquery()
+    referrals = select(
+        User.referred_by.label('user_id'), func.count(User.id).label('referrals_count')
+    ).where(User.referred_by.isnot(None)).group_by(User.referred_by).subquery()
+    
+    conversions = func.coalesce(links.c.total_conversions, 0)
+    return select(
+        User.id,
+        func.coalesce(referrals.c.referrals_count, 0),
+        func.coalesce(links.c.links_count, 0),
+        func.coalesce(links.c.active_links_count, 0),
+        func.coalesce(links.c.total_clicks, 0),
+        conversions,
+        conversions * EARNINGS_PER_CONVERSION
+    ).select_from(User).outerjoin(
+        links, links.c.user_id == User.id
+    ).outerjoin(
+        referrals, referrals.c.user_id == User.id
+    ).where(literal(True))  # SQLite reads an ON CONFLICT right after a join's ON as part of it
+
+def get_user_summary(user_id):
+    summary = db.session.get(UserStats, user_id)
+    if summary:
+        return summary
+    
+    # First read for a user created before summaries existed
+    values = compute_user_stats([user_id])[user_id]
+    summary = UserStats(user_id=user_id, **values)
+    db.session.add(summary)
+    score_histogram.enter([values])
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        summary = db.session.get(UserStats, user_id)
+    
+    return summary
+
+def load_referral_link(link_code):
+    row = db.session.query(
+        ReferralLink.id, ReferralLink.user_id, ReferralLink.is_active, User.username
+    ).join(User, ReferralLink.user_id == User.id).filter(ReferralLink.link_code == link_code).first()
+    
+    return ResolvedLink(*row) if row else None
+
+link_cache = LinkCodeCache(loader=load_referral_link)
+
+def resolve_active_link(link_code):
+    link = link_cache.get(link_code)
+    return link if link and link.is_active else None
+
+click_buffer = ClickBuffer(writer=partial(write_click_batch, active_only=True))
+
+def resolve_user_agent(value):
+    # Own connection and transaction, so the id is committed before it is
+    # cached; ON CONFLICT covers another worker inserting the same agent
+    with db.engine.begin() as connection:
+        connection.execute(
+            dialect_insert(UserAgent.__table__).values(value=value).on_conflict_do_nothing(index_elements=['value'])
+        )
+        return connection.execute(select(UserAgent.id).where(UserAgent.value == value)).scalar_one()
+
+user_agent_cache = UserAgentCache(resolver=resolve_user_agent)
+
+def dialect_insert(table):
+    # INSERT construct with on_conflict_do_update()/do_nothing() for the configured database
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(table)
+
+def reserve_code_block(kind, size):
+    # Own connection and transaction, so a block is never handed out twice
+    # even if the request that reserved it rolls back
+    sequences = CodeSequence.__table__
+    statement = dialect_insert(sequences).values(kind=kind, next_value=size).on_conflict_do_update(
+        index_elements=['kind'], set_={'next_value': sequences.c.next_value + size}
+    ).returning(sequences.c.next_value)
+    with db.engine.begin() as connection:
+        return connection.execute(statement).scalar_one() - size
+
+score_histogram = ScoreHistogram(db, LeaderboardScore, UserStats, LEADERBOARD_BOARDS, insert=dialect_insert)
+
+code_allocator = CodeAllocator(kinds={
+    'link': ('LINK_CODE_LENGTH', ReferralLink.__table__.c.link_code.type.length),
+    'referral': ('REFERRAL_CODE_LENGTH', User.__table__.c.referral_code.type.length)
+}, reserver=reserve_code_block)
+
+def insert_with_unique_code(table, code_column, kind, values, returning, attempts=5):
+    # INSERT ... ON CONFLICT (code) DO NOTHING RETURNING ...: a duplicate code
+    # comes back as no row and is retried with a fresh one, without a
+    # pre-check query and without aborting the surrounding transaction.
+    # Call before the transaction writes: the first code may reserve a
+    # sequence block; retries use random codes, which need no round trip
+    for attempt in range(attempts):
+        code = code_allocator.generate(kind) if attempt == 0 else code_allocator.random_code(kind)
+        statement = dialect_insert(table).values(**values, **{code_column: code})
+        statement = statement.on_conflict_do_nothing(index_elements=[code_column]).returning(*returning)
+        row = db.session.execute(statement).first()
+        if row is not None:
+            return code, row
+        code_allocator.record_conflict(kind)
+    raise RuntimeError(f'Could not allocate a unique {code_column} after {attempts} attempts')
+
+def insert_many_with_unique_codes(table, code_column, kind, rows, returning, attempts=5):
+    # Bulk form of insert_with_unique_code(): codes for every row are
+    # generated up front, the rows go in as one executemany (batched into
+    # multi-row INSERTs by SQLAlchemy), and only the rows whose code was
+    # taken are retried. Returns (code, row) pairs
+    codes = code_allocator.generate_many(kind, len(rows))
+    pending = [{**values, code_column: code} for values, code in zip(rows, codes)]
+    statement = dialect_insert(table).on_conflict_do_nothing(index_elements=[code_column])
+    statement = statement.returning(table.c[code_column], *returning)
+    inserted = []
+    for _ in range(attempts):
+        written = {row[0]: row for row in db.session.execute(statement, pending)}
+        retry = []
+        for values in pending:
+            code = values[code_column]
+            if code in written:
+                inserted.append((code, written[code]))
+            else:
+                code_allocator.record_conflict(kind)
+                retry.append({**values, code_column: code_allocator.random_code(kind)})
+        if not retry:
+            return inserted
+        pending = retry
+    raise RuntimeError(f'Could not allocate {len(pending)} unique {code_column} values after {attempts} attempts')
+
+# Same text layout SQLAlchemy uses for DateTime columns on SQLite, so buckets
+# written by the database compare equal to datetimes bound from Python
+ROLLUP_BUCKET_FORMATS = {'hour': '%Y-%m-%d %H:00:00.000000', 'day': '%Y-%m-%d 00:00:00.000000'}
+
+def time_bucket(column, granularity):
+    if db.engine.dialect.name == 'postgresql':
+        # Inline the unit: a bound parameter would make the SELECT and GROUP BY
+        # expressions differ in PostgreSQL's eyes
+        return func.date_trunc(literal_column(f"'{granularity}'"), column)
+    return func.strftime(ROLLUP_BUCKET_FORMATS[granularity], column)
+
+def as_datetime(value):
+    # SQLite returns bucket expressions as text
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def rollup_sources():
+    return {
+        'clicks': (ReferralClick, ReferralClick.clicked_at),
+        'conversions': (ConversionEvent, ConversionEvent.converted_at)
+    }
 
-def generate_link_code():
-    return str(uuid.uuid4())[:8]
+def settled_max_id(model):
+    # Highest id of `model` that no insert still in flight can end up below,
+    # or None if that could not be settled in time. SQLite writers commit one
+    # at a time, so max(id) already is. PostgreSQL hands out sequence ids
+    # before commit, so a row can become visible below an id already read:
+    # a SHARE lock waits for the table's open inserts to finish and holds new
+    # ones back for the one index lookup, on a connection of its own.
+    statement = select(func.coalesce(func.max(model.id), 0))
+    if db.engine.dialect.name != 'postgresql':
+        return db.session.execute(statement).scalar()
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text(f"SET LOCAL lock_timeout = {int(current_app.config['ROLLUP_LOCK_TIMEOUT_MS'])}"))
+            connection.execute(text(f'LOCK TABLE {model.__tablename__} IN SHARE MODE'))
+            return connection.execute(statement).scalar()
+    except OperationalError as error:
+        # lock_not_available
+        if getattr(error.orig, 'pgcode', None) == '55P03':
+            return None
+        raise
+
+def roll_up_batch(source, batch_size, since=None):
+    # Fold the next batch of source rows past the watermark into the rollups;
+    # returns how many ids were covered (0 when caught up or another worker won).
+    # With `since`, older rows in the batch are skipped.
+    model, timestamp = rollup_sources()[source]
+    
+    # Every id up to `newest` is final, so nothing can turn up behind the
+    # watermark later (and compact_clicks() only deletes behind it)
+    newest = settled_max_id(model)
+    watermark = db.session.get(RollupWatermark, source)
+    low = watermark.last_id if watermark else 0
+    if newest is None or newest <= low:
+        return 0
+    high = min(newest, low + batch_size)
+    
+    # Claim the id range before touching the rollups: a concurrent aggregator
+    # that read the same watermark matches no row here and backs off
+    if watermark is None:
+        db.session.add(RollupWatermark(source=source, last_id=high))
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            return 0
+    else:
+        claimed = db.session.execute(
+            update(RollupWatermark)
+            .where(RollupWatermark.source == source, RollupWatermark.last_id == low)
+            .values(last_id=high)
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            return 0
+    
+    # Aggregate and upsert entirely inside the database: INSERT ... SELECT
+    # ... GROUP BY ... ON CONFLICT adds each bucket's count to the rollup
+    table = ActivityRollup.__table__
+    other = 'conversions' if source == 'clicks' else 'clicks'
+    for granularity in ROLLUP_BUCKET_FORMATS:
+        bucket = time_bucket(timestamp, granularity)
+        grouped = select(
+            literal_column(f"'{granularity}'"), bucket, model.link_id, ReferralLink.user_id,
+            func.count(model.id), literal_column('0')
+        ).join(ReferralLink, model.link_id == ReferralLink.id).where(
+            model.id > low, model.id <= high
+        ).group_by(model.link_id, ReferralLink.user_id, bucket)
+        if since is not None:
+            grouped = grouped.where(timestamp >= since)
+        
+        statement = dialect_insert(table).from_select(
+            ['granularity', 'bucket_start', 'link_id', 'user_id', source, other], grouped
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=['granularity', 'bucket_start', 'link_id'],
+            set_={source: table.c[source] + statement.excluded[source]}
+        )
+        db.session.execute(statement)
+    
+    # Cached trend responses are keyed by the owners' versions, which the
+    # clicks themselves moved before they were folded in here
+    user_stats_counters.increment_where(
+        UserStats.user_id.in_(
+            select(ReferralLink.user_id).join(model, model.link_id == ReferralLink.id).where(model.id > low, model.id <= high)
+        ),
+        version=1
+    )
+    
+    db.session.commit()
+    return high - low
+
+def refresh_activity_rollups(max_batches=None, since=None):
+    batch_size = current_app.config['ROLLUP_BATCH_SIZE']
+    covered = 0
+    for source in rollup_sources():
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            batch = roll_up_batch(source, batch_size, since)
+            covered += batch
+            batches += 1
+            if batch < batch_size:
+                break
+    return covered
+
+last_rollup_refresh = 0.0
+
+def refresh_activity_rollups_if_due():
+    # Keeps trend reads near real time without a separate scheduler; a cron
+    # running 'flask rollup-activity' keeps the inline work small
+    global last_rollup_refresh
+    now = time.monotonic()
+    if now - last_rollup_refresh < current_app.config['ROLLUP_REFRESH_INTERVAL']:
+        return
+    last_rollup_refresh = now
+    refresh_activity_rollups(max_batches=current_app.config['ROLLUP_INLINE_BATCHES'])
+
+def retention_cutoff(days):
+    # Midnight UTC `days` days ago, so compaction only ever removes whole days
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=days)
+
+def compact_clicks(cutoff, archive_dir=None, echo=print):
+    # Archive and delete raw clicks older than `cutoff`. Their counts live on
+    # in the daily rollups (brought up to date first; only clicks at or below
+    # the rollup watermark are removed), in ReferralLink.clicks and in
+    # UserStats. Hourly rollups before the cutoff are dropped too.
+    refresh_activity_rollups()
+    watermark = db.session.get(RollupWatermark, 'clicks')
+    last_old = db.session.query(func.max(ReferralClick.id)).filter(
+        ReferralClick.clicked_at < cutoff, ReferralClick.id <= (watermark.last_id if watermark else 0)
+    ).scalar()
+    first = db.session.query(func.min(ReferralClick.id)).scalar()
+    db.session.commit()
+    
+    report = {'cutoff': cutoff, 'archive': None, 'archived': 0, 'deleted': 0, 'batches': 0, 'longest_batch': 0.0}
+    if last_old is None:
+        return report
+    
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        columns, statement = export_statement('clicks', end=cutoff)
+        rows = db.session.execute(
+            statement.where(ReferralClick.id <= last_old)
+            .execution_options(yield_per=current_app.config['EXPORT_YIELD_PER'])
+        )
+        
+        def counted(rows):
+            for row in rows:
+                report['archived'] += 1
+                yield row
+        
+        path = os.path.join(archive_dir, f"clicks-before-{cutoff:%Y%m%d}-{datetime.utcnow():%Y%m%dT%H%M%S}.ndjson.gz")
+        size = write_gzip(path, encode_rows(counted(rows), columns, 'ndjson'))
+        db.session.commit()
+        report['archive'] = path
+        echo(f"Archived {report['archived']} clicks to {path} ({size} bytes)")
+    
+    # Short id-range batches, each its own transaction, with a pause between
+    # them so click writes get the lock in between
+    batch_size = current_app.config['CLICK_RETENTION_BATCH_SIZE']
+    pause = current_app.config['CLICK_RETENTION_BATCH_PAUSE']
+    # SQLite hands out max(id) + 1, so deleting the newest rows would let new
+    # clicks reuse ids at or below the watermark and never be rolled up. Each
+    # batch lowers the watermark to the surviving max(id) in its own
+    # transaction, before any insert can take one of those ids.
+    newest = select(func.coalesce(func.max(ReferralClick.id), 0)).scalar_subquery()
+    lower_watermark = update(RollupWatermark).where(
+        RollupWatermark.source == 'clicks', RollupWatermark.last_id > newest
+    ).values(last_id=newest)
+    start = first - 1
+    while start < last_old:
+        stop = min(start + batch_size, last_old)
+        started = time.perf_counter()
+        report['deleted'] += db.session.execute(
+            delete(ReferralClick).where(
+                ReferralClick.id > start, ReferralClick.id <= stop, ReferralClick.clicked_at < cutoff
+            )
+        ).rowcount
+        db.session.execute(lower_watermark)
+        db.session.commit()
+        report['longest_batch'] = max(report['longest_batch'], time.perf_counter() - started)
+        report['batches'] += 1
+        start = stop
+        if pause and start < last_old:
+            time.sleep(pause)
+    
+    report['hourly_rollups_pruned'] = db.session.execute(
+        delete(ActivityRollup).where(ActivityRollup.granularity == 'hour', ActivityRollup.bucket_start < cutoff)
+    ).rowcount
+    db.session.commit()
+    return report
+
+def trend_window(days):
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return [today - timedelta(days=offset) for offset in reversed(range(days))]
+
+def daily_activity(days, user_id=None):
+    # Per-day (clicks, conversions) for the last `days` days, oldest first,
+    # read from the daily rollups with one range scan
+    window = trend_window(days)
+    query = db.session.query(
+        ActivityRollup.bucket_start,
+        func.sum(ActivityRollup.clicks),
+        func.sum(ActivityRollup.conversions)
+    ).filter(ActivityRollup.granularity == 'day', ActivityRollup.bucket_start >= window[0])
+    if user_id is not None:
+        query = query.filter(ActivityRollup.user_id == user_id)
+    
+    by_day = {as_datetime(bucket): (clicks, conversions) for bucket, clicks, conversions in query.group_by(ActivityRollup.bucket_start)}
+    clicks = [by_day.get(day, (0, 0))[0] for day in window]
+    conversions = [by_day.get(day, (0, 0))[1] for day in window]
+    return clicks, conversions
+
+def daily_counts(timestamp, days):
+    # Rows created per day for the last `days` days, oldest first
+    window = trend_window(days)
+    bucket = time_bucket(timestamp, 'day')
+    by_day = {
+        as_datetime(day): count
+        for day, count in db.session.query(bucket, func.count()).filter(timestamp >= window[0]).group_by(bucket)
+    }
+    return [by_day.get(day, 0) for day in window]
+
+def compute_global_kpis():
+    # Program-wide totals from three aggregate queries; served through kpi_cache
+    users = db.session.query(func.count(User.id)).scalar()
+    engaged_users = db.session.query(func.count(func.distinct(ReferralLink.user_id))).scalar()
+    clicks, conversions = db.session.query(
+        func.coalesce(func.sum(ReferralLink.clicks), 0),
+        func.coalesce(func.sum(ReferralLink.conversions), 0)
+    ).one()
+    
+    return {
+        'users': users,
+        'engagedUsers': engaged_users,
+        'clicks': clicks,
+        'conversions': conversions,
+        'revenue': clicks * REVENUE_PER_CLICK,
+        'computedAt': datetime.utcnow().isoformat()
+    }
+
+kpi_cache = KpiCache(compute=compute_global_kpis)
+
+response_cache = ResponseCache()
+
+# Core statement on the table, built once and run outside the ORM session:
+# unchanged polls are answered after this lookup alone
+USER_VERSION = select(UserStats.__table__.c.version).where(UserStats.__table__.c.user_id == bindparam('user_id'))
+
+def trend_validator():
+    # Folding activity into the rollups moves its owners' versions, so catch
+    # up before the version is read; the series also shift at midnight
+    refresh_activity_rollups_if_due()
+    return f"{trend_window(1)[0]:%Y%m%d}"
+
+def versioned_per_user(validator=None):
+    # For dashboard reads that only change with the logged-in user's
+    # UserStats.version (and whatever `validator`, run first, returns): a
+    # matching If-None-Match gets a 304, a body already built for the tag
+    # comes from response_cache, and only otherwise does the view run. Users
+    # without a summary row yet go straight to the view.
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id = session.get('user_id')
+            if user_id is None:
+                return view(*args, **kwargs)
+            extra = validator() if validator else None
+            with db.engine.connect() as connection:
+                version = connection.execute(USER_VERSION, {'user_id': user_id}).scalar()
+            if version is None:
+                return view(*args, **kwargs)
+            
+            tag = f"{user_id}-{version}" + (f"-{extra}" if extra else '')
+            if request.if_none_match.contains_weak(tag):
+                response_cache.count_not_modified()
+                response = Response(status=304)
+            else:
+                key = (user_id, request.full_path)
+                body = response_cache.get(key, tag)
+                if body is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    body = response.get_data()
+                    response_cache.put(key, tag, body)
+                response = Response(body, mimetype='application/json')
+            
+            # Weak: a body rebuilt for the same tag is equivalent, not byte-identical
+            response.set_etag(tag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorate
+
+def read_live_activity(cursor, limit):
+    # Reader for live_events: up to `limit` clicks, conversions and sign-ups
+    # past `cursor` (the last id read from each table), as per-link counts.
+    # Ids are handed out in commit order on SQLite; on PostgreSQL a row whose
+    # transaction commits after a higher id was read is not streamed.
+    if cursor is None:
+        return tuple(
+            db.session.execute(select(func.coalesce(func.max(model.id), 0))).scalar()
+            for model in (ReferralClick, ConversionEvent, User)
+        ), [], False
+    
+    events = []
+    more = False
+    positions = list(cursor)
+    for index, (model, counts) in enumerate((
+        (ReferralClick, lambda n: {'clicks': n}),
+        (ConversionEvent, lambda n: {'conversions': n, 'earnings': n * EARNINGS_PER_CONVERSION})
+    )):
+        rows = select(model.id, model.link_id).where(model.id > positions[index]).order_by(model.id).limit(limit).subquery()
+        read = 0
+        for user_id, link_id, count, last_id in db.session.execute(
+            select(ReferralLink.user_id, rows.c.link_id, func.count(), func.max(rows.c.id))
+            .join(ReferralLink, ReferralLink.id == rows.c.link_id)
+            .group_by(rows.c.link_id, ReferralLink.user_id)
+        ):
+            events.append((user_id, link_id, counts(count)))
+            positions[index] = max(positions[index], last_id)
+            read += count
+        more = more or read == limit
+    
+    users = db.session.execute(
+        select(User.id, User.referred_by).where(User.id > positions[2]).order_by(User.id).limit(limit)
+    ).all()
+    if users:
+        referrals = defaultdict(int)
+        for _, referred_by in users:
+            if referred_by is not None:
+                referrals[referred_by] += 1
+        events.extend((user_id, None, {'referrals': count}) for user_id, count in referrals.items())
+        events.append((None, None, {'registrations': len(users)}))
+        positions[2] = users[-1].id
+        more = more or len(users) == limit
+    return tuple(positions), events, more
+
+live_events = LiveEvents(reader=read_live_activity)
+
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_MAX_PAGE_SIZE = 100
+
+def overall_leaderboard(board, limit):
+    # Top `limit` users walked off the (score DESC, user_id) index, with
+    # competition ranks: from the top, a rank is the position of the first
+    # user holding that score
+    score = getattr(UserStats, LEADERBOARD_BOARDS[board])
+    rows = db.session.execute(
+        select(User.username, score).select_from(UserStats).join(User, User.id == UserStats.user_id)
+        .order_by(score.desc(), UserStats.user_id).limit(limit)
+    )
+    entries = []
+    for position, (username, value) in enumerate(rows, start=1):
+        rank = entries[-1]['rank'] if entries and entries[-1]['score'] == value else position
+        entries.append({'rank': rank, 'username': username, 'score': value})
+    return entries
+
+def overall_rank(board, user_id):
+    # (rank, score) from the user's summary and the score histogram
+    score = getattr(get_user_summary(user_id), LEADERBOARD_BOARDS[board])
+    return score_histogram.rank(board, score), score
+
+def window_scores(board, days):
+    # (user_id, score) for every user with activity on `board` in the last `days` days
+    start = trend_window(days)[0]
+    if board == 'referrals':
+        return select(User.referred_by.label('user_id'), func.count().label('score')).where(
+            User.referred_by.isnot(None), User.created_at >= start
+        ).group_by(User.referred_by)
+    
+    column = ActivityRollup.clicks if board == 'clicks' else ActivityRollup.conversions
+    return select(ActivityRollup.user_id, func.sum(column).label('score')).where(
+        ActivityRollup.granularity == 'day', ActivityRollup.bucket_start >= start
+    ).group_by(ActivityRollup.user_id).having(func.sum(column) > 0)
+
+def build_window_board(board, days):
+    # Replace one windowed board with a freshly ranked snapshot in a single
+    # transaction: readers see the old snapshot until it commits
+    scores = window_scores(board, days).subquery()
+    ranked = select(
+        literal(days), literal(board), scores.c.user_id, scores.c.score,
+        func.rank().over(order_by=scores.c.score.desc())
+    )
+    db.session.execute(delete(LeaderboardEntry).where(
+        LeaderboardEntry.window_days == days, LeaderboardEntry.board == board
+    ))
+    db.session.execute(LeaderboardEntry.__table__.insert().from_select(
+        ['window_days', 'board', 'user_id', 'score', 'rank'], ranked
+    ))
+    ranked_users = db.session.query(func.count()).filter(
+        LeaderboardEntry.window_days == days, LeaderboardEntry.board == board
+    ).scalar()
+    
+    snapshots = LeaderboardSnapshot.__table__
+    statement = dialect_insert(snapshots).values(
+        window_days=days, board=board, ranked_users=ranked_users, built_at=datetime.utcnow(), claimed_at=None
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['window_days', 'board'],
+        set_={'ranked_users': ranked_users, 'built_at': statement.excluded.built_at, 'claimed_at': None}
+    ))
+    db.session.commit()
+    return ranked_users
+
+def claim_window_board(board, days):
+    # A stale (or missing) board is claimed with a conditional write on its
+    # own connection, so exactly one worker rebuilds it while every reader
+    # keeps getting the current snapshot. A claim that never finished
+    # expires after the same TTL
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=current_app.config['LEADERBOARD_WINDOW_TTL'])
+    snapshots = LeaderboardSnapshot.__table__
+    with db.engine.begin() as connection:
+        claimed = connection.execute(update(snapshots).where(
+            snapshots.c.window_days == days, snapshots.c.board == board,
+            or_(snapshots.c.built_at.is_(None), snapshots.c.built_at < stale),
+            or_(snapshots.c.claimed_at.is_(None), snapshots.c.claimed_at < stale)
+        ).values(claimed_at=now)).rowcount
+        if not claimed:
+            claimed = connection.execute(dialect_insert(snapshots).values(
+                window_days=days, board=board, ranked_users=0, claimed_at=now
+            ).on_conflict_do_nothing(index_elements=['window_days', 'board'])).rowcount
+    return bool(claimed)
+
+def rebuild_window_board_in_background(app, board, days):
+    try:
+        with app.app_context():
+            if board != 'referrals':
+                refresh_activity_rollups_if_due()
+            build_window_board(board, days)
+    except Exception:
+        app.logger.exception('Rebuilding the %s leaderboard for %s days failed; serving the previous snapshot', board, days)
+
+def refresh_window_board_if_due(board, days, snapshot):
+    # `snapshot` is the board's LeaderboardSnapshot as the caller read it
+    # (None if never built). Fresh boards, and stale ones another worker has
+    # already claimed, are settled by that read; only the rest try a claim
+    stale = datetime.utcnow() - timedelta(seconds=current_app.config['LEADERBOARD_WINDOW_TTL'])
+    if snapshot and snapshot.built_at and snapshot.built_at >= stale:
+        return
+    if snapshot and snapshot.claimed_at and snapshot.claimed_at >= stale:
+        return
+    if claim_window_board(board, days):
+        threading.Thread(
+            target=rebuild_window_board_in_background, args=(current_app._get_current_object(), board, days),
+            name='leaderboard-refresh', daemon=True
+        ).start()
+
+def window_leaderboard(board, days, limit):
+    rows = db.session.execute(
+        select(LeaderboardEntry.rank, User.username, LeaderboardEntry.score)
+        .join(User, User.id == LeaderboardEntry.user_id)
+        .where(LeaderboardEntry.window_days == days, LeaderboardEntry.board == board)
+        .order_by(LeaderboardEntry.rank, LeaderboardEntry.user_id).limit(limit)
+    )
+    return [{'rank': rank, 'username': username, 'score': score} for rank, username, score in rows]
+
+def window_rank(board, days, user_id, snapshot):
+    # One primary key lookup; users left out of the snapshot share the last rank
+    entry = db.session.get(LeaderboardEntry, (days, board, user_id))
+    if entry:
+        return entry.rank, entry.score
+    return (snapshot.ranked_users if snapshot else 0) + 1, 0
+
+def count_direct_referrals(user_ids):
+    # {user id: number of users they referred} for a page of users, in one grouped query
+    if not user_ids:
+        return {}
+    return dict(
+        db.session.query(User.referred_by, func.count(User.id))
+        .filter(User.referred_by.in_(user_ids))
+        .group_by(User.referred_by)
+    )
+
+def network_member(user, sub_referrals):
+    return {
+        'id': user.id,
+        'name': user.username,
+        'email': user.email,
+        'referrals': sub_referrals.get(user.id, 0),
+        'joined': user.created_at.isoformat(),
+        'status': 'active'
+    }
+
+NETWORK_PAGE_SIZE = 20
+NETWORK_MAX_PAGE_SIZE = 100
+NETWORK_MAX_DEPTH = 10
+
+# Guard against pathological trees: stop walking the downline after this many nodes
+NETWORK_MAX_NODES = 100000
+
+# Parents per query while walking the downline; SQLite allows 32766 bound parameters since 3.32
+NETWORK_WALK_CHUNK = 5000
+
+def downline(root_id, depth, max_nodes):
+    # (user id, referrer id, level) for everyone below root_id down to `depth`
+    # levels, breadth first. Walked one level at a time: each level's parents
+    # in id order, their referrals in (referred_by, id) order straight off
+    # ix_user_referred_by_id, and every query limited to the rows still
+    # wanted. The walk stops after max_nodes + 1 rows (the extra one tells
+    # callers it was cut short), however large the tree below is.
+    rows = []
+    parents = [root_id]
+    for level in range(1, depth + 1):
+        children = []
+        for start in range(0, len(parents), NETWORK_WALK_CHUNK):
+            wanted = max_nodes + 1 - len(rows) - len(children)
+            if wanted <= 0:
+                break
+            children.extend(db.session.execute(
+                select(User.id, User.referred_by)
+                .where(User.referred_by.in_(parents[start:start + NETWORK_WALK_CHUNK]))
+                .order_by(User.referred_by, User.id).limit(wanted)
+            ).all())
+        rows.extend((user_id, parent_id, level) for user_id, parent_id in children)
+        if not children or len(rows) > max_nodes:
+            break
+        parents = sorted(user_id for user_id, _ in children)
+    
+    return rows
+
+ADMIN_USERS_PAGE_SIZE = 100
+ADMIN_USERS_MAX_PAGE_SIZE = 1000
+
+ADMIN_USER_SORTS = {
+    'created_at': User.created_at,
+    'id': User.id,
+    'username': User.username,
+    'email': User.email
+}
+
+def encode_cursor(value, row_id):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps([value, row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+def decode_cursor(cursor, column):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if isinstance(column.type, db.DateTime):
+            value = datetime.fromisoformat(value)
+    except (TypeError, ValueError, binascii.Error) as error:
+        raise ValueError('malformed cursor') from error
+    if not isinstance(row_id, int):
+        raise ValueError('malformed cursor')
+    return value, row_id
+
+def trend_series(data, current, previous):
+    if previous:
+        change = round((current - previous) / previous * 100, 1)
+    else:
+        change = 100.0 if current else 0
+    
+    return {
+        'data': data,
+        'period': 'Last 7 days',
+        'change': change,
+        'changeType': 'positive' if change > 0 else 'negative' if change < 0 else 'neutral'
+    }
+
+EXPORT_DATASETS = ('clicks', 'links', 'referrals')
+
+def parse_export_time(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+
+def export_statement(dataset, start=None, end=None, link_ids=None):
+    # Columns and ordered SELECT for one export; `start` is inclusive, `end` exclusive
+    if dataset == 'clicks':
+        columns = (ReferralClick.id, ReferralClick.link_id, ReferralClick.ip_address,
+                   UserAgent.value.label('user_agent'), ReferralClick.clicked_at)
+        timestamp, link_column = ReferralClick.clicked_at, ReferralClick.link_id
+    elif dataset == 'links':
+        columns = (ReferralLink.id, ReferralLink.user_id, ReferralLink.link_code, ReferralLink.clicks,
+                   ReferralLink.conversions, ReferralLink.is_active, ReferralLink.created_at)
+        timestamp, link_column = ReferralLink.created_at, ReferralLink.id
+    elif dataset == 'referrals':
+        # The referral graph: one edge per user to the user who referred them
+        columns = (User.id, User.username, User.referral_code, User.referred_by, User.created_at)
+        timestamp, link_column = User.created_at, None
+    else:
+        raise ValueError(f"Unknown export: {dataset}")
+    
+    statement = select(*columns)
+    if dataset == 'clicks':
+        # Interned agents come back as the header text
+        statement = statement.outerjoin(UserAgent, ReferralClick.user_agent_id == UserAgent.id)
+    if start is not None:
+        statement = statement.where(timestamp >= start)
+    if end is not None:
+        statement = statement.where(timestamp < end)
+    if link_ids:
+        if link_column is None:
+            raise ValueError(f"The {dataset} export cannot be filtered by link")
+        statement = statement.where(link_column.in_(link_ids))
+    
+    # Timestamp order walks the timestamp index, so rows stream without a sort
+    statement = statement.order_by(timestamp, columns[0])
+    return [column.key for column in columns], statement
+
+def stream_export(columns, statement, fmt):
+    # yield_per fetches in batches (a server-side cursor on PostgreSQL)
+    rows = db.session.execute(statement.execution_options(yield_per=current_app.config['EXPORT_YIELD_PER']))
+    yield from encode_rows(rows, columns, fmt)
+
+IMPORT_DATASETS = ('users', 'conversions', 'clicks')
+
+# A stored bcrypt hash, e.g. carried over from a system using the same scheme
+BCRYPT_HASH = re.compile(r'\$2[aby]\$\d\d\$[./A-Za-z0-9]{53}')
+
+def link_reference(row):
+    # Imported conversions and clicks name their link by code, or by id as the exports do
+    link_code = text_field(row, 'link_code', 50, required=False)
+    if link_code is not None:
+        return 'code', link_code
+    link_id = row.get('link_id')
+    if link_id is None or link_id == '':
+        raise RowError('link_code or link_id is required')
+    try:
+        return 'id', int(link_id)
+    except (TypeError, ValueError):
+        raise RowError(f'link_id is not an integer: {link_id}')
+
+def lookup_import_links(references):
+    # At most one IN query per reference kind; returns {reference: row}
+    found = {}
+    columns = (ReferralLink.id, ReferralLink.user_id, ReferralLink.is_active, ReferralLink.link_code)
+    codes = {value for kind, value in references if kind == 'code'}
+    ids = {value for kind, value in references if kind == 'id'}
+    if codes:
+        for row in db.session.execute(select(*columns).where(ReferralLink.link_code.in_(codes))):
+            found['code', row.link_code] = row
+    if ids:
+        for row in db.session.execute(select(*columns).where(ReferralLink.id.in_(ids))):
+            found['id', row.id] = row
+    return found
+
+def import_users(rows, hash_passwords=True):
+    # Registrations with optional referralLinkCode attribution, as
+    # POST /api/register records them. Uniqueness is checked with one IN
+    # query per column against the table and with sets within the chunk;
+    # rows taken by an earlier chunk were committed, so the queries see them
+    errors, candidates = [], []
+    usernames, emails = set(), set()
+    now = datetime.utcnow()
+    for number, row in rows:
+        try:
+            values = {
+                'username': text_field(row, 'username', 80),
+                'email': text_field(row, 'email', 120),
+                'password_hash': text_field(row, 'password_hash', 120, required=False),
+                'created_at': time_field(row, 'created_at') or now
+            }
+            password = None if values['password_hash'] else text_field(row, 'password', 1024, required=False)
+            if values['password_hash'] is not None and not BCRYPT_HASH.fullmatch(values['password_hash']):
+                raise RowError('password_hash is not a bcrypt hash')
+            if values['password_hash'] is None and password is None:
+                raise RowError('password_hash or password is required')
+            if password is not None and not hash_passwords:
+                raise RowError('send password_hash; plain passwords are only hashed by `flask import`')
+            link_code = text_field(row, 'referralLinkCode', 50, required=False)
+        except RowError as error:
+            errors.append((number, str(error)))
+            continue
+    
+        if values['username'] in usernames:
+            errors.append((number, 'username appears earlier in this import'))
+        elif values['email'] in emails:
+            errors.append((number, 'email appears earlier in this import'))
+        else:
+            usernames.add(values['username'])
+            emails.add(values['email'])
+            candidates.append((number, values, password, link_code))
+    
+    if not candidates:
+        return 0, errors
+    
+    taken_usernames = set(db.session.scalars(select(User.username).where(User.username.in_(usernames))))
+    taken_emails = set(db.session.scalars(select(User.email).where(User.email.in_(emails))))
+    links = lookup_import_links({('code', link_code) for _, _, _, link_code in candidates if link_code})
+    
+    accepted = []
+    for number, values, password, link_code in candidates:
+        link = links.get(('code', link_code)) if link_code else None
+        if values['username'] in taken_usernames:
+            errors.append((number, 'Username already exists'))
+        elif values['email'] in taken_emails:
+            errors.append((number, 'Email already exists'))
+        elif link_code and (link is None or not link.is_active):
+            errors.append((number, f'referralLinkCode {link_code} is not an active referral link'))
+        else:
+            if password is not None:
+                # Full bcrypt cost per row; stored hashes skip this
+                values['password_hash'] = bcrypt.generate_password_hash(password).decode('utf-8')
+            values['referred_by'] = link.user_id if link else None
+            accepted.append((values, link))
+    
+    if not accepted:
+        return 0, errors
+    
+    # Nothing is written before this point, so reserving a sequence block is safe
+    created = insert_many_with_unique_codes(
+        User.__table__, 'referral_code', 'referral', [values for values, _ in accepted],
+        returning=[User.id]
+    )
+    db.session.execute(UserStats.__table__.insert(), [{'user_id': row.id} for _, row in created])
+    score_histogram.enter([{}] * len(created))
+    
+    attributed = [(values, link) for values, link in accepted if link]
+    if attributed:
+        db.session.execute(ConversionEvent.__table__.insert(), [
+            {'link_id': link.id, 'converted_at': values['created_at']} for values, link in attributed
+        ])
+        pending = link_counters.pending()
+        pending_stats = user_stats_counters.pending()
+        for values, link in attributed:
+            pending.add(link.id, conversions=1)
+            pending_stats.add(link.user_id, referrals_count=1, total_conversions=1, earnings=EARNINGS_PER_CONVERSION, version=1)
+        pending.apply()
+        score_histogram.moved(pending_stats.apply())
+        touch_referrers({link.user_id for _, link in attributed})
+    
+    return len(accepted), errors
+
+def import_conversions(rows):
+    # Conversions replayed from another system. Inactive links are accepted,
+    # the conversions happened while they were live; rows are not
+    # deduplicated, importing a file twice counts its conversions twice
+    errors, parsed = [], []
+    for number, row in rows:
+        try:
+            parsed.append((number, link_reference(row), time_field(row, 'converted_at')))
+        except RowError as error:
+            errors.append((number, str(error)))
+    
+    links = lookup_import_links({reference for _, reference, _ in parsed})
+    now = datetime.utcnow()
+    events = []
+    pending = link_counters.pending()
+    pending_stats = user_stats_counters.pending()
+    for number, reference, converted_at in parsed:
+        link = links.get(reference)
+        if link is None:
+            errors.append((number, f'Unknown referral link: {reference[1]}'))
+            continue
+        events.append({'link_id': link.id, 'converted_at': converted_at or now})
+        pending.add(link.id, conversions=1)
+        pending_stats.add(link.user_id, total_conversions=1, earnings=EARNINGS_PER_CONVERSION, version=1)
+    
+    if events:
+        db.session.execute(ConversionEvent.__table__.insert(), events)
+        pending.apply()
+        score_histogram.moved(pending_stats.apply())
+    return len(events), errors
+
+def import_clicks(rows):
+    # Historical clicks, e.g. a clicks export from another deployment. They
+    # bypass the dedup and bot filters, which only see live traffic, and are
+    # not deduplicated either
+    errors, parsed = [], []
+    for number, row in rows:
+        try:
+            parsed.append((number, link_reference(row), {
+                'ip_address': text_field(row, 'ip_address', 45),
+                'user_agent': text_field(row, 'user_agent', 64 * 1024, required=False),
+                'clicked_at': time_field(row, 'clicked_at')
+            }))
+        except RowError as error:
+            errors.append((number, str(error)))
+    
+    links = lookup_import_links({reference for _, reference, _ in parsed})
+    now = datetime.utcnow()
+    clicks = []
+    for number, reference, click_values in parsed:
+        link = links.get(reference)
+        if link is None:
+            errors.append((number, f'Unknown referral link: {reference[1]}'))
+            continue
+        clicks.append(dict(click_values, link_id=link.id, clicked_at=click_values['clicked_at'] or now))
+    
+    if clicks:
+        # Same bulk write as the click buffer; it commits the chunk
+        write_click_batch(clicks)
+    return len(clicks), errors
+
+IMPORTERS = {'users': import_users, 'conversions': import_conversions, 'clicks': import_clicks}
+
+def import_rows(dataset, records, on_error=None, hash_passwords=True):
+    # Validate and write decoded (number, row, error) records in chunks of
+    # IMPORT_CHUNK_SIZE, one transaction each: a rejected row never costs the
+    # rest of its chunk, and a failure part way through a file keeps the
+    # chunks before it. The report lists the first IMPORT_MAX_ERRORS
+    # rejected rows; on_error(number, message) is called for every one
+    importer = partial(import_users, hash_passwords=hash_passwords) if dataset == 'users' else IMPORTERS[dataset]
+    max_errors = current_app.config['IMPORT_MAX_ERRORS']
+    report = {'received': 0, 'inserted': 0, 'error_count': 0, 'errors': []}
+    
+    for chunk in chunked(records, current_app.config['IMPORT_CHUNK_SIZE']):
+        report['received'] += len(chunk)
+        rows = [(number, row) for number, row, error in chunk if error is None]
+        errors = [(number, error) for number, _, error in chunk if error is not None]
+        if rows:
+            try:
+                inserted, rejected = importer(rows)
+                db.session.commit()
+            except IntegrityError:
+                # A concurrent registration took a username or email between
+                # the check and the insert
+                db.session.rollback()
+                inserted, rejected = 0, [(number, 'Conflicts with a concurrent write, import the row again') for number, _ in rows]
+            report['inserted'] += inserted
+            errors += rejected
+    
+        for number, message in sorted(errors):
+            report['error_count'] += 1
+            if len(report['errors']) < max_errors:
+                report['errors'].append({'row': number, 'error': message})
+            if on_error:
+                on_error(number, message)
+    
+    return report
+
+request_metrics.add_collector(
+    'referral_clicks_total', 'Referral clicks by outcome: recorded, duplicate or bot.',
+    lambda: {(('outcome', outcome),): count for outcome, count in click_filter.counts().items()}
+)
 
 # Routes
-@app.route('/api/register', methods=['POST'])
+@api.app_errorhandler(HasherBusy)
+def handle_hasher_busy(error):
+    response = jsonify({'error': 'Too many login attempts in progress, please retry shortly'})
+    response.headers['Retry-After'] = str(current_app.config['PASSWORD_HASH_RETRY_AFTER'])
+    return response, 503
+
+@api.app_errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(error):
+    return jsonify({'error': f"Request body over {current_app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+
+@api.route('/api/register', methods=['POST'])
 def register():
     data = request.get_json()
     
@@ -69,33 +1459,45 @@ def register():
     if User.query.filter_by(email=data['email']).first():
         return jsonify({'error': 'Email already exists'}), 400
     
+    # Hash before any writes so a full hash queue rejects the request cleanly
+    password_hash = password_hasher.hash(data['password'])
+    
     # Handle referral link code if provided
-    referred_by_id = None
-    if data.get('referralLinkCode'):
-        referral_link = ReferralLink.query.filter_by(link_code=data['referralLinkCode'], is_active=True).first()
-        if referral_link:
-            referred_by_id = referral_link.user_id
-            # Track conversion
-            referral_link.conversions += 1
-    
-    # Create new user
-    password_hash = bcrypt.generate_password_hash(data['password']).decode('utf-8')
-    referral_code = generate_referral_code()
-    
-    user = User(
-        username=data['username'],
-        email=data['email'],
-        password_hash=password_hash,
-        referral_code=referral_code,
-        referred_by=referred_by_id
+    referral_link = resolve_active_link(data['referralLinkCode']) if data.get('referralLinkCode') else None
+    referred_by_id = referral_link.user_id if referral_link else None
+    
+    # Create new user first: allocating its code may need its own transaction
+    referral_code, user = insert_with_unique_code(
+        User.__table__, 'referral_code', 'referral',
+        {'username': data['username'], 'email': data['email'], 'password_hash': password_hash, 'referred_by': referred_by_id},
+        returning=[User.id]
     )
+    db.session.add(UserStats(user_id=user.id))
+    score_histogram.enter([{}])
+    
+    if referral_link:
+        # Track conversion. As in track_conversion(), the UPDATE re-checks
+        # is_active; a link deactivated since it was cached gets no referral
+        converted = link_counters.increment_where(
+            ReferralLink.id == referral_link.id,
+            ReferralLink.is_active == True,
+            returning=[ReferralLink.user_id],
+            conversions=1
+        )
+        
+        if converted:
+            bump_user_stats(referred_by_id, referrals_count=1, total_conversions=1)
+            touch_referrers([referred_by_id])
+            db.session.add(ConversionEvent(link_id=referral_link.id))
+        else:
+            link_cache.invalidate(data['referralLinkCode'])
+            db.session.execute(update(User).where(User.id == user.id).values(referred_by=None))
     
-    db.session.add(user)
     db.session.commit()
     
     return jsonify({'message': 'User created successfully', 'referral_code': referral_code}), 201
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
     
@@ -104,7 +1506,15 @@ def login():
     
     user = User.query.filter_by(username=data['username']).first()
     
-    if user and bcrypt.check_password_hash(user.password_hash, data['password']):
+    if user and password_hasher.check(user.password_hash, data['password']):
+        # Upgrade hashes made with a different BCRYPT_LOG_ROUNDS; best effort
+        if password_hasher.needs_rehash(user.password_hash):
+            try:
+                user.password_hash = password_hasher.hash(data['password'])
+                db.session.commit()
+            except HasherBusy:
+                pass
+        
         session['user_id'] = user.id
         session['is_admin'] = user.is_admin
         
@@ -121,12 +1531,12 @@ def login():
     
     return jsonify({'error': 'Invalid credentials'}), 401
 
-@app.route('/api/logout', methods=['POST'])
+@api.route('/api/logout', methods=['POST'])
 def logout():
     session.clear()
     return jsonify({'message': 'Logged out successfully'}), 200
 
-@app.route('/api/user/profile', methods=['GET'])
+@api.route('/api/user/profile', methods=['GET'])
 def get_user_profile():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -142,15 +1552,53 @@ def get_user_profile():
         'is_admin': user.is_admin,
         'referral_code': user.referral_code,
         'referred_by': user.referred_by,
-        'referrals_count': len(user.referrals)
+        'referrals_count': get_user_summary(user.id).referrals_count
     }), 200
 
-@app.route('/api/admin/users', methods=['GET'])
+@api.route('/api/admin/users', methods=['GET'])
 def get_all_users():
     if 'user_id' not in session or not session.get('is_admin'):
         return jsonify({'error': 'Admin access required'}), 403
     
-    users = User.query.all()
+    sort = request.args.get('sort', 'created_at')
+    descending = sort.startswith('-')
+    sort_column = ADMIN_USER_SORTS.get(sort.lstrip('-'))
+    if sort_column is None:
+        return jsonify({'error': f"Invalid sort, expected one of: {', '.join(ADMIN_USER_SORTS)}"}), 400
+    
+    try:
+        limit = min(max(int(request.args.get('limit', ADMIN_USERS_PAGE_SIZE)), 1), ADMIN_USERS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    query = User.query
+    
+    # Case-sensitive prefix search as a range, so the unique username/email indexes are used
+    search = request.args.get('q', '').strip()
+    if search:
+        upper = search + '\U0010ffff'
+        query = query.filter(or_(
+            and_(User.username >= search, User.username < upper),
+            and_(User.email >= search, User.email < upper)
+        ))
+    
+    # Keyset pagination: resume strictly after the (sort value, id) of the last row served
+    if request.args.get('cursor'):
+        try:
+            last_value, last_id = decode_cursor(request.args['cursor'], sort_column)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        position = tuple_(sort_column, User.id)
+        query = query.filter(position < tuple_(last_value, last_id) if descending else position > tuple_(last_value, last_id))
+    
+    order = [sort_column.desc(), User.id.desc()] if descending else [sort_column.asc(), User.id.asc()]
+    users = query.order_by(*order).limit(limit + 1).all()
+    has_more = len(users) > limit
+    users = users[:limit]
+    
+    # Referral counts for the whole page in one grouped query
+    referral_counts = count_direct_referrals([user.id for user in users])
+    
     users_data = []
     
     for user in users:
@@ -160,13 +1608,19 @@ def get_all_users():
             'email': user.email,
             'is_admin': user.is_admin,
             'referral_code': user.referral_code,
-            'referrals_count': len(user.referrals),
+            'referrals_count': referral_counts.get(user.id, 0),
             'created_at': user.created_at.isoformat()
         })
     
-    return jsonify(users_data), 200
+    response = jsonify(users_data)
+    if has_more:
+        last = users[-1]
+        response.headers['X-Next-Cursor'] = encode_cursor(getattr(last, sort_column.key), last.id)
+    
+    return response, 200
 
-@app.route('/api/referral-links', methods=['GET'])
+@api.route('/api/referral-links', methods=['GET'])
+@versioned_per_user()
 def get_referral_links():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -187,22 +1641,25 @@ def get_referral_links():
     
     return jsonify(links_data), 200
 
-@app.route('/api/referral-links', methods=['POST'])
+@api.route('/api/referral-links', methods=['POST'])
 def create_referral_link():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
     user = User.query.get(session['user_id'])
-    link_code = generate_link_code()
     
-    referral_link = ReferralLink(
-        user_id=user.id,
-        link_code=link_code
+    link_code, referral_link = insert_with_unique_code(
+        ReferralLink.__table__, 'link_code', 'link',
+        {'user_id': user.id, 'clicks': 0, 'conversions': 0, 'is_active': True},
+        returning=[ReferralLink.id, ReferralLink.created_at]
     )
     
-    db.session.add(referral_link)
+    bump_user_stats(user.id, links_count=1, active_links_count=1)
     db.session.commit()
     
+    # Drop any negative entry cached for this code before it existed
+    link_cache.invalidate(link_code)
+    
     return jsonify({
         'id': referral_link.id,
         'link_code': link_code,
@@ -210,69 +1667,263 @@ def create_referral_link():
         'created_at': referral_link.created_at.isoformat()
     }), 201
 
-@app.route('/api/referral/<link_code>', methods=['GET'])
-def track_referral_click(link_code):
-    referral_link = ReferralLink.query.filter_by(link_code=link_code, is_active=True).first()
+@api.route('/api/referral-links/<int:link_id>', methods=['DELETE'])
+def deactivate_referral_link(link_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
     
+    referral_link = ReferralLink.query.filter_by(id=link_id, user_id=session['user_id']).first()
     if not referral_link:
-        return jsonify({'error': 'Invalid referral link'}), 404
+        return jsonify({'error': 'Referral link not found'}), 404
     
-    # Track the click
-    click = ReferralClick(
-        link_id=referral_link.id,
-        ip_address=request.remote_addr,
-        user_agent=request.headers.get('User-Agent')
-    )
+    if referral_link.is_active:
+        referral_link.is_active = False
+        bump_user_stats(referral_link.user_id, active_links_count=-1)
+        db.session.commit()
     
-    db.session.add(click)
-    referral_link.clicks += 1
-    db.session.commit()
+    link_cache.invalidate(referral_link.link_code)
+    
+    return jsonify({'message': 'Referral link deactivated'}), 200
+
+@api.route('/api/admin/cache-stats', methods=['GET'])
+def get_cache_stats():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
     
     return jsonify({
-        'message': 'Referral link tracked',
-        'referrer': referral_link.user.username
+        'link_cache': link_cache.stats(),
+        'user_agent_cache': user_agent_cache.stats(),
+        'code_allocator': code_allocator.stats(),
+        'click_filter': click_filter.stats(),
+        'kpi_cache': kpi_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'live_events': live_events.stats(),
+        'password_hasher': password_hasher.stats()
     }), 200
 
-@app.route('/api/referral/<link_code>/convert', methods=['POST'])
-def convert_referral(link_code):
-    referral_link = ReferralLink.query.filter_by(link_code=link_code, is_active=True).first()
+@api.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus scrape endpoint; protected by a bearer token when METRICS_TOKEN is set
+    token = current_app.config['METRICS_TOKEN']
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'Metrics token required'}), 401
+    
+    return Response(request_metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@api.route('/api/admin/export/<dataset>', methods=['GET'])
+def export_data(dataset):
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+    
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({'error': 'Unknown export'}), 404
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    try:
+        columns, statement = export_statement(
+            dataset,
+            start=parse_export_time(request.args.get('start')),
+            end=parse_export_time(request.args.get('end')),
+            link_ids=request.args.getlist('link_id', type=int)
+        )
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    
+    filename = f"{dataset}-{datetime.utcnow():%Y%m%d-%H%M%S}.{fmt}"
+    return Response(
+        stream_with_context(stream_export(columns, statement, fmt)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@api.route('/api/admin/import/<dataset>', methods=['POST'])
+def import_data(dataset):
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+    
+    if dataset not in IMPORT_DATASETS:
+        return jsonify({'error': 'Unknown import'}), 404
+    
+    # ?format= wins over the Content-Type
+    fmt = request.args.get('format') or next(
+        (name for name, mimetype in IMPORT_FORMATS.items() if mimetype == request.mimetype), None
+    )
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(IMPORT_FORMATS)}"}), 400
+    
+    # Decode straight off the request stream and stop one row past the
+    # limit, so an oversized CSV/NDJSON upload is refused without reading it
+    # all (MAX_CONTENT_LENGTH bounds the JSON array, which is parsed whole)
+    max_rows = current_app.config['IMPORT_MAX_ROWS']
+    lines = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8', errors='replace', newline='')
+    try:
+        records = list(islice(decode_rows(lines, fmt), max_rows + 1))
+    except RowError as error:
+        return jsonify({'error': str(error)}), 400
+    
+    if len(records) > max_rows:
+        return jsonify({'error': f'At most {max_rows} rows per request; load larger files with `flask import`'}), 413
+    
+    # Hashing plain passwords at full cost would hold the worker for minutes
+    return jsonify(import_rows(dataset, records, hash_passwords=False)), 200
+
+def track_click(link_code, ip_address, user_agent):
+    # Click endpoint logic, shared by the Flask route and the async click
+    # service in asgi.py; needs an app context, returns (body, status)
+    referral_link = resolve_active_link(link_code)
+    
+    if not referral_link:
+        return {'error': 'Invalid referral link'}, 404
+    
+    outcome = click_filter.classify(referral_link.id, ip_address, user_agent)
+    
+    # Track the click; repeats and bots get the same answer without a database write
+    if outcome == RECORDED and click_buffer.enabled:
+        click_buffer.add(referral_link.id, ip_address, user_agent)
+    elif outcome == RECORDED:
+        # Interned on its own connection, so before this session takes the
+        # write lock
+        user_agent_id = user_agent_cache.get_id(user_agent)
+        
+        # Re-check is_active in the UPDATE, as track_conversion() does; the
+        # buffered path drops such clicks in write_click_batch()
+        counted = link_counters.increment_where(
+            ReferralLink.id == referral_link.id,
+            ReferralLink.is_active == True,
+            clicks=1
+        )
+        
+        if not counted:
+            link_cache.invalidate(link_code)
+            return {'error': 'Invalid referral link'}, 404
+        
+        click = ReferralClick(
+            link_id=referral_link.id,
+            ip_address=ip_address,
+            user_agent_id=user_agent_id
+        )
+        
+        db.session.add(click)
+        bump_user_stats(referral_link.user_id, total_clicks=1)
+        db.session.commit()
+    
+    return {'message': 'Referral link tracked', 'referrer': referral_link.referrer}, 200
+
+def track_conversion(link_code):
+    # Conversion endpoint logic, shared like track_click()
+    referral_link = resolve_active_link(link_code)
     
     if not referral_link:
-        return jsonify({'error': 'Invalid referral link'}), 404
+        return {'error': 'Invalid referral link'}, 404
+    
+    # Re-check is_active in the UPDATE itself: the cached entry may be stale
+    # if another worker deactivated the link. The owner comes back from the
+    # same statement.
+    converted = link_counters.increment_where(
+        ReferralLink.id == referral_link.id,
+        ReferralLink.is_active == True,
+        returning=[ReferralLink.user_id],
+        conversions=1
+    )
     
-    referral_link.conversions += 1
+    if not converted:
+        link_cache.invalidate(link_code)
+        return {'error': 'Invalid referral link'}, 404
+    
+    bump_user_stats(converted[0].user_id, total_conversions=1)
+    db.session.add(ConversionEvent(link_id=referral_link.id))
     db.session.commit()
     
-    return jsonify({'message': 'Conversion tracked successfully'}), 200
+    return {'message': 'Conversion tracked successfully'}, 200
 
-# Initialize database
-with app.app_context():
-    db.create_all()
+@api.route('/api/referral/<link_code>', methods=['GET'])
+def track_referral_click(link_code):
+    body, status = track_click(link_code, request.remote_addr, request.headers.get('User-Agent'))
+    return jsonify(body), status
+
+@api.route('/api/referral/<link_code>/convert', methods=['POST'])
+def convert_referral(link_code):
+    body, status = track_conversion(link_code)
+    return jsonify(body), status
+
+def event_stream(user_id):
+    # Each open stream holds a gunicorn thread, so workers take only
+    # EVENTS_THREAD_STREAMS; the async service (asgi.py) serves these paths
+    # in production and takes thousands per process
+    try:
+        subscription = live_events.subscribe(user_id, current_app.config['EVENTS_THREAD_STREAMS'])
+    except TooManyStreams:
+        response = jsonify({'error': 'Too many live streams open, please retry shortly'})
+        response.headers['Retry-After'] = str(RETRY_AFTER)
+        return response, 503
     
-    # Create admin user if it doesn't exist
-    admin = User.query.filter_by(username='admin').first()
-    if not admin:
-        # Also check if email already exists
-        existing_email = User.query.filter_by(email='admin@elantar.com').first()
-        if not existing_email:
-            admin_password = bcrypt.generate_password_hash('admin123').decode('utf-8')
-            admin = User(
-                username='admin',
-                email='admin@elantar.com',
-                password_hash=admin_password,
-                is_admin=True,
-                referral_code=generate_referral_code()
-            )
-            db.session.add(admin)
-            db.session.commit()
-            print("✅ Admin user created successfully!")
-        else:
-            print("ℹ️ Admin user already exists with this email")
-    else:
-        print("ℹ️ Admin user already exists")
+    response = Response(subscription.frames(), mimetype='text/event-stream', headers=STREAM_HEADERS)
+    # A stream closed before its first frame never runs the generator's cleanup
+    response.call_on_close(subscription.close)
+    return response
+
+@api.route('/api/events', methods=['GET'])
+def stream_user_events():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    return event_stream(session['user_id'])
+
+@api.route('/api/admin/events', methods=['GET'])
+def stream_admin_events():
+    if 'user_id' not in session or not session.get('is_admin'):
+        return jsonify({'error': 'Admin access required'}), 403
+    
+    return event_stream(None)
 
 # New API endpoints for enhanced functionality
-@app.route('/api/network', methods=['GET'])
+@api.route('/api/leaderboard', methods=['GET'])
+def get_leaderboard():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    metric = request.args.get('metric', 'referrals')
+    if metric not in LEADERBOARD_METRICS:
+        return jsonify({'error': f"Invalid metric, expected one of: {', '.join(LEADERBOARD_METRICS)}"}), 400
+    window = request.args.get('window', 'all')
+    if window not in LEADERBOARD_WINDOWS:
+        return jsonify({'error': f"Invalid window, expected one of: {', '.join(LEADERBOARD_WINDOWS)}"}), 400
+    
+    try:
+        limit = min(max(int(request.args.get('limit', LEADERBOARD_PAGE_SIZE)), 1), LEADERBOARD_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    board, multiplier = LEADERBOARD_METRICS[metric]
+    days = LEADERBOARD_WINDOWS[window]
+    if days is None:
+        # Live: UserStats and the score histogram move with every write
+        entries = overall_leaderboard(board, limit)
+        rank, score = overall_rank(board, session['user_id'])
+        as_of = None
+    else:
+        snapshot = db.session.get(LeaderboardSnapshot, (days, board))
+        refresh_window_board_if_due(board, days, snapshot)
+        entries = window_leaderboard(board, days, limit)
+        rank, score = window_rank(board, days, session['user_id'], snapshot)
+        as_of = snapshot.built_at.isoformat() if snapshot and snapshot.built_at else None
+    
+    for entry in entries:
+        entry['score'] *= multiplier
+    
+    return jsonify({
+        'metric': metric,
+        'window': window,
+        'as_of': as_of,
+        'entries': entries,
+        'me': {'rank': rank, 'score': score * multiplier}
+    }), 200
+
+@api.route('/api/network', methods=['GET'])
+@versioned_per_user()
 def get_user_network():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -284,24 +1935,81 @@ def get_user_network():
     # Get users referred by current user
     referred_users = User.query.filter_by(referred_by=current_user.id).all()
     
-    network_data = []
-    for user in referred_users:
-        # Count how many people this user has referred
-        sub_referrals = User.query.filter_by(referred_by=user.id).count()
-        
-        user_data = {
-            'id': user.id,
-            'name': user.username,
-            'email': user.email,
-            'referrals': sub_referrals,
-            'joined': user.created_at.isoformat(),
-            'status': 'active'
-        }
-        network_data.append(user_data)
+    # Count how many people each of them has referred, in one query
+    sub_referrals = count_direct_referrals([user.id for user in referred_users])
+    
+    network_data = [network_member(user, sub_referrals) for user in referred_users]
     
     return jsonify(network_data), 200
 
-@app.route('/api/achievements', methods=['GET'])
+@api.route('/api/network/tree', methods=['GET'])
+def get_user_network_tree():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    current_user = User.query.get(session['user_id'])
+    if not current_user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    try:
+        depth = min(max(int(request.args.get('depth', 3)), 1), NETWORK_MAX_DEPTH)
+        limit = min(max(int(request.args.get('limit', NETWORK_PAGE_SIZE)), 1), NETWORK_MAX_PAGE_SIZE)
+        page_level = int(request.args['level']) if 'level' in request.args else None
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({'error': 'depth, limit, level and after must be integers'}), 400
+    
+    # `after` is an id within one level's page, so it needs that level
+    if 'after' in request.args and page_level is None:
+        return jsonify({'error': 'after needs level'}), 400
+    
+    rows = downline(current_user.id, depth, NETWORK_MAX_NODES)
+    truncated = len(rows) > NETWORK_MAX_NODES
+    rows = rows[:NETWORK_MAX_NODES]
+    
+    # Rows arrive breadth first, so folding them in reverse adds every node
+    # to its parent after the node's own subtree is complete
+    subtree_sizes = defaultdict(int)
+    for user_id, parent_id, _ in reversed(rows):
+        subtree_sizes[parent_id] += subtree_sizes[user_id] + 1
+    
+    by_level = defaultdict(list)
+    for user_id, _, level in rows:
+        by_level[level].append(user_id)
+    
+    # One page per level (or only the requested level), keyset-paginated on id
+    pages = {}
+    for level, user_ids in by_level.items():
+        if page_level is not None and level != page_level:
+            continue
+        user_ids = sorted(user_id for user_id in user_ids if user_id > after)
+        pages[level] = (user_ids[:limit], len(user_ids) > limit)
+    
+    page_ids = [user_id for user_ids, _ in pages.values() for user_id in user_ids]
+    users = {user.id: user for user in User.query.filter(User.id.in_(page_ids))} if page_ids else {}
+    sub_referrals = count_direct_referrals(page_ids)
+    
+    levels = []
+    for level in sorted(by_level):
+        entry = {'level': level, 'count': len(by_level[level])}
+        if level in pages:
+            user_ids, has_more = pages[level]
+            entry['users'] = [
+                dict(network_member(users[user_id], sub_referrals), subtree_size=subtree_sizes[user_id])
+                for user_id in user_ids
+            ]
+            entry['next_after'] = user_ids[-1] if has_more else None
+        levels.append(entry)
+    
+    return jsonify({
+        'depth': depth,
+        'total': len(rows),
+        'truncated': truncated,
+        'levels': levels
+    }), 200
+
+@api.route('/api/achievements', methods=['GET'])
+@versioned_per_user()
 def get_user_achievements():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -311,9 +2019,9 @@ def get_user_achievements():
         return jsonify({'error': 'User not found'}), 404
     
     # Calculate user stats
-    referrals_count = len(current_user.referrals)
-    total_links = len(current_user.referral_links)
-    total_clicks = sum(link.clicks for link in current_user.referral_links)
+    summary = get_user_summary(current_user.id)
+    referrals_count = summary.referrals_count
+    total_clicks = summary.total_clicks
     
     # Define achievements with real progress
     achievements = [
@@ -365,7 +2073,8 @@ def get_user_achievements():
     
     return jsonify(achievements), 200
 
-@app.route('/api/stats', methods=['GET'])
+@api.route('/api/stats', methods=['GET'])
+@versioned_per_user()
 def get_user_stats():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -375,14 +2084,13 @@ def get_user_stats():
         return jsonify({'error': 'User not found'}), 404
     
     # Calculate comprehensive stats
-    referrals_count = len(current_user.referrals)
-    total_links = len(current_user.referral_links)
-    total_clicks = sum(link.clicks for link in current_user.referral_links)
-    total_conversions = sum(link.conversions for link in current_user.referral_links)
-    active_links = len([link for link in current_user.referral_links if link.is_active])
-    
-    # Calculate earnings (example: $15 per conversion)
-    earnings = total_conversions * 15
+    summary = get_user_summary(current_user.id)
+    referrals_count = summary.referrals_count
+    total_links = summary.links_count
+    total_clicks = summary.total_clicks
+    total_conversions = summary.total_conversions
+    active_links = summary.active_links_count
+    earnings = summary.earnings
     
     # Calculate conversion rate
     conversion_rate = (total_conversions / total_clicks * 100) if total_clicks > 0 else 0
@@ -405,7 +2113,8 @@ def get_user_stats():
     
     return jsonify(stats), 200
 
-@app.route('/api/analytics/trends', methods=['GET'])
+@api.route('/api/analytics/trends', methods=['GET'])
+@versioned_per_user(validator=trend_validator)
 def get_analytics_trends():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
@@ -414,169 +2123,333 @@ def get_analytics_trends():
     if not current_user:
         return jsonify({'error': 'User not found'}), 404
     
-    from datetime import datetime, timedelta
+    refresh_activity_rollups_if_due()
     
-    # Get real data from user's referral links
-    total_clicks = sum(link.clicks for link in current_user.referral_links)
-    total_conversions = sum(link.conversions for link in current_user.referral_links)
-    earnings = total_conversions * 15
+    # Two weeks of real daily activity: the previous week only feeds 'change'
+    clicks, conversions = daily_activity(TREND_DAYS * 2, user_id=current_user.id)
+    earnings = [count * EARNINGS_PER_CONVERSION for count in conversions]
+    conversion_rates = [
+        int(converted / clicked * 100) if clicked else 0
+        for clicked, converted in zip(clicks, conversions)
+    ]
     
-    # Calculate conversion rate
-    conversion_rate = (total_conversions / total_clicks * 100) if total_clicks > 0 else 0
+    def weekly_rate(clicked, converted):
+        return (sum(converted) / sum(clicked) * 100) if sum(clicked) > 0 else 0
     
-    # If user has no activity, return zero trends
-    if total_clicks == 0 and total_conversions == 0:
-        trends = {
-            'clicks': {
-                'data': [0, 0, 0, 0, 0, 0, 0],
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            },
-            'conversions': {
-                'data': [0, 0, 0, 0, 0, 0, 0],
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            },
-            'earnings': {
-                'data': [0, 0, 0, 0, 0, 0, 0],
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            },
-            'conversionRate': {
-                'data': [0, 0, 0, 0, 0, 0, 0],
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            }
-        }
-    else:
-        # For users with activity, create simple trend data based on their actual stats
-        # Distribute their total activity across 7 days with some variation
-        clicks_per_day = total_clicks / 7
-        conversions_per_day = total_conversions / 7
-        earnings_per_day = earnings / 7
-        
-        # Create simple trend arrays with minimal variation
-        def create_simple_trend(daily_value):
-            if daily_value == 0:
-                return [0, 0, 0, 0, 0, 0, 0]
-            # Create a simple trend with small variations (±20%)
-            return [max(0, int(daily_value * (0.8 + (i % 3) * 0.2))) for i in range(7)]
-        
-        trends = {
-            'clicks': {
-                'data': create_simple_trend(clicks_per_day),
-                'period': 'Last 7 days',
-                'change': 0 if total_clicks == 0 else 5.0,  # Small positive change for users with activity
-                'changeType': 'positive' if total_clicks > 0 else 'neutral'
-            },
-            'conversions': {
-                'data': create_simple_trend(conversions_per_day),
-                'period': 'Last 7 days',
-                'change': 0 if total_conversions == 0 else 3.0,
-                'changeType': 'positive' if total_conversions > 0 else 'neutral'
-            },
-            'earnings': {
-                'data': create_simple_trend(earnings_per_day),
-                'period': 'Last 7 days',
-                'change': 0 if earnings == 0 else 8.0,
-                'changeType': 'positive' if earnings > 0 else 'neutral'
-            },
-            'conversionRate': {
-                'data': [int(conversion_rate)] * 7,  # Keep conversion rate constant
-                'period': 'Last 7 days',
-                'change': 0 if conversion_rate == 0 else 2.0,
-                'changeType': 'positive' if conversion_rate > 0 else 'neutral'
-            }
-        }
+    previous, current = slice(0, TREND_DAYS), slice(TREND_DAYS, None)
+    
+    trends = {
+        'clicks': trend_series(clicks[current], sum(clicks[current]), sum(clicks[previous])),
+        'conversions': trend_series(conversions[current], sum(conversions[current]), sum(conversions[previous])),
+        'earnings': trend_series(earnings[current], sum(earnings[current]), sum(earnings[previous])),
+        'conversionRate': trend_series(
+            conversion_rates[current],
+            weekly_rate(clicks[current], conversions[current]),
+            weekly_rate(clicks[previous], conversions[previous])
+        )
+    }
     
     return jsonify(trends), 200
 
-@app.route('/api/analytics/admin-trends', methods=['GET'])
+@api.route('/api/analytics/admin-trends', methods=['GET'])
 def get_admin_analytics_trends():
     if 'user_id' not in session or not session.get('is_admin'):
         return jsonify({'error': 'Admin access required'}), 403
     
-    # Get real data from database
-    total_users = User.query.count()
-    total_referrals = ReferralLink.query.count()
-    total_clicks = sum(link.clicks for link in ReferralLink.query.all())
-    total_revenue = total_clicks * 10  # Example revenue calculation
+    refresh_activity_rollups_if_due()
+    
+    # Program-wide totals, cached for KPI_CACHE_TTL seconds per worker
+    totals = kpi_cache.get()
+    total_users = totals['users']
     
     # Calculate engagement rate (users with at least one referral link)
-    active_users = User.query.join(ReferralLink).distinct().count()
-    engagement_rate = (active_users / total_users * 100) if total_users > 0 else 0
-    
-    # If there's no activity, return zero trends
-    if total_clicks == 0 and total_referrals == 0:
-        trends = {
-            'revenue': {
-                'data': [0, 0, 0, 0, 0, 0, 0],
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            },
-            'users': {
-                'data': [total_users] * 7,  # User count stays constant
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            },
-            'referrals': {
-                'data': [0, 0, 0, 0, 0, 0, 0],
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            },
-            'engagement': {
-                'data': [int(engagement_rate)] * 7,
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            }
+    engagement_rate = (totals['engagedUsers'] / total_users * 100) if total_users > 0 else 0
+    
+    clicks, _ = daily_activity(TREND_DAYS * 2)
+    revenue = [count * REVENUE_PER_CLICK for count in clicks]
+    new_users = daily_counts(User.created_at, TREND_DAYS * 2)
+    new_links = daily_counts(ReferralLink.created_at, TREND_DAYS * 2)
+    
+    # Users registered at the end of each day, counting back from today's total
+    users = []
+    remaining = total_users
+    for joined in reversed(new_users):
+        users.append(remaining)
+        remaining -= joined
+    users.reverse()
+    
+    previous, current = slice(0, TREND_DAYS), slice(TREND_DAYS, None)
+    
+    trends = {
+        'revenue': trend_series(revenue[current], sum(revenue[current]), sum(revenue[previous])),
+        'users': trend_series(users[current], users[-1], users[TREND_DAYS - 1]),
+        'referrals': trend_series(new_links[current], sum(new_links[current]), sum(new_links[previous])),
+        'engagement': {
+            'data': [int(engagement_rate)] * TREND_DAYS,  # No engagement history is kept
+            'period': 'Last 7 days',
+            'change': 0,
+            'changeType': 'neutral'
+        },
+        'totals': totals
+    }
+    
+    return jsonify(trends), 200
+
+@api.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and apply pending schema migrations."""
+    db.create_all()
+    migrations.upgrade(db.engine, echo=click.echo)
+    click.echo('Database schema is up to date')
+
+@api.cli.command('create-admin')
+@click.option('--username', default=lambda: current_app.config['ADMIN_USERNAME'], show_default='ADMIN_USERNAME')
+@click.option('--email', default=lambda: current_app.config['ADMIN_EMAIL'], show_default='ADMIN_EMAIL')
+@click.option('--password', default=lambda: current_app.config['ADMIN_PASSWORD'], show_default='ADMIN_PASSWORD')
+def create_admin_command(username, email, password):
+    """Create the admin user unless that username or email is taken."""
+    existing = User.query.filter(or_(User.username == username, User.email == email)).first()
+    if existing:
+        click.echo(f"Admin user already exists: {existing.username} <{existing.email}>")
+        return
+    
+    password_hash = password_hasher.hash(password)
+    try:
+        _, admin = insert_with_unique_code(
+            User.__table__, 'referral_code', 'referral',
+            {'username': username, 'email': email, 'password_hash': password_hash, 'is_admin': True},
+            returning=[User.id]
+        )
+        db.session.add(UserStats(user_id=admin.id))
+        score_histogram.enter([{}])
+        db.session.commit()
+    except IntegrityError:
+        # Another bootstrap created it first
+        db.session.rollback()
+        click.echo('Admin user already exists')
+        return
+    click.echo(f"Admin user {username} created")
+
+@api.cli.command('bootstrap')
+@click.pass_context
+def bootstrap_command(ctx):
+    """One-time setup before workers start: init-db, then create-admin."""
+    ctx.invoke(init_db_command)
+    ctx.invoke(create_admin_command)
+
+@api.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations."""
+    applied = migrations.upgrade(db.engine, echo=click.echo)
+    if not applied:
+        click.echo('Database schema is up to date')
+
+@api.cli.command('db-status')
+def db_status_command():
+    """List schema migrations and whether they have been applied."""
+    applied = migrations.applied_versions(db.engine)
+    for version, description, _ in migrations.MIGRATIONS:
+        click.echo(f"{'x' if version in applied else ' '} {version:>3}  {description}")
+
+@api.cli.command('rebuild-user-stats')
+@click.option('--check', is_flag=True, help='Only report drift, do not rewrite summaries.')
+def rebuild_user_stats_command(check):
+    """Recompute per-user summaries from scratch and verify them."""
+    def drifted():
+        columns = [getattr(UserStats, field) for field in USER_STATS_FIELDS]
+        stored = {
+            user_id: dict(zip(USER_STATS_FIELDS, values))
+            for user_id, *values in db.session.execute(select(UserStats.user_id, *columns))
         }
-    else:
-        # For systems with activity, create simple trend data
-        revenue_per_day = total_revenue / 7
-        referrals_per_day = total_referrals / 7
-        
-        def create_simple_trend(daily_value):
-            if daily_value == 0:
-                return [0, 0, 0, 0, 0, 0, 0]
-            # Create a simple trend with small variations
-            return [max(0, int(daily_value * (0.9 + (i % 2) * 0.2))) for i in range(7)]
-        
-        trends = {
-            'revenue': {
-                'data': create_simple_trend(revenue_per_day),
-                'period': 'Last 7 days',
-                'change': 0 if total_revenue == 0 else 5.0,
-                'changeType': 'positive' if total_revenue > 0 else 'neutral'
-            },
-            'users': {
-                'data': [total_users] * 7,  # User count stays constant
-                'period': 'Last 7 days',
-                'change': 0,
-                'changeType': 'neutral'
-            },
-            'referrals': {
-                'data': create_simple_trend(referrals_per_day),
-                'period': 'Last 7 days',
-                'change': 0 if total_referrals == 0 else 8.0,
-                'changeType': 'positive' if total_referrals > 0 else 'neutral'
-            },
-            'engagement': {
-                'data': [int(engagement_rate)] * 7,
-                'period': 'Last 7 days',
-                'change': 0 if engagement_rate == 0 else 2.0,
-                'changeType': 'positive' if engagement_rate > 0 else 'neutral'
-            }
+        return [user_id for user_id, values in expected.items() if stored.get(user_id) != values]
+    
+    if check:
+        expected = compute_user_stats()
+        mismatched = drifted()
+        click.echo(f"{len(mismatched)} of {len(expected)} user summaries out of date")
+        if mismatched:
+            raise SystemExit(1)
+        return
+    
+    # Recounted and rewritten by one statement, so the summaries are never
+    # rebuilt from totals a concurrent click has since moved: PostgreSQL holds
+    # off counter writes until the commit (reads carry on), and on SQLite the
+    # statement holds the write lock. Versions carry on past their old values,
+    # so no ETag handed out before the rebuild can match a rebuilt summary
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('LOCK TABLE user_stats IN EXCLUSIVE MODE'))
+    statement = dialect_insert(UserStats.__table__).from_select(
+        ['user_id', *USER_STATS_FIELDS, 'version'], user_stats_rows().add_columns(literal(1))
+    )
+    rebuilt = db.session.execute(statement.on_conflict_do_update(
+        index_elements=['user_id'],
+        set_={
+            **{field: getattr(statement.excluded, field) for field in USER_STATS_FIELDS},
+            'version': UserStats.version + 1
         }
+    )).rowcount
+    db.session.execute(delete(UserStats).where(UserStats.user_id.not_in(select(User.id))))
+    score_histogram.rebuild()
+    # Verified before the commit: afterwards live traffic moves the totals
+    expected = compute_user_stats()
+    mismatched = drifted()
+    db.session.commit()
     
-    return jsonify(trends), 200
+    click.echo(f"Rebuilt {rebuilt} user summaries, {len(mismatched)} inconsistent")
+    if mismatched:
+        raise SystemExit(1)
+
+@api.cli.command('export')
+@click.argument('dataset', type=click.Choice(EXPORT_DATASETS))
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--start', help='Only rows at or after this ISO date/time.')
+@click.option('--end', help='Only rows before this ISO date/time.')
+@click.option('--link-id', 'link_ids', type=int, multiple=True, help='Restrict clicks/links to these link ids.')
+@click.option('--output', type=click.File('wb'), default='-', help='File to write (default: stdout).')
+def export_command(dataset, fmt, start, end, link_ids, output):
+    """Stream clicks, links or the referral graph as CSV or NDJSON."""
+    try:
+        columns, statement = export_statement(
+            dataset, start=parse_export_time(start), end=parse_export_time(end), link_ids=link_ids
+        )
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    
+    for chunk in stream_export(columns, statement, fmt):
+        output.write(chunk)
+
+@api.cli.command('import')
+@click.argument('dataset', type=click.Choice(IMPORT_DATASETS))
+@click.argument('source', metavar='FILE', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Input format (default: from the file extension).')
+@click.option('--errors', type=click.File('w'), help='Write every rejected row to this file as NDJSON {"row", "error"}.')
+def import_command(dataset, source, fmt, errors):
+    """Bulk-load users, conversions or historical clicks from CSV or NDJSON."""
+    if fmt is None:
+        extension = os.path.splitext(source.name)[1].lstrip('.').lower()
+        fmt = 'ndjson' if extension == 'jsonl' else extension
+        if fmt not in ('csv', 'ndjson'):
+            raise click.UsageError('Cannot tell the format from the file name; pass --format')
+    
+    def on_error(number, message):
+        if errors:
+            errors.write(json.dumps({'row': number, 'error': message}) + '\n')
+    
+    started = time.perf_counter()
+    report = import_rows(dataset, decode_rows(source, fmt), on_error=on_error)
+    elapsed = time.perf_counter() - started
+    
+    if not errors:
+        for error in report['errors'][:20]:
+            click.echo(f"  row {error['row']}: {error['error']}", err=True)
+    click.echo(
+        f"Imported {report['inserted']} of {report['received']} {dataset} rows in {elapsed:.1f}s "
+        f"({report['received'] / max(elapsed, 1e-9):,.0f} rows/sec), {report['error_count']} rejected"
+    )
+    if report['error_count']:
+        raise SystemExit(1)
+
+@api.cli.command('rebuild-leaderboard')
+@click.option('--check', is_flag=True, help='Only report whether the overall boards match the user summaries.')
+def rebuild_leaderboard_command(check):
+    """Recount the overall leaderboards from the user summaries and rebuild the windowed ones."""
+    if check:
+        drifted = score_histogram.drift()
+        click.echo(f"{len(drifted)} leaderboard score buckets out of date")
+        if drifted:
+            raise SystemExit(1)
+        return
+    
+    started = time.perf_counter()
+    score_histogram.rebuild()
+    db.session.commit()
+    click.echo(f"Recounted the overall boards in {time.perf_counter() - started:.1f}s")
+    
+    # Windowed boards rank the daily rollups, so bring those up to date first
+    refresh_activity_rollups()
+    for window, days in LEADERBOARD_WINDOWS.items():
+        if days is None:
+            continue
+        for board in LEADERBOARD_BOARDS:
+            started = time.perf_counter()
+            ranked = build_window_board(board, days)
+            click.echo(f"Ranked {ranked} users on the {window} {board} board in {time.perf_counter() - started:.1f}s")
+
+@api.cli.command('rollup-activity')
+def rollup_activity_command():
+    """Fold clicks and conversions recorded since the last run into the rollups."""
+    covered = refresh_activity_rollups()
+    click.echo(f"Rolled up {covered} new click/conversion ids")
+
+@api.cli.command('compact-clicks')
+@click.option('--days', type=int, help='Retention window (default: CLICK_RETENTION_DAYS).')
+@click.option('--no-archive', is_flag=True, help='Delete without writing an archive file.')
+@click.option('--full-vacuum', is_flag=True, help='If the database is not in incremental auto-vacuum mode, VACUUM it once (exclusive lock).')
+def compact_clicks_command(days, no_archive, full_vacuum):
+    """Archive and delete raw clicks older than the retention window."""
+    cutoff = retention_cutoff(days if days is not None else current_app.config['CLICK_RETENTION_DAYS'])
+    report = compact_clicks(cutoff, None if no_archive else current_app.config['CLICK_ARCHIVE_DIR'], echo=click.echo)
+    click.echo(
+        f"Deleted {report['deleted']} clicks before {cutoff:%Y-%m-%d} in {report['batches']} batches "
+        f"(longest {report['longest_batch'] * 1000:.0f} ms), "
+        f"dropped {report.get('hourly_rollups_pruned', 0)} hourly rollups"
+    )
+    if report['archive'] and report['archived'] != report['deleted']:
+        click.echo(f"Warning: archived {report['archived']} rows but deleted {report['deleted']}")
+    
+    if db.engine.dialect.name != 'sqlite':
+        click.echo('Space is reclaimed by the database\'s own (auto)vacuum')
+        return
+    before, after = reclaim_free_pages(db.engine, full=full_vacuum)
+    click.echo(f"Database {before['size']} -> {after['size']} bytes, reclaimed {before['size'] - after['size']}")
+    if after['free']:
+        click.echo(
+            f"{after['free']} bytes are free inside the file but auto_vacuum is {after['auto_vacuum']}; "
+            f"run once with --full-vacuum to hand them back"
+        )
+
+@api.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    """Rebuild the activity rollups from the click and conversion history."""
+    # Days whose raw clicks were compacted away keep their rollups; everything
+    # from the oldest remaining click onwards is rebuilt
+    oldest = db.session.query(func.min(ReferralClick.clicked_at)).scalar()
+    since = oldest.replace(hour=0, minute=0, second=0, microsecond=0) if oldest else None
+    if since is not None:
+        ActivityRollup.query.filter(ActivityRollup.bucket_start >= since).delete()
+    else:
+        ActivityRollup.query.delete()
+    RollupWatermark.query.delete()
+    db.session.commit()
+    
+    started = time.perf_counter()
+    covered = refresh_activity_rollups(since=since)
+    click.echo(f"Backfilled {covered} click/conversion ids in {time.perf_counter() - started:.1f}s")
+
+@api.cli.command('create-links')
+@click.argument('username')
+@click.option('--count', type=int, default=100, show_default=True, help='Links to create.')
+@click.option('--output', type=click.File('w'), default='-', help='File to write the new codes to (default: stdout).')
+def create_links_command(username, count, output):
+    """Pre-generate a batch of active referral links for a user, e.g. for a printed campaign."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.UsageError(f'No user named {username}')
+    
+    created = insert_many_with_unique_codes(
+        ReferralLink.__table__, 'link_code', 'link',
+        [{'user_id': user.id, 'clicks': 0, 'conversions': 0, 'is_active': True}] * count,
+        returning=[ReferralLink.id]
+    )
+    bump_user_stats(user.id, links_count=count, active_links_count=count)
+    db.session.commit()
+    
+    for link_code, _ in created:
+        link_cache.invalidate(link_code)
+        output.write(f"https://lacasacowork.com/referral/{link_code}\n")
+    click.echo(f"Created {count} links for {username}", err=True)
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,232 @@
+"""
+Async serving mode for the public referral click and conversion endpoints
+and the live event streams.
+
+The gunicorn deployment gives each request a thread for its whole life, so
+the number of connections a server can hold is workers x threads, and a slow
+or idle client keeps its thread. This ASGI application serves only
+
+    GET  /api/referral/<link_code>
+    POST /api/referral/<link_code>/convert
+
+on an asyncio event loop, which holds thousands of open connections per
+process for the cost of a coroutine each. Everything that can touch the
+database (link lookup on a cache miss, click/conversion writes, User-Agent
+interning) runs through app.track_click() / app.track_conversion(), the same
+code the Flask routes use, on a pool of ASYNC_DB_THREADS threads per
+process. The loop never waits on the database, and at most that many
+database operations run at once per process; keep it within the connection
+pool (DB_POOL_SIZE + DB_MAX_OVERFLOW, 15 by default).
+
+It also serves the server-sent event streams
+
+    GET  /api/events          (logged-in user)
+    GET  /api/admin/events    (admins)
+
+which stay open for as long as the client listens, up to EVENTS_MAX_STREAMS
+per process (see live_events.py). The Flask session cookie is checked with
+the app's own serializer. Writes to a client that stops reading block only
+that stream; after EVENTS_SEND_TIMEOUT seconds it is dropped.
+
+Any other path answers 404: the proxy routes /api/referral/ and the event
+paths here and the rest of /api to gunicorn (see docker-compose.async.yml). Per-request
+Prometheus metrics are only recorded by the Flask app; the click outcome
+counters in /api/admin/cache-stats are per process as before.
+
+Run with:  uvicorn asgi:application --host 0.0.0.0 --port 5001 --workers 2 --timeout-graceful-shutdown 5 --no-proxy-headers
+(open streams never finish on their own, so shutdown has to cut them off).
+Click dedup keys on the client address, which behind a proxy is taken from
+X-Forwarded-For with the Flask app's rule: TRUSTED_PROXY_HOPS entries from
+the right. uvicorn's own --proxy-headers is left off (--no-proxy-headers):
+with --forwarded-allow-ips "*" it takes the leftmost entry, which the
+client writes.
+"""
+
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+
+from app import CORS_ORIGINS, app, click_buffer, live_events, track_click, track_conversion
+from live_events import RETRY_AFTER, STREAM_HEADERS, TooManyStreams
+
+CLICK_PATH = re.compile(r'/api/referral/([^/]+)')
+CONVERT_PATH = re.compile(r'/api/referral/([^/]+)/convert')
+# Path -> whether the stream is the admin firehose
+EVENT_PATHS = {'/api/events': False, '/api/admin/events': True}
+
+# Flask-CORS's default for preflight requests
+ALLOWED_METHODS = b'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'
+
+
+class ClickService:
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=flask_app.config['ASYNC_DB_THREADS'], thread_name_prefix='click-db'
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Let in-flight writes finish, then write out buffered clicks
+                # here: uvicorn's worker processes end with os._exit(), which
+                # skips the buffer's atexit hook
+                self.executor.shutdown(wait=True)
+                try:
+                    click_buffer.flush()
+                except Exception:
+                    self.app.logger.exception('Flushing buffered clicks failed; the next worker replays them from the spill files')
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        headers = dict(scope['headers'])
+        origin = headers.get(b'origin')
+        method = scope['method']
+        path = scope['path']
+
+        if path in EVENT_PATHS:
+            if method == 'OPTIONS':
+                return await self._preflight(send, origin, headers.get(b'access-control-request-headers'))
+            if method != 'GET':
+                return await self._respond(send, 405, {'error': 'Method not allowed'}, origin)
+            return await self._events(receive, send, EVENT_PATHS[path], self._session(headers), origin)
+
+        click = CLICK_PATH.fullmatch(path)
+        convert = CONVERT_PATH.fullmatch(path)
+        if not click and not convert:
+            return await self._respond(send, 404, {'error': 'Not found'}, origin)
+        if method == 'OPTIONS':
+            return await self._preflight(send, origin, headers.get(b'access-control-request-headers'))
+        if click and method not in ('GET', 'HEAD') or convert and method != 'POST':
+            return await self._respond(send, 405, {'error': 'Method not allowed'}, origin)
+
+        if click:
+            user_agent = headers.get(b'user-agent')
+            call = (
+                track_click, click.group(1), self._client_address(scope, headers),
+                user_agent.decode('latin-1') if user_agent is not None else None
+            )
+        else:
+            call = (track_conversion, convert.group(1))
+
+        try:
+            body, status = await asyncio.get_running_loop().run_in_executor(self.executor, self._in_app_context, *call)
+        except Exception:
+            self.app.logger.exception('%s %s failed', method, path)
+            body, status = {'error': 'Internal server error'}, 500
+        await self._respond(send, status, body, origin, include_body=method != 'HEAD')
+
+    async def _events(self, receive, send, firehose, session, origin):
+        if firehose and ('user_id' not in session or not session.get('is_admin')):
+            return await self._respond(send, 403, {'error': 'Admin access required'}, origin)
+        if 'user_id' not in session:
+            return await self._respond(send, 401, {'error': 'Not authenticated'}, origin)
+        try:
+            subscription = live_events.subscribe(
+                None if firehose else session['user_id'], self.app.config['EVENTS_MAX_STREAMS']
+            )
+        except TooManyStreams:
+            return await self._respond(
+                send, 503, {'error': 'Too many live streams open, please retry shortly'}, origin,
+                extra_headers=[(b'retry-after', str(RETRY_AFTER).encode('ascii'))]
+            )
+
+        headers = [(b'content-type', b'text/event-stream')] + [
+            (name.lower().encode('ascii'), value.encode('ascii')) for name, value in STREAM_HEADERS.items()
+        ] + self._cors_headers(origin)
+        # uvicorn's send() returns quietly once the client is gone, so the
+        # stream ends on the disconnect message instead
+        watcher = asyncio.create_task(self._close_on_disconnect(receive, subscription))
+        timeout = self.app.config['EVENTS_SEND_TIMEOUT']
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            async for frame in subscription.async_frames():
+                # send() waits while the connection's write buffer is full
+                await asyncio.wait_for(send({'type': 'http.response.body', 'body': frame, 'more_body': True}), timeout)
+        except asyncio.TimeoutError:
+            self.app.logger.warning('Dropping an event stream that stopped reading for %ss', timeout)
+        finally:
+            watcher.cancel()
+            subscription.close()
+
+    @staticmethod
+    async def _close_on_disconnect(receive, subscription):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        subscription.close()
+
+    def _client_address(self, scope, headers):
+        # Same rule as ProxyFix in the Flask app: with TRUSTED_PROXY_HOPS
+        # proxies in front, the client is that many entries from the right of
+        # X-Forwarded-For; with fewer entries the peer address stands
+        client = scope.get('client')
+        hops = self.app.config['TRUSTED_PROXY_HOPS']
+        forwarded = headers.get(b'x-forwarded-for')
+        if hops and forwarded:
+            hosts = [host.strip() for host in forwarded.decode('latin-1').split(',')]
+            if len(hosts) >= hops:
+                return hosts[-hops]
+        return client[0] if client else None
+
+    def _session(self, headers):
+        # The Flask session, read without a request context; {} if absent or tampered with
+        cookie = parse_cookie(headers.get(b'cookie', b'').decode('latin-1')).get(self.app.config['SESSION_COOKIE_NAME'])
+        if not cookie:
+            return {}
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        try:
+            return serializer.loads(cookie, max_age=int(self.app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return {}
+
+    def _in_app_context(self, view, *args):
+        # Runs on an executor thread; the context's teardown returns the session's connection
+        with self.app.app_context():
+            return view(*args)
+
+    @staticmethod
+    def _cors_headers(origin):
+        if origin is None or origin.decode('latin-1') not in CORS_ORIGINS:
+            return []
+        return [
+            (b'access-control-allow-origin', origin),
+            (b'access-control-allow-credentials', b'true'),
+            (b'vary', b'Origin'),
+        ]
+
+    async def _preflight(self, send, origin, requested_headers):
+        headers = self._cors_headers(origin)
+        if headers:
+            headers.append((b'access-control-allow-methods', ALLOWED_METHODS))
+            if requested_headers:
+                headers.append((b'access-control-allow-headers', requested_headers))
+        headers.append((b'content-length', b'0'))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _respond(self, send, status, body, origin, include_body=True, extra_headers=()):
+        # Same bytes as Flask's jsonify outside debug mode
+        payload = json.dumps(body, separators=(',', ':'), sort_keys=True).encode('utf-8') + b'\n'
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode('ascii')),
+        ] + list(extra_headers) + self._cors_headers(origin)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': payload if include_body else b''})
+
+
+application = ClickService(app)
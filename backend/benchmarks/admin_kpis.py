@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Global admin KPIs on a large link table
+
+Compares the old per-request approach (hydrate every ReferralLink and count
+engaged users through a join) with the aggregate queries behind KpiCache,
+then hammers /api/analytics/admin-trends from several threads with a cold
+cache and reports latency and how many times the KPIs were actually computed.
+
+Usage: python benchmarks/admin_kpis.py [--links 1000000] [--users 100000] [--threads 16]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+CHUNK = 50000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--links', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=10, help='requests per thread')
+    args = parser.parse_args()
+
+    use_scratch_database('kpi-bench-')
+
+    from app import app, db, User, ReferralLink, compute_global_kpis, kpi_cache
+    bootstrap(app)
+
+    rng = random.Random(3)
+    now = datetime.utcnow()
+    # Two years of history, so the 14-day trend windows hold a realistic slice
+    created = lambda: now - timedelta(seconds=rng.randrange(2 * 365 * 86400))
+    started = time.perf_counter()
+    with app.app_context():
+        for offset in range(0, args.users, CHUNK):
+            db.session.execute(User.__table__.insert(), [
+                {'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': 'x',
+                 'referral_code': f'code{n}', 'created_at': created()}
+                for n in range(offset, min(offset + CHUNK, args.users))
+            ])
+        # Links go to the first half of the users so engagement is not 100%
+        for offset in range(0, args.links, CHUNK):
+            db.session.execute(ReferralLink.__table__.insert(), [
+                {'user_id': 2 + rng.randrange(args.users // 2), 'link_code': f'l{n}',
+                 'clicks': rng.randrange(100), 'conversions': rng.randrange(5), 'is_active': True,
+                 'created_at': created()}
+                for n in range(offset, min(offset + CHUNK, args.links))
+            ])
+        db.session.commit()
+    print(f"Seeded {args.users:,} users and {args.links:,} links in {time.perf_counter() - started:.1f}s")
+
+    def legacy():
+        total_clicks = sum(link.clicks for link in ReferralLink.query.all())
+        return User.query.count(), User.query.join(ReferralLink).distinct().count(), total_clicks
+
+    with app.app_context():
+        for name, compute in (('hydrate + join', legacy), ('aggregate SQL', compute_global_kpis)):
+            started = time.perf_counter()
+            compute()
+            db.session.remove()
+            print(f"  {name:<15} {(time.perf_counter() - started) * 1000:9.1f} ms")
+
+    def admin_client():
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = 1
+            session['is_admin'] = True
+        return client
+
+    def refresh(_):
+        client = admin_client()
+        samples = []
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            response = client.get('/api/analytics/admin-trends')
+            samples.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.get_data(as_text=True)
+        return samples
+
+    kpi_cache.invalidate()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        latencies = sorted(sample for samples in pool.map(refresh, range(args.threads)) for sample in samples)
+    stats = kpi_cache.stats()
+    print(f"{args.threads} threads x {args.requests} admin-trends requests from a cold cache:")
+    print(f"  p50 {statistics.median(latencies):7.1f} ms  p99 {latencies[int(0.99 * (len(latencies) - 1))]:7.1f} ms  "
+          f"KPI computations: {stats['computations']}")
+
+
+if __name__ == '__main__':
+    main()
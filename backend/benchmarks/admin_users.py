@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+/api/admin/users response times on a large user table
+
+Usage: python benchmarks/admin_users.py [--users 100000 1000000] [--repeat 20]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap
+
+CHUNK = 50000
+
+
+def seed_users(db, User, count, rng):
+    for offset in range(0, count, CHUNK):
+        db.session.execute(User.__table__.insert(), [
+            {
+                'username': f'user{n:07d}', 'email': f'user{n:07d}@example.com', 'password_hash': 'x',
+                'referral_code': f'code{n}', 'referred_by': rng.randrange(1, n + 1) if n and rng.random() < 0.7 else None
+            }
+            for n in range(offset, min(offset + CHUNK, count))
+        ])
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    from app import create_app, db, User
+
+    for count in args.users:
+        # Fresh app per size so each run gets its own database
+        workdir = tempfile.mkdtemp(prefix='admin-users-bench-')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}"})
+        bootstrap(app)
+
+        with app.app_context():
+            seed_users(db, User, count, random.Random(7))
+
+        client = app.test_client()
+        client.post('/api/login', json={'username': 'admin', 'password': 'admin123'})
+
+        def timed(path, **params):
+            samples = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                response = client.get(path, query_string=params)
+                samples.append((time.perf_counter() - started) * 1000)
+                assert response.status_code == 200, response.get_data(as_text=True)
+            return statistics.median(samples), response
+
+        _, page = timed('/api/admin/users', limit=100)
+        deep_cursor = page.headers['X-Next-Cursor']
+        for _ in range(50):
+            deep_cursor = client.get('/api/admin/users', query_string={'limit': 100, 'cursor': deep_cursor}).headers['X-Next-Cursor']
+
+        print(f"{count:,} users (median of {args.repeat})")
+        for label, params in (
+            ('first page', {'limit': 100}),
+            ('page 52 via cursor', {'limit': 100, 'cursor': deep_cursor}),
+            ('sort -username', {'limit': 100, 'sort': '-username'}),
+            ('search prefix', {'limit': 100, 'q': 'user00012'}),
+        ):
+            median, _ = timed('/api/admin/users', **params)
+            print(f"  {label:<20} {median:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
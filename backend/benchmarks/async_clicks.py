@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Click path under many concurrent connections: the production gunicorn
+deployment (gthread) against the async click service (asgi.py on uvicorn)
+
+Both servers run against the same scratch database with every click recorded
+(no dedup, no bot filter). An asyncio client keeps N keep-alive connections
+busy for --seconds at each --connections level, every connection sending
+GET /api/referral/<code> back to back, and reports clicks/sec, p50/p99
+latency and failed requests. "Max sustained" is the best throughput among
+levels with under 1% failures and p99 within --slo-ms.
+
+A second run holds --slow-clients connections that send a request line and
+then trickle one header per second without ever finishing, the way slow
+mobile clients and slowloris attacks do, while 64 normal connections click.
+
+With --click-buffer both servers write clicks through the write-behind
+buffer (CLICK_BUFFER_ENABLED) instead of one transaction per click. At the
+end every acknowledged click must be in the database (clicks the client gave
+up on after --timeout may be recorded too).
+
+Usage: python benchmarks/async_clicks.py [--connections 64,256,1024,4096] [--seconds 10] [--slow-clients 256] [--click-buffer]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, record_every_click, use_scratch_database
+
+BROWSER = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def clicker(port, codes, deadline, timeout, latencies, failures, rng):
+    # One keep-alive connection sending clicks until the deadline; reconnects after errors
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(
+                f'GET /api/referral/{rng.choice(codes)} HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                f'User-Agent: {BROWSER}\r\n\r\n'.encode('latin-1')
+            )
+            status = await asyncio.wait_for(read_response(reader), timeout=timeout)
+            if status == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failures.append(status)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError) as error:
+            failures.append(type(error).__name__)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+
+async def slow_client(port, stop):
+    # Starts a request and never finishes its headers
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /api/referral/slow HTTP/1.1\r\nHost: 127.0.0.1\r\n')
+        while not stop.is_set():
+            await asyncio.sleep(1)
+            writer.write(b'X-Slow: 1\r\n')
+            await writer.drain()
+        writer.close()
+    except OSError:
+        pass
+
+
+async def load(port, codes, connections, seconds, timeout, slow_clients=0):
+    stop = asyncio.Event()
+    slow = [asyncio.create_task(slow_client(port, stop)) for _ in range(slow_clients)]
+    if slow:
+        await asyncio.sleep(2)
+    latencies, failures = [], []
+    rng = random.Random(connections)
+    started = time.perf_counter()
+    deadline = started + seconds
+    await asyncio.gather(*(clicker(port, codes, deadline, timeout, latencies, failures, rng) for _ in range(connections)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*slow, return_exceptions=True)
+    total = len(latencies) + len(failures)
+    return {
+        'throughput': len(latencies) / elapsed,
+        'p50': statistics.median(latencies) * 1000 if latencies else float('inf'),
+        'p99': percentile(latencies, 0.99) * 1000 if latencies else float('inf'),
+        'failed': len(failures) / total if total else 1.0,
+        'acknowledged': len(latencies),
+    }
+
+
+def wait_until_up(port):
+    for _ in range(300):
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on port {port} did not come up')
+
+
+def run_server(name, command, port, codes, args):
+    server = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    best = 0
+    acknowledged = 0
+    try:
+        wait_until_up(port)
+        acknowledged += asyncio.run(load(port, codes, 16, 2, args.timeout))['acknowledged']  # warm caches and connection pools
+        for connections in args.connections:
+            result = asyncio.run(load(port, codes, connections, args.seconds, args.timeout))
+            acknowledged += result['acknowledged']
+            print(f"  {name:<6} {connections:>5} connections  {result['throughput']:8.0f} clicks/sec  "
+                  f"p50 {result['p50']:8.1f}  p99 {result['p99']:8.1f} ms  failed {result['failed']:6.1%}")
+            if result['failed'] < 0.01 and result['p99'] <= args.slo_ms:
+                best = max(best, result['throughput'])
+        if args.slow_clients:
+            result = asyncio.run(load(port, codes, 64, args.seconds, args.timeout, slow_clients=args.slow_clients))
+            acknowledged += result['acknowledged']
+            print(f"  {name:<6} 64 + {args.slow_clients} slow  {result['throughput']:8.0f} clicks/sec  "
+                  f"p50 {result['p50']:8.1f}  p99 {result['p99']:8.1f} ms  failed {result['failed']:6.1%}")
+    finally:
+        # Graceful shutdown flushes buffered clicks
+        server.terminate()
+        server.wait()
+    print(f"  {name:<6} max sustained {best:,.0f} clicks/sec (p99 <= {args.slo_ms:.0f} ms, < 1% failed)")
+    return acknowledged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--links', type=int, default=1000)
+    parser.add_argument('--connections', default='64,256,1024,4096',
+                        type=lambda value: [int(part) for part in value.split(',')])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--slow-clients', type=int, default=256)
+    parser.add_argument('--slo-ms', type=float, default=1000)
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a click counts as failed')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers (as in the Dockerfile)')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker (as in the Dockerfile)')
+    parser.add_argument('--async-workers', type=int, default=2, help='uvicorn worker processes')
+    parser.add_argument('--click-buffer', action='store_true', help='write clicks through the write-behind buffer')
+    args = parser.parse_args()
+
+    workdir = use_scratch_database('async-clicks-bench-')
+    record_every_click()
+    os.environ['CLICK_BUFFER_ENABLED'] = 'true' if args.click_buffer else 'false'
+    os.environ['CLICK_BUFFER_SPILL_DIR'] = os.path.join(workdir, 'click-spill')
+
+    from app import app, db, User, ReferralLink
+    bootstrap(app)
+
+    with app.app_context():
+        owner_id = db.session.query(User.id).scalar()
+        codes = [f'click{n}' for n in range(args.links)]
+        db.session.execute(ReferralLink.__table__.insert(), [
+            {'user_id': owner_id, 'link_code': code, 'clicks': 0, 'conversions': 0, 'is_active': True} for code in codes
+        ])
+        db.session.commit()
+
+    print(f"{args.links:,} links, {args.seconds:.0f}s per level, click buffer {'on' if args.click_buffer else 'off'}, "
+          f"{os.cpu_count()} CPUs shared by servers and client")
+    port = free_port()
+    acknowledged = run_server('sync', [
+        sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers),
+        '--worker-class', 'gthread', '--threads', str(args.threads), '--timeout', '120', 'app:app'
+    ], port, codes, args)
+    port = free_port()
+    acknowledged += run_server('async', [
+        sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', str(port),
+        '--workers', str(args.async_workers), '--no-access-log', '--log-level', 'warning', '--backlog', '4096'
+    ], port, codes, args)
+
+    with app.app_context():
+        recorded = db.session.query(db.func.sum(ReferralLink.clicks)).scalar()
+    print(f"Clicks recorded in the database: {recorded:,}, acknowledged: {acknowledged:,}")
+    sys.exit(0 if recorded >= acknowledged else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Bulk import throughput: loading --users registrations, then --events
+conversions and historical clicks, through import_rows() (the code behind
+`flask import` and POST /api/admin/import/<dataset>)
+
+Users come from an NDJSON file with stored bcrypt hashes, --referred of them
+attributed to one of --links referral links. For comparison, --register
+users first go through POST /api/register one request at a time, with
+BCRYPT_LOG_ROUNDS=4 so that endpoint is not just measuring bcrypt. Rates
+are reported per tenth of the load, to show whether they hold as the tables
+grow. At the end the per-user summaries and the leaderboard histogram must
+match a recount.
+
+Usage: python benchmarks/bulk_import.py [--users 1000000] [--events 200000] [--chunk-size 5000]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+BROWSER = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+def write_ndjson(path, rows):
+    with open(path, 'w') as output:
+        for row in rows:
+            output.write(json.dumps(row) + '\n')
+
+
+def timed(records, chunk_size, marks):
+    # Pass records through, noting the time each chunk starts being read,
+    # which is when the chunk before it has been written
+    for index, record in enumerate(records):
+        if index % chunk_size == 0:
+            marks.append(time.perf_counter())
+        yield record
+
+
+def run_import(app, dataset, path):
+    from app import import_rows
+    from imports import decode_rows
+
+    marks = []
+    with app.app_context(), open(path) as source:
+        started = time.perf_counter()
+        chunk_size = app.config['IMPORT_CHUNK_SIZE']
+        report = import_rows(dataset, timed(decode_rows(source, 'ndjson'), chunk_size, marks))
+        marks.append(time.perf_counter())
+        elapsed = marks[-1] - started
+    rates = [chunk_size / (later - earlier) for earlier, later in zip(marks, marks[1:-1])] or [report['inserted'] / elapsed]
+    tenth = max(1, len(rates) // 10)
+    print(f"  {dataset:<12} {report['inserted']:>9,} rows in {elapsed:6.1f}s  {report['inserted'] / elapsed:9,.0f} rows/sec"
+          f"  (first tenth {statistics.mean(rates[:tenth]):9,.0f}, last {statistics.mean(rates[-tenth:]):9,.0f})"
+          f"  {report['error_count']} rejected")
+    if report['error_count']:
+        print(f"    first errors: {report['errors'][:5]}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--referred', type=float, default=0.3, help='fraction of users with a referralLinkCode')
+    parser.add_argument('--links', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=200000, help='conversions and clicks imported after the users')
+    parser.add_argument('--register', type=int, default=1000, help='users registered one by one for comparison')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    workdir = use_scratch_database('bulk-import-bench-')
+    os.environ['CLICK_BUFFER_ENABLED'] = 'false'
+    os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+    os.environ['IMPORT_CHUNK_SIZE'] = str(args.chunk_size)
+
+    from app import app, db, bcrypt, User, ReferralLink, bump_user_stats, insert_many_with_unique_codes
+    bootstrap(app)
+
+    with app.app_context():
+        owner_id = db.session.query(User.id).scalar()
+        created = insert_many_with_unique_codes(
+            ReferralLink.__table__, 'link_code', 'link',
+            [{'user_id': owner_id, 'clicks': 0, 'conversions': 0, 'is_active': True}] * args.links,
+            returning=[ReferralLink.id]
+        )
+        bump_user_stats(owner_id, links_count=args.links, active_links_count=args.links)
+        db.session.commit()
+        codes = [code for code, _ in created]
+        # One hash at the production cost, stored for every imported user
+        app.config['BCRYPT_LOG_ROUNDS'] = 12
+        password_hash = bcrypt.generate_password_hash('imported-password').decode('utf-8')
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+    rng = random.Random(42)
+    print(f"{args.users:,} users ({args.referred:.0%} referred across {args.links:,} links), "
+          f"{args.events:,} conversions and clicks, chunks of {args.chunk_size:,}")
+
+    client = app.test_client()
+    started = time.perf_counter()
+    for n in range(args.register):
+        payload = {'username': f'registered{n}', 'email': f'registered{n}@example.com', 'password': 'pw'}
+        if rng.random() < args.referred:
+            payload['referralLinkCode'] = rng.choice(codes)
+        response = client.post('/api/register', json=payload)
+        assert response.status_code == 201, response.get_json()
+    if args.register:
+        elapsed = time.perf_counter() - started
+        print(f"  {'register':<12} {args.register:>9,} rows in {elapsed:6.1f}s  {args.register / elapsed:9,.0f} rows/sec"
+              f"  (POST /api/register, one request per user, bcrypt cost 4)")
+
+    users_path = os.path.join(workdir, 'users.ndjson')
+    write_ndjson(users_path, (
+        dict({'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': password_hash},
+             **({'referralLinkCode': rng.choice(codes)} if rng.random() < args.referred else {}))
+        for n in range(args.users)
+    ))
+    run_import(app, 'users', users_path)
+
+    if args.events:
+        conversions_path = os.path.join(workdir, 'conversions.ndjson')
+        write_ndjson(conversions_path, (
+            {'link_code': rng.choice(codes), 'converted_at': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00'}
+            for _ in range(args.events)
+        ))
+        run_import(app, 'conversions', conversions_path)
+
+        clicks_path = os.path.join(workdir, 'clicks.ndjson')
+        write_ndjson(clicks_path, (
+            {'link_code': rng.choice(codes), 'ip_address': f'10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}',
+             'user_agent': BROWSER, 'clicked_at': f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00'}
+            for _ in range(args.events)
+        ))
+        run_import(app, 'clicks', clicks_path)
+
+    failed = False
+    for command in ('rebuild-user-stats', 'rebuild-leaderboard'):
+        result = app.test_cli_runner().invoke(args=[command, '--check'])
+        print(f"  {result.output.strip()}")
+        failed = failed or result.exit_code != 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
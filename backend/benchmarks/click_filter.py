@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Click dedup filter and bot classifier: false-positive rate, window accuracy,
+throughput and database traffic
+
+  - False positives: every slice of a SlicedBloomFilter is loaded to its
+    capacity, then never-seen keys are probed; the measured rate should stay
+    at or below --error-rate.
+  - Window: a repeat is caught anywhere inside the window and forgotten once
+    the window (plus at most one slice) has passed.
+  - Throughput: ClickFilter.classify() on a realistic mix of new clicks,
+    repeats and bots, single-threaded and from several threads, and the bot
+    pattern on its own.
+  - Database: SQL statements issued while replaying duplicate and bot clicks
+    through /api/referral/<code> (should be zero).
+
+Usage: python benchmarks/click_filter.py [--capacity 100000] [--error-rate 0.001] [--clicks 200000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+BROWSERS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
+]
+BOTS = [
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)',
+    'Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)',
+    'WhatsApp/2.23.20.0 A',
+    'python-requests/2.31.0',
+]
+
+
+def false_positives(args):
+    from click_filter import SlicedBloomFilter
+
+    window = 3600
+    bloom = SlicedBloomFilter(window, args.capacity, args.error_rate, args.slices)
+    probes = args.capacity // 10
+    key = iter(range(10 ** 12)).__next__
+
+    # Fill every slice to capacity; the last slice's final keys are the probes
+    for slice_index in range(args.slices):
+        now = slice_index * bloom.slice_seconds
+        for _ in range(args.capacity - (probes if slice_index == args.slices - 1 else 0)):
+            bloom.add_if_absent(b'k%d' % key(), now)
+    hits = sum(bloom.add_if_absent(b'k%d' % key(), now) for _ in range(probes))
+
+    print(f"Sliced Bloom filter: {args.slices} slices x {args.capacity:,} keys, "
+          f"{bloom.hashes} hashes, {bloom.memory_bytes / 1024:,.0f} KiB")
+    print(f"  false positives at capacity {hits / probes:.5f} (target {args.error_rate})")
+    return hits / probes <= args.error_rate * 1.5
+
+
+def window_accuracy(args):
+    from click_filter import SlicedBloomFilter
+
+    window = 1800
+    bloom = SlicedBloomFilter(window, 1000, args.error_rate, args.slices)
+    rng = random.Random(7)
+    caught = forgotten = trials = 0
+    for trial in range(1000):
+        start = rng.uniform(0, 10 * window)
+        bloom.add_if_absent(b'w%d' % trial, start)
+        caught += bloom.add_if_absent(b'w%d' % trial, start + rng.uniform(0, window))
+        forgotten += not bloom.add_if_absent(b'w%d' % trial, start + window + 2 * bloom.slice_seconds)
+        trials += 1
+    print(f"  repeats inside the window caught {caught}/{trials}, "
+          f"forgotten after window + one slice {forgotten}/{trials}")
+    return caught == trials and forgotten == trials
+
+
+def throughput(args, click_filter):
+    from click_filter import is_bot
+
+    rng = random.Random(17)
+
+    def traffic(network):
+        # 5% bots, 20% repeats of an earlier click, the rest new visitors
+        clicks = []
+        for n in range(args.clicks):
+            roll = rng.random()
+            if roll < 0.05:
+                clicks.append((rng.randrange(1000), f'198.51.100.{rng.randrange(256)}', rng.choice(BOTS)))
+            elif roll < 0.25 and clicks:
+                clicks.append(rng.choice(clicks))
+            else:
+                clicks.append((rng.randrange(1000), f'{network}.{n % 256}.{n // 256 % 256}', rng.choice(BROWSERS)))
+        return clicks
+
+    clicks = traffic('203.0')
+
+    started = time.perf_counter()
+    for _, _, user_agent in clicks:
+        is_bot(user_agent)
+    print(f"  bot pattern        {len(clicks) / (time.perf_counter() - started):12,.0f} user agents/sec")
+
+    started = time.perf_counter()
+    for click in clicks:
+        click_filter.classify(*click)
+    print(f"  classify, 1 thread {len(clicks) / (time.perf_counter() - started):12,.0f} clicks/sec")
+
+    clicks = traffic('192.0')
+    chunks = [clicks[n::args.threads] for n in range(args.threads)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(lambda chunk: [click_filter.classify(*click) for click in chunk], chunks))
+    print(f"  classify, {args.threads} threads {len(clicks) / (time.perf_counter() - started):11,.0f} clicks/sec")
+    stats = click_filter.stats()
+    print(f"  outcomes: {stats['recorded']:,} recorded, {stats['duplicates']:,} duplicates, {stats['bots']:,} bots")
+
+
+def database_traffic(app, db):
+    client = app.test_client()
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *_: statements.append(1))
+
+    def replay(user_agent, count):
+        del statements[:]
+        for _ in range(count):
+            assert client.get('/api/referral/filterlnk', headers={'User-Agent': user_agent}).status_code == 200
+        return len(statements)
+
+    first = replay(BROWSERS[0], 1)
+    repeats = replay(BROWSERS[0], 1000)
+    bots = replay(BOTS[0], 1000)
+    print(f"  SQL statements: first click {first}, 1000 repeats {repeats}, 1000 bot hits {bots}")
+    return repeats == 0 and bots == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--capacity', type=int, default=100000)
+    parser.add_argument('--error-rate', type=float, default=0.001)
+    parser.add_argument('--slices', type=int, default=4)
+    parser.add_argument('--clicks', type=int, default=200000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    use_scratch_database('click-filter-bench-')
+    os.environ['CLICK_BUFFER_ENABLED'] = 'false'
+    os.environ['CLICK_DEDUP_CAPACITY'] = str(args.capacity)
+    os.environ['CLICK_DEDUP_ERROR_RATE'] = str(args.error_rate)
+    os.environ['CLICK_DEDUP_SLICES'] = str(args.slices)
+
+    from app import app, db, User, ReferralLink, click_filter
+    bootstrap(app)
+
+    ok = false_positives(args)
+    ok = window_accuracy(args) and ok
+    print("Throughput:")
+    throughput(args, click_filter)
+
+    with app.app_context():
+        user = User(username='filter', email='filter@example.com', password_hash='x', referral_code='filter')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(ReferralLink(user_id=user.id, link_code='filterlnk'))
+        db.session.commit()
+        ok = database_traffic(app, db) and ok
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
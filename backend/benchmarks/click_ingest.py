@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Click ingestion benchmark: synchronous writes vs. the write-behind buffer
+
+Usage: python benchmarks/click_ingest.py [--clicks 5000] [--threads 8]
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, record_every_click, use_scratch_database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clicks', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    workdir = use_scratch_database('click-bench-')
+    record_every_click()
+    os.environ['CLICK_BUFFER_SPILL_DIR'] = os.path.join(workdir, 'spill')
+
+    from app import app, db, User, ReferralLink, ReferralClick, click_buffer
+    bootstrap(app)
+
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com', password_hash='x', referral_code='bench')
+        db.session.add(user)
+        db.session.flush()
+        link = ReferralLink(user_id=user.id, link_code='benchlnk')
+        db.session.add(link)
+        db.session.commit()
+
+    def click(_):
+        with app.test_client() as client:
+            response = client.get('/api/referral/benchlnk', headers={'User-Agent': 'bench/1.0'})
+            assert response.status_code == 200
+
+    def run(buffered):
+        app.config['CLICK_BUFFER_ENABLED'] = buffered
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            list(pool.map(click, range(args.clicks)))
+        if buffered:
+            click_buffer.flush()
+        return args.clicks / (time.perf_counter() - start)
+
+    def counted():
+        with app.app_context():
+            return ReferralLink.query.filter_by(link_code='benchlnk').first().clicks
+
+    print(f"{args.clicks} clicks per mode, {args.threads} threads")
+    for mode, buffered in (('sync', False), ('buffered', True)):
+        before = counted()
+        rate = run(buffered)
+        print(f"  {mode:<9} {rate:10.1f} clicks/sec  (counter +{counted() - before})")
+
+    with app.app_context():
+        assert ReferralClick.query.count() == 2 * args.clicks
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Link code allocation: insert throughput, single-insert latency, conflicts and
+unique-index size as the link table grows, per code strategy
+
+  - old hex: 8 hex characters, the code space of the former uuid4()[:8]
+    generator (2^32 codes)
+  - random: CODE_STRATEGY=random with the default alphabet and length
+  - sequence: CODE_STRATEGY=sequence (block-reserved, permuted)
+  - ordered: the sequence numbers without the permutation, i.e. codes that
+    always append to the end of the unique index; a reference for what
+    index locality is worth, not a strategy the app offers (the codes are
+    guessable)
+
+Each strategy starts from an empty link table, bulk-loads --links links
+through insert_many_with_unique_codes() in batches of --batch, then times
+--inserts single links through insert_with_unique_code(), one transaction
+each, as POST /api/referral-links does.
+
+Usage: python benchmarks/code_allocation.py [--links 1000000] [--inserts 2000]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--links', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=10000)
+    parser.add_argument('--inserts', type=int, default=2000, help='single-link inserts timed per strategy')
+    args = parser.parse_args()
+
+    use_scratch_database('code-allocation-bench-')
+    os.environ['CLICK_BUFFER_ENABLED'] = 'false'
+
+    from app import app, db, User, ReferralLink, code_allocator, insert_many_with_unique_codes, insert_with_unique_code
+    from codes import DEFAULT_ALPHABET, CodePermutation
+    bootstrap(app)
+
+    class Ordered(CodePermutation):
+        def permute(self, number):
+            return number
+
+    strategies = [
+        ('old hex', {'CODE_STRATEGY': 'random', 'CODE_ALPHABET': '0123456789abcdef'}),
+        ('random', {'CODE_STRATEGY': 'random', 'CODE_ALPHABET': DEFAULT_ALPHABET}),
+        ('sequence', {'CODE_STRATEGY': 'sequence', 'CODE_ALPHABET': DEFAULT_ALPHABET}),
+        ('ordered', {'CODE_STRATEGY': 'sequence', 'CODE_ALPHABET': DEFAULT_ALPHABET}),
+    ]
+    link_values = {'clicks': 0, 'conversions': 0, 'is_active': True}
+
+    with app.app_context():
+        sqlite = db.engine.dialect.name == 'sqlite'
+        owner_id = db.session.query(User.id).scalar()
+
+        def index_bytes():
+            if sqlite:
+                return db.session.execute(text(
+                    "SELECT sum(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master "
+                    "WHERE tbl_name = 'referral_link' AND name LIKE 'sqlite_autoindex_%')"
+                )).scalar()
+            return db.session.execute(text(
+                "SELECT sum(pg_relation_size(indexrelid)) FROM pg_index "
+                "WHERE indrelid = 'referral_link'::regclass AND indisunique AND NOT indisprimary"
+            )).scalar()
+
+        print(f"{args.links:,} links per strategy, bulk batches of {args.batch:,}; {args.inserts:,} single inserts")
+        for name, config in strategies:
+            db.session.execute(text('DELETE FROM referral_link'))
+            db.session.commit()
+            if sqlite:
+                db.session.execute(text('VACUUM'))
+            app.config.update(config)
+            app.config['LINK_CODE_LENGTH'] = 8
+            if name == 'ordered':
+                secret = app.config['CODE_SECRET'] or app.config['SECRET_KEY']
+                key = ('link', DEFAULT_ALPHABET, 8, secret)
+                code_allocator._permutations[key] = Ordered(DEFAULT_ALPHABET, 8, b'')
+            code_allocator.conflicts.clear()
+
+            rates = []
+            for offset in range(0, args.links, args.batch):
+                size = min(args.batch, args.links - offset)
+                started = time.perf_counter()
+                insert_many_with_unique_codes(
+                    ReferralLink.__table__, 'link_code', 'link',
+                    [{'user_id': owner_id, **link_values}] * size, returning=[ReferralLink.id]
+                )
+                db.session.commit()
+                rates.append(size / (time.perf_counter() - started))
+            tenth = max(1, len(rates) // 10)
+            bulk_conflicts = code_allocator.conflicts.get('link', 0)
+
+            samples = []
+            for _ in range(args.inserts):
+                started = time.perf_counter()
+                insert_with_unique_code(
+                    ReferralLink.__table__, 'link_code', 'link', {'user_id': owner_id, **link_values},
+                    returning=[ReferralLink.id]
+                )
+                db.session.commit()
+                samples.append((time.perf_counter() - started) * 1000)
+            single_conflicts = code_allocator.conflicts.get('link', 0) - bulk_conflicts
+
+            print(f"  {name:<9} bulk {statistics.mean(rates[:tenth]):9,.0f} -> {statistics.mean(rates[-tenth:]):9,.0f} links/sec"
+                  f"  single p50 {statistics.median(samples):6.3f} ms  p99 {percentile(samples, 0.99):6.3f} ms"
+                  f"  conflicts {bulk_conflicts:,} bulk / {single_conflicts} single"
+                  f"  unique index {index_bytes() / 2**20:6.1f} MiB")
+
+        print(f"Allocator: {code_allocator.stats()}")
+
+
+if __name__ == '__main__':
+    main()
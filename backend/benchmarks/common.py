@@ -0,0 +1,33 @@
+"""
+Helpers shared by the benchmark scripts
+"""
+
+import os
+import tempfile
+
+
+def use_scratch_database(prefix):
+    """
+    Point the app at a scratch database before it is imported.
+
+    Defaults to a fresh SQLite file. Set BENCH_DATABASE_URL to run against
+    another backend instead, e.g. the PostgreSQL service from
+    docker-compose.postgres.yml; it must point at an empty database.
+    """
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    url = os.environ.get('BENCH_DATABASE_URL') or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['DATABASE_URL'] = url
+    return workdir
+
+
+def record_every_click():
+    """Turn off click dedup and bot filtering, for benchmarks that replay one click many times."""
+    os.environ['CLICK_DEDUP_WINDOW'] = '0'
+    os.environ['CLICK_FILTER_BOTS'] = 'false'
+
+
+def bootstrap(app):
+    """Run `flask bootstrap` (tables, migrations, admin user) against the scratch database."""
+    result = app.test_cli_runner().invoke(args=['bootstrap'])
+    if result.exit_code != 0:
+        raise RuntimeError(result.output) from result.exception
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Counter exactness check: many processes click the same link in parallel and
+the final ReferralLink.clicks must equal the number of clicks sent.
+
+Usage: python benchmarks/counter_concurrency.py [--clicks 4000] [--processes 4] [--threads 4]
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, record_every_click, use_scratch_database
+
+
+def click_many(job):
+    clicks, threads = job
+    from app import app
+
+    def click(_):
+        with app.test_client() as client:
+            return client.get('/api/referral/hotlink1').status_code
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return sum(1 for status in pool.map(click, range(clicks)) if status == 200)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clicks', type=int, default=4000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    use_scratch_database('counter-bench-')
+    record_every_click()
+
+    from app import app, db, User, ReferralLink
+    bootstrap(app)
+
+    with app.app_context():
+        user = User(username='hot', email='hot@example.com', password_hash='x', referral_code='hot')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(ReferralLink(user_id=user.id, link_code='hotlink1'))
+        db.session.commit()
+        # Forked workers must open their own connections, not share the
+        # parent's pooled ones (fine for SQLite files, breaks PostgreSQL)
+        db.engine.dispose(close=False)
+
+    per_process = args.clicks // args.processes
+    start = time.perf_counter()
+    with Pool(args.processes) as pool:
+        accepted = sum(pool.map(click_many, [(per_process, args.threads)] * args.processes))
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        counted = ReferralLink.query.filter_by(link_code='hotlink1').first().clicks
+
+    print(f"{accepted} clicks accepted in {elapsed:.2f}s, counter = {counted}")
+    assert counted == accepted, f"lost {accepted - counted} increments"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Dashboard polling throughput with conditional requests and the response cache
+
+Seeds --users users in a referral tree with links, clicks spread over the
+last two weeks and their trend rollups, then runs --rounds dashboard
+refreshes for --clients logged-in users. A refresh is what the dashboard
+loads: /api/stats, /api/achievements, /api/network, /api/referral-links and
+/api/analytics/trends. Before each round --change-rate of the clients get a
+click on one of their links (through the public click endpoint, not timed),
+so that share of the refreshes has something new to show.
+
+Each refresh mix runs three ways:
+
+  - recomputed: the undecorated views, every poll rebuilt from the database
+    (how the endpoints behaved before ETags)
+  - response cache: clients without ETag support, served from the per-worker
+    cache while their version is unchanged
+  - conditional: clients sending If-None-Match, answered 304 when unchanged
+
+and reports polls/sec, p50/p99 per endpoint and the share of 304s.
+
+Usage: python benchmarks/dashboard_polling.py [--users 100000] [--clients 1000] [--rounds 10] [--change-rate 0.1]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, record_every_click, use_scratch_database
+
+BATCH = 50000
+
+DASHBOARD = ['/api/stats', '/api/achievements', '/api/network', '/api/referral-links', '/api/analytics/trends']
+
+MODES = ('recomputed', 'response cache', 'conditional')
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--clicks', type=int, default=1000000, help='historical clicks spread over the last 14 days')
+    parser.add_argument('--clients', type=int, default=1000, help='users polling their dashboard')
+    parser.add_argument('--rounds', type=int, default=10, help='dashboard refreshes per client and mode')
+    parser.add_argument('--change-rate', type=float, default=0.1, help='share of clients with a new click before each round')
+    args = parser.parse_args()
+
+    use_scratch_database('dashboard-bench-')
+    record_every_click()
+
+    from app import app, db, User, ReferralLink, ReferralClick, response_cache
+    bootstrap(app)
+    rng = random.Random(11)
+
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    with app.app_context():
+        for offset in range(0, args.users, BATCH):
+            db.session.execute(User.__table__.insert(), [
+                {'id': n, 'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': 'x',
+                 'referral_code': f'r{n}', 'created_at': now - timedelta(days=60 * rng.random()),
+                 'referred_by': 2 + int((n - 2) * rng.random() ** 2) if n > 2 else None}
+                for n in range(offset + 2, min(offset + BATCH, args.users) + 2)
+            ])
+        links = [(n, rng.randrange(2, args.users + 2)) for n in range(1, args.users + 1)]
+        for offset in range(0, len(links), BATCH):
+            db.session.execute(ReferralLink.__table__.insert(), [
+                {'id': link_id, 'user_id': user_id, 'link_code': f'l{link_id}', 'clicks': 0, 'conversions': 0,
+                 'is_active': True, 'created_at': now - timedelta(days=30)}
+                for link_id, user_id in links[offset:offset + BATCH]
+            ])
+        for offset in range(0, args.clicks, BATCH):
+            db.session.execute(ReferralClick.__table__.insert(), [
+                {'link_id': rng.randrange(1, args.users + 1), 'ip_address': f'10.0.{n % 256}.{n // 256 % 256}',
+                 'clicked_at': now - timedelta(seconds=rng.randrange(14 * 86400))}
+                for n in range(offset, min(offset + BATCH, args.clicks))
+            ])
+        db.session.execute(ReferralLink.__table__.update().values(clicks=(
+            select(func.count()).where(ReferralClick.link_id == ReferralLink.id).scalar_subquery()
+        )))
+        db.session.commit()
+    for command in ('rebuild-user-stats', 'backfill-rollups'):
+        result = app.test_cli_runner().invoke(args=[command])
+        if result.exit_code != 0:
+            raise RuntimeError(result.output) from result.exception
+    print(f"Seeded {args.users:,} users, {len(links):,} links and {args.clicks:,} clicks "
+          f"in {time.perf_counter() - started:.0f}s")
+
+    owners = defaultdict(list)
+    for link_id, user_id in links:
+        owners[user_id].append(link_id)
+    polling = rng.sample(sorted(owners), min(args.clients, len(owners)))
+
+    def logged_in(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+            session['is_admin'] = False
+        return client
+
+    clicker = app.test_client()
+    decorated = {
+        rule.endpoint: app.view_functions[rule.endpoint]
+        for rule in app.url_map.iter_rules() if rule.rule in DASHBOARD and 'GET' in rule.methods
+    }
+
+    print(f"{len(polling):,} clients x {args.rounds} refreshes of {len(DASHBOARD)} endpoints, "
+          f"{args.change_rate:.0%} of clients with a new click per round")
+    for mode in MODES:
+        for endpoint, view in decorated.items():
+            app.view_functions[endpoint] = view.__wrapped__ if mode == 'recomputed' else view
+        response_cache.clear()
+        clients = {user_id: logged_in(user_id) for user_id in polling}
+        etags = {}
+        latencies = defaultdict(list)
+        statuses = Counter()
+        elapsed = 0.0
+        # Warm-up refresh: every mode starts from clients that have loaded the dashboard once
+        for round_number in range(args.rounds + 1):
+            if round_number:
+                for user_id in rng.sample(polling, int(len(polling) * args.change_rate)):
+                    clicker.get(f"/api/referral/l{rng.choice(owners[user_id])}")
+            for user_id, client in clients.items():
+                for path in DASHBOARD:
+                    headers = {'If-None-Match': etags[user_id, path]} if mode == 'conditional' and (user_id, path) in etags else {}
+                    started = time.perf_counter()
+                    response = client.get(path, headers=headers)
+                    took = time.perf_counter() - started
+                    if response.status_code not in (200, 304):
+                        raise RuntimeError(f"{path}: {response.status_code} {response.get_data(as_text=True)}")
+                    if response.headers.get('ETag'):
+                        etags[user_id, path] = response.headers['ETag']
+                    if round_number:
+                        elapsed += took
+                        latencies[path].append(took * 1000)
+                        statuses[response.status_code] += 1
+
+        polls = sum(statuses.values())
+        print(f"\n{mode}: {polls / elapsed:,.0f} polls/sec, {statuses[304] / polls:.0%} answered 304")
+        for path in DASHBOARD:
+            samples = latencies[path]
+            print(f"  {path:<24} p50 {statistics.median(samples):7.2f} ms  p99 {percentile(samples, 0.99):7.2f} ms")
+        if mode == 'response cache':
+            cache = response_cache.stats()
+            print(f"  cache: {cache['hit_rate']:.0%} hits, {cache['size']:,} bodies, {cache['bytes'] / 1024:,.0f} KiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Live event streams with thousands of subscribers
+
+Starts the async service (asgi.py on uvicorn, --async-workers processes)
+for the streams and gunicorn for the writes, both on one scratch database,
+as in docker-compose.async.yml. It then opens --subscribers streams on
+/api/events for --users logged-in users (several streams per user, spread
+over the processes), --firehose admin streams on /api/admin/events, and
+--slow firehose streams that read nothing.
+
+For --seconds a pool of clients clicks, converts and registers (some of them
+through a referral link) through gunicorn, on links of every user, streamed
+or not. Afterwards it checks that:
+
+  - every stream's summed updates equal the user's clicks, conversions,
+    earnings and referrals in the database, per link too, and the firehose
+    totals equal the whole table counts;
+  - no stream got two updates closer than EVENTS_MIN_INTERVAL;
+  - the slow streams held up none of the others.
+
+A stream that stops reading only stalls once its socket buffers are full,
+a few MiB on Linux; at one coalesced update a second that takes a long
+time, so how many slow streams hit --send-timeout and were dropped is
+reported, not checked.
+
+It reports the delay from a click being acknowledged to the update that
+carries it, how many activity rows went out as how many messages, and the
+stream processes' memory before and after.
+
+Usage: python benchmarks/event_streams.py [--users 2000] [--subscribers 5000] [--firehose 4] [--slow 50] [--seconds 20]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from sqlalchemy import func, select
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, record_every_click, use_scratch_database
+
+from async_clicks import free_port, percentile, read_response, wait_until_up
+
+COUNTS = ('clicks', 'conversions', 'earnings', 'referrals')
+
+
+class Stream:
+    def __init__(self, user_id, cookie):
+        self.user_id = user_id
+        self.cookie = cookie
+        self.status = None
+        self.ready = asyncio.Event()
+        self.totals = defaultdict(int)
+        self.links = defaultdict(lambda: defaultdict(int))
+        # (received at, clicks so far) per activity update
+        self.updates = []
+        self.truncated = 0
+        self.dropped = False
+
+    def apply(self, payload):
+        for name, value in payload['totals'].items():
+            self.totals[name] += value
+        for link_id, counts in payload.get('links', {}).items():
+            for name, value in counts.items():
+                self.links[int(link_id)][name] += value
+        self.truncated += payload.get('truncated', False)
+        self.updates.append((time.perf_counter(), self.totals['clicks']))
+
+
+def frames(buffer):
+    # Complete SSE frames at the head of `buffer` as (event, data) pairs, and the rest
+    parsed = []
+    while b'\n\n' in buffer:
+        frame, buffer = buffer.split(b'\n\n', 1)
+        event, data = 'message', None
+        for line in frame.split(b'\n'):
+            name, _, value = line.partition(b': ')
+            if name == b'event':
+                event = value.decode()
+            elif name == b'data':
+                data = value
+        if data is not None:
+            parsed.append((event, data))
+    return parsed, buffer
+
+
+async def subscribe(port, path, stream, stop, resume=None):
+    # HTTP/1.0, so the body is the raw event stream up to the server's close.
+    # With `resume`, the stream reads nothing between `ready` and resume.set().
+    sock = socket.socket()
+    if resume is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+    reader, writer = await asyncio.open_connection(sock=sock, limit=1 << 22)
+    writer.write(f'GET {path} HTTP/1.0\r\nHost: 127.0.0.1\r\nCookie: session={stream.cookie}\r\n\r\n'.encode())
+    head = await reader.readuntil(b'\r\n\r\n')
+    stream.status = int(head.split(b' ', 2)[1])
+    if stream.status != 200:
+        writer.close()
+        stream.ready.set()
+        return
+    buffer = b''
+    try:
+        while not stop.is_set():
+            if resume is not None and stream.ready.is_set() and not resume.is_set():
+                # Drain what the kernel buffered; a dropped stream then ends
+                await resume.wait()
+                try:
+                    while await asyncio.wait_for(reader.read(1 << 20), 10):
+                        pass
+                    stream.dropped = True
+                except asyncio.TimeoutError:
+                    pass
+                return
+            data = await reader.read(65536)
+            if not data:
+                stream.dropped = True
+                return
+            parsed, buffer = frames(buffer + data)
+            for event, payload in parsed:
+                if event == 'ready':
+                    stream.ready.set()
+                elif event == 'activity':
+                    stream.apply(json.loads(payload))
+    finally:
+        writer.close()
+
+
+async def write_traffic(port, codes, owners, deadline, acks, names, rng):
+    # One keep-alive connection to gunicorn sending clicks (80%), conversions
+    # (10%) and sign-ups (10%, half through a referral link)
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        link_id = rng.randrange(len(codes))
+        roll = rng.random()
+        if roll < 0.8:
+            kind, request = 'clicks', f'GET /api/referral/{codes[link_id]} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'
+        elif roll < 0.9:
+            kind, request = 'conversions', (
+                f'POST /api/referral/{codes[link_id]}/convert HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: 0\r\n\r\n'
+            )
+        else:
+            name = f'live{next(names)}'
+            body = {'username': name, 'email': f'{name}@example.com', 'password': 'live-events'}
+            if rng.random() < 0.5:
+                body['referralLinkCode'] = codes[link_id]
+            body = json.dumps(body)
+            kind, request = 'registrations', (
+                f'POST /api/register HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n\r\n{body}'
+            )
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(request.encode())
+            status = await asyncio.wait_for(read_response(reader), 30)
+            if status in (200, 201):
+                acks[kind].append((time.perf_counter(), owners[link_id]))
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+
+def rss_mib(parent_pid):
+    # Resident memory of the server's worker processes
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as stat:
+                if int(stat.read().rsplit(')', 1)[1].split()[1]) != parent_pid:
+                    continue
+            with open(f'/proc/{pid}/status') as status:
+                total += next(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+        except (OSError, StopIteration):
+            pass
+    return total / 1024
+
+
+async def run(args, stream_port, write_port, server, codes, owners, cookies, admin_cookie):
+    stop = asyncio.Event()
+    resume = asyncio.Event()
+    user_ids = sorted(cookies)
+    streams = [Stream(user_ids[n % len(user_ids)], cookies[user_ids[n % len(user_ids)]]) for n in range(args.subscribers)]
+    firehose = [Stream(None, admin_cookie) for _ in range(args.firehose)]
+    slow = [Stream(None, admin_cookie) for _ in range(args.slow)]
+
+    rss_before = rss_mib(server.pid)
+    tasks = []
+    started = time.perf_counter()
+    # Batches keep the listen backlog from overflowing
+    for offset in range(0, len(streams), 500):
+        batch = streams[offset:offset + 500]
+        tasks += [asyncio.create_task(subscribe(stream_port, '/api/events', stream, stop)) for stream in batch]
+        await asyncio.gather(*(stream.ready.wait() for stream in batch))
+    tasks += [asyncio.create_task(subscribe(stream_port, '/api/admin/events', stream, stop)) for stream in firehose]
+    tasks += [asyncio.create_task(subscribe(stream_port, '/api/admin/events', stream, stop, resume)) for stream in slow]
+    await asyncio.gather(*(stream.ready.wait() for stream in firehose + slow))
+    refused = sum(stream.status != 200 for stream in streams + firehose + slow)
+    print(f"Opened {len(streams):,} user streams for {len(user_ids):,} users, {len(firehose)} firehose and "
+          f"{len(slow)} slow streams in {time.perf_counter() - started:.1f}s, {refused} refused")
+    rss_open = rss_mib(server.pid)
+    await asyncio.sleep(2)
+
+    acks = defaultdict(list)
+    names = iter(range(10 ** 9))
+    rng = random.Random(3)
+    deadline = time.perf_counter() + args.seconds
+    await asyncio.gather(*(
+        write_traffic(write_port, codes, owners, deadline, acks, names, rng) for _ in range(args.writers)
+    ))
+    print(f"Wrote for {args.seconds:.0f}s: " + ', '.join(f"{len(acks[kind]):,} {kind}" for kind in ('clicks', 'conversions', 'registrations')))
+
+    # Last updates: one poll and one throttle interval
+    await asyncio.sleep(3)
+    rss_after = rss_mib(server.pid)
+    resume.set()
+    await asyncio.gather(*tasks[-len(slow):] if slow else [])
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return streams, firehose, slow, acks, refused, (rss_before, rss_open, rss_after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000, help='users with a link and a live stream')
+    parser.add_argument('--others', type=int, default=1000, help='users with a link but no stream')
+    parser.add_argument('--subscribers', type=int, default=5000, help='user streams, spread over --users')
+    parser.add_argument('--firehose', type=int, default=4, help='admin streams reading everything')
+    parser.add_argument('--slow', type=int, default=50, help='admin streams that stop reading')
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--writers', type=int, default=16, help='concurrent writing connections')
+    parser.add_argument('--min-interval', type=float, default=1.0, help='EVENTS_MIN_INTERVAL')
+    parser.add_argument('--send-timeout', type=float, default=3, help='EVENTS_SEND_TIMEOUT')
+    parser.add_argument('--async-workers', type=int, default=2, help='uvicorn worker processes')
+    args = parser.parse_args()
+
+    use_scratch_database('event-streams-bench-')
+    record_every_click()
+    os.environ.update({
+        'CLICK_BUFFER_ENABLED': 'false',
+        'BCRYPT_LOG_ROUNDS': '4',
+        'PASSWORD_HASH_QUEUE_SIZE': '64',
+        'EVENTS_MIN_INTERVAL': str(args.min_interval),
+        'EVENTS_SEND_TIMEOUT': str(args.send_timeout),
+        'EVENTS_MAX_STREAMS': str(args.subscribers + args.firehose + args.slow),
+    })
+
+    from app import app, db, User, ReferralLink, ReferralClick, ConversionEvent, EARNINGS_PER_CONVERSION
+    bootstrap(app)
+
+    total = args.users + args.others
+    with app.app_context():
+        admin_id = db.session.query(User.id).filter_by(is_admin=True).scalar()
+        first = admin_id + 1
+        db.session.execute(User.__table__.insert(), [
+            {'id': first + n, 'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': 'x',
+             'referral_code': f'r{n}'}
+            for n in range(total)
+        ])
+        db.session.execute(ReferralLink.__table__.insert(), [
+            {'id': n + 1, 'user_id': first + n, 'link_code': f'l{n}', 'clicks': 0, 'conversions': 0, 'is_active': True}
+            for n in range(total)
+        ])
+        db.session.commit()
+    codes = [f'l{n}' for n in range(total)]
+    owners = [first + n for n in range(total)]
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = {first + n: serializer.dumps({'user_id': first + n, 'is_admin': False}) for n in range(args.users)}
+    admin_cookie = serializer.dumps({'user_id': admin_id, 'is_admin': True})
+
+    stream_port, write_port = free_port(), free_port()
+    streams_server = subprocess.Popen([
+        sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', str(stream_port),
+        '--workers', str(args.async_workers), '--no-access-log', '--log-level', 'warning', '--backlog', '4096',
+        '--timeout-graceful-shutdown', '1'
+    ], cwd=BACKEND_DIR)
+    writes_server = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{write_port}', '--workers', '2',
+        '--worker-class', 'gthread', '--threads', '8', '--log-level', 'warning', 'app:app'
+    ], cwd=BACKEND_DIR)
+    try:
+        wait_until_up(stream_port)
+        wait_until_up(write_port)
+        time.sleep(1)
+        streams, firehose, slow, acks, refused, rss = asyncio.run(
+            run(args, stream_port, write_port, streams_server, codes, owners, cookies, admin_cookie)
+        )
+    finally:
+        streams_server.terminate()
+        writes_server.terminate()
+        streams_server.wait()
+        writes_server.wait()
+
+    with app.app_context():
+        clicks = dict(db.session.execute(select(ReferralClick.link_id, func.count()).group_by(ReferralClick.link_id)).all())
+        conversions = dict(db.session.execute(
+            select(ConversionEvent.link_id, func.count()).group_by(ConversionEvent.link_id)
+        ).all())
+        referrals = dict(db.session.execute(
+            select(User.referred_by, func.count()).where(User.referred_by.isnot(None)).group_by(User.referred_by)
+        ).all())
+        registrations = db.session.query(func.count(User.id)).filter(User.id >= first + total).scalar()
+
+    failures = []
+    for stream in streams:
+        link_id = stream.user_id - first + 1
+        expected = {
+            'clicks': clicks.get(link_id, 0),
+            'conversions': conversions.get(link_id, 0),
+            'earnings': conversions.get(link_id, 0) * EARNINGS_PER_CONVERSION,
+            'referrals': referrals.get(stream.user_id, 0),
+        }
+        got = {name: stream.totals[name] for name in COUNTS}
+        by_link = {name: stream.links[link_id][name] for name in ('clicks', 'conversions', 'earnings')}
+        if got != expected or any(by_link[name] != expected[name] for name in by_link) or stream.dropped:
+            failures.append(f"user {stream.user_id}: streamed {got}, database {expected}")
+    expected = {
+        'clicks': sum(clicks.values()),
+        'conversions': sum(conversions.values()),
+        'earnings': sum(conversions.values()) * EARNINGS_PER_CONVERSION,
+        'referrals': sum(referrals.values()),
+        'registrations': registrations,
+    }
+    for stream in firehose:
+        got = {name: stream.totals[name] for name in expected}
+        if got != expected or stream.dropped:
+            failures.append(f"firehose: streamed {got}, database {expected}")
+
+    gaps = [
+        later[0] - earlier[0]
+        for stream in streams + firehose for earlier, later in zip(stream.updates, stream.updates[1:])
+    ]
+    # Receive times jitter with the client's own scheduling
+    too_close = sum(gap < args.min_interval - 0.25 for gap in gaps)
+    click_acks = defaultdict(list)
+    for acked_at, user_id in acks['clicks']:
+        click_acks[user_id].append(acked_at)
+    delays = []
+    for stream in streams:
+        updates = iter(stream.updates)
+        update = next(updates, None)
+        for number, acked_at in enumerate(click_acks[stream.user_id], 1):
+            while update is not None and update[1] < number:
+                update = next(updates, None)
+            if update is not None:
+                delays.append(max(update[0] - acked_at, 0) * 1000)
+    messages = sum(len(stream.updates) for stream in streams)
+    rows = sum(len(acks[kind]) for kind in acks)
+    dropped = sum(stream.dropped for stream in slow)
+
+    print(f"Delivery, click acknowledged -> update received: p50 {statistics.median(delays):,.0f} ms, "
+          f"p99 {percentile(delays, 0.99):,.0f} ms" if delays else "No clicks delivered")
+    print(f"{messages:,} updates on user streams ({messages / len(streams):.1f} each) for {rows:,} writes; "
+          f"firehose: {sum(len(stream.updates) for stream in firehose) // max(len(firehose), 1)} updates each, "
+          f"{sum(stream.truncated for stream in firehose)} truncated")
+    print(f"Closest updates on one stream: {min(gaps):.2f}s apart (EVENTS_MIN_INTERVAL {args.min_interval}), "
+          f"{too_close} too close" if gaps else "No stream got two updates")
+    print(f"Slow streams dropped after blocking {args.send_timeout:.0f}s: {dropped} of {len(slow)}")
+    print(f"Stream processes RSS: {rss[0]:,.0f} MiB idle, {rss[1]:,.0f} MiB with "
+          f"{len(streams) + len(firehose) + len(slow):,} streams "
+          f"({(rss[1] - rss[0]) * 1024 / (len(streams) + len(firehose) + len(slow)):.1f} KiB each), "
+          f"{rss[2]:,.0f} MiB after the writes")
+    for failure in failures[:10]:
+        print(f"  MISMATCH {failure}")
+    print(f"{len(streams) - sum(1 for f in failures if f.startswith('user')):,} of {len(streams):,} user streams and "
+          f"{len(firehose) - sum(1 for f in failures if f.startswith('firehose'))} of {len(firehose)} firehose streams "
+          f"match the database")
+    sys.exit(1 if failures or refused or too_close else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Export memory ceiling: peak RSS of `flask export clicks` must not grow with
+the number of rows exported
+
+Seeds --clicks click rows, then exports one link's clicks and the full click
+history in separate processes and compares their peak resident memory. The
+full export must stay within --ceiling MiB of the small one, and must
+contain every row.
+
+Usage: python benchmarks/export_memory.py [--clicks 2000000] [--format csv] [--ceiling 32]
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+CHUNK = 50000
+# Runs the flask CLI and reports the process's own peak RSS (VmHWM) on exit.
+# ru_maxrss from wait4() is no good here: Linux carries the parent's high-water
+# mark, inflated by seeding, over into the child.
+CLI_PROBE = '''
+import sys
+from flask.cli import main
+try:
+    main()
+finally:
+    with open('/proc/self/status') as status:
+        peak = next(line.split()[1] for line in status if line.startswith('VmHWM:'))
+    print(f"VmHWM {peak}", file=sys.stderr)
+'''
+
+# The tuned profile's mmap window and page cache legitimately fill up as a big
+# export reads the file; both are bounded by configuration, not by row count.
+# Measure with SQLite's own small defaults so only the export code is tested.
+SQLITE_DEFAULTS = {'SQLITE_MMAP_SIZE': '', 'SQLITE_CACHE_SIZE': ''}
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+
+def export(workdir, fmt, *options):
+    """Run one export in a child process; returns (seconds, peak RSS MiB, output lines)."""
+    path = os.path.join(workdir, f'export.{fmt}')
+    command = [sys.executable, '-c', CLI_PROBE, '--app', 'app', 'export', 'clicks',
+               '--format', fmt, '--output', path, *options]
+    started = time.perf_counter()
+    result = subprocess.run(command, cwd=BACKEND_DIR, capture_output=True, text=True, env=dict(os.environ, **SQLITE_DEFAULTS))
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"export failed: {result.stderr}")
+    peak_kib = int(result.stderr.rsplit('VmHWM ', 1)[1])
+
+    with open(path, 'rb') as output:
+        lines = sum(1 for _ in output)
+    os.remove(path)
+    return elapsed, peak_kib / 1024, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clicks', type=int, default=2000000)
+    parser.add_argument('--links', type=int, default=1000)
+    parser.add_argument('--format', default='csv', choices=['csv', 'ndjson'])
+    parser.add_argument('--ceiling', type=float, default=32, help='allowed peak RSS growth in MiB')
+    args = parser.parse_args()
+
+    workdir = use_scratch_database('export-bench-')
+
+    from app import app, db, User, ReferralLink, ReferralClick, user_agent_cache
+    bootstrap(app)
+
+    rng = random.Random(11)
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    with app.app_context():
+        agent_id = user_agent_cache.get_id(USER_AGENT)
+        user = User(username='exporter', email='exporter@example.com', password_hash='x', referral_code='exporter')
+        db.session.add(user)
+        db.session.flush()
+        db.session.execute(ReferralLink.__table__.insert(), [
+            {'user_id': user.id, 'link_code': f'export{n}', 'clicks': 0, 'conversions': 0, 'is_active': True}
+            for n in range(args.links)
+        ])
+        link_ids = [link_id for (link_id,) in db.session.query(ReferralLink.id)]
+        for offset in range(0, args.clicks, CHUNK):
+            db.session.execute(ReferralClick.__table__.insert(), [
+                {'link_id': rng.choice(link_ids), 'ip_address': '203.0.113.7', 'user_agent_id': agent_id,
+                 'clicked_at': now - timedelta(seconds=rng.randrange(90 * 86400))}
+                for _ in range(min(CHUNK, args.clicks - offset))
+            ])
+            db.session.commit()
+    print(f"Seeded {args.clicks:,} clicks in {time.perf_counter() - started:.1f}s")
+
+    header = 1 if args.format == 'csv' else 0
+    _, small_rss, small_lines = export(workdir, args.format, '--link-id', str(link_ids[0]))
+    elapsed, full_rss, full_lines = export(workdir, args.format)
+    print(f"  one link   {small_lines - header:>10,} rows  peak RSS {small_rss:7.1f} MiB")
+    print(f"  everything {full_lines - header:>10,} rows  peak RSS {full_rss:7.1f} MiB  "
+          f"({(full_lines - header) / elapsed:,.0f} rows/sec)")
+
+    assert full_lines - header == args.clicks, f"exported {full_lines - header} of {args.clicks} rows"
+    assert full_rss - small_rss <= args.ceiling, \
+        f"peak RSS grew by {full_rss - small_rss:.1f} MiB exporting every row (ceiling {args.ceiling} MiB)"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Leaderboard reads and upkeep at --users users
+
+Seeds users who signed up over the last 60 days, 30% of them referred
+(mostly by early users), with long-tailed click/conversion totals, and
+--active of them with daily rollups over the last 30 days, then runs
+`flask rebuild-leaderboard` and times, per board:
+
+  - top 10 / top 100: overall_leaderboard() off the score index, and
+    window_leaderboard() off the 7-day snapshot
+  - my rank: overall_rank() (score histogram) and window_rank() (snapshot
+    lookup) for users sampled across the whole board, top to tail
+  - the same ranks the way they could be computed without the leaderboard:
+    COUNT(*) of users with a higher score (one index range per lookup, as
+    long as the users above), and a full sort of the board
+
+Finally it times --writes single-click counter bumps with and without the
+histogram upkeep, the cost the write paths pay for the live boards.
+
+Usage: python benchmarks/leaderboard.py [--users 1000000] [--active 100000] [--lookups 200]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, text
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+BATCH = 50000
+
+
+def long_tail(rng, scale):
+    # Most users at 0 or a handful, a few in the thousands
+    return int(scale * (rng.paretovariate(1.3) - 1))
+
+
+def timed_ms(callable_, *args):
+    started = time.perf_counter()
+    callable_(*args)
+    return (time.perf_counter() - started) * 1000
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def report(label, samples):
+    print(f"  {label:<44} p50 {statistics.median(samples):9.3f} ms  p99 {percentile(samples, 0.99):9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--active', type=int, default=100000, help='users with clicks/conversions in the last 30 days')
+    parser.add_argument('--lookups', type=int, default=200, help='rank lookups timed per board')
+    parser.add_argument('--writes', type=int, default=2000, help='single-click counter bumps timed')
+    args = parser.parse_args()
+
+    use_scratch_database('leaderboard-bench-')
+    os.environ['CLICK_BUFFER_ENABLED'] = 'false'
+
+    from app import (
+        app, db, User, UserStats, ReferralLink, ActivityRollup, LeaderboardSnapshot, LEADERBOARD_BOARDS,
+        bump_user_stats, overall_leaderboard, overall_rank, score_histogram, window_leaderboard, window_rank
+    )
+    bootstrap(app)
+    rng = random.Random(7)
+
+    started = time.perf_counter()
+    with app.app_context():
+        now = datetime.utcnow()
+        for offset in range(0, args.users, BATCH):
+            ids = range(offset + 2, min(offset + BATCH, args.users) + 2)
+            db.session.execute(User.__table__.insert(), [
+                {'id': n, 'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': 'x',
+                 'referral_code': f'r{n}', 'created_at': now - timedelta(days=60 * rng.random()),
+                 'referred_by': 2 + int((n - 2) * rng.random() ** 3) if n > 2 and rng.random() < 0.3 else None}
+                for n in ids
+            ])
+            stats = []
+            for n in ids:
+                conversions = long_tail(rng, 1)
+                stats.append({'user_id': n, 'total_clicks': conversions * 8 + long_tail(rng, 3),
+                              'total_conversions': conversions, 'earnings': conversions * 15})
+            db.session.execute(UserStats.__table__.insert(), stats)
+            db.session.commit()
+        db.session.execute(text(
+            'UPDATE user_stats SET referrals_count = (SELECT count(*) FROM "user" u WHERE u.referred_by = user_stats.user_id)'
+        ))
+        db.session.commit()
+
+        active = rng.sample(range(2, args.users + 2), min(args.active, args.users))
+        db.session.execute(ReferralLink.__table__.insert(), [
+            {'id': n, 'user_id': n, 'link_code': f'l{n}', 'clicks': 0, 'conversions': 0, 'is_active': True} for n in active
+        ])
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        rollups = []
+        for n in active:
+            for day in rng.sample(range(30), rng.randint(1, 5)):
+                rollups.append({'granularity': 'day', 'bucket_start': today - timedelta(days=day), 'link_id': n,
+                                'user_id': n, 'clicks': 1 + long_tail(rng, 2), 'conversions': long_tail(rng, 0.3)})
+        for offset in range(0, len(rollups), BATCH):
+            db.session.execute(ActivityRollup.__table__.insert(), rollups[offset:offset + BATCH])
+        db.session.commit()
+    print(f"Seeded {args.users:,} users, {len(active):,} active with {len(rollups):,} daily rollups "
+          f"in {time.perf_counter() - started:.0f}s")
+
+    started = time.perf_counter()
+    result = app.test_cli_runner().invoke(args=['rebuild-leaderboard'])
+    print(result.output.rstrip())
+    print(f"rebuild-leaderboard: {time.perf_counter() - started:.1f}s")
+
+    with app.app_context():
+        for board, column_name in LEADERBOARD_BOARDS.items():
+            column = getattr(UserStats, column_name)
+            distinct = db.session.query(func.count(func.distinct(column))).scalar()
+            print(f"\n{board}: {distinct:,} distinct scores")
+
+            report('top 10, overall', [timed_ms(overall_leaderboard, board, 10) for _ in range(50)])
+            report('top 100, overall', [timed_ms(overall_leaderboard, board, 100) for _ in range(50)])
+            report('top 10, 7 days', [timed_ms(window_leaderboard, board, 7, 10) for _ in range(50)])
+
+            # Users sampled uniformly across the board's order, top to tail
+            ordered = [user_id for (user_id,) in db.session.execute(
+                select(UserStats.user_id).order_by(column.desc(), UserStats.user_id)
+            )]
+            sample = [ordered[int(i * (len(ordered) - 1) / (args.lookups - 1))] for i in range(args.lookups)]
+            scores = dict(db.session.execute(select(UserStats.user_id, column).where(UserStats.user_id.in_(sample))).all())
+            snapshot = db.session.get(LeaderboardSnapshot, (7, board))
+
+            report('my rank, overall (histogram)', [timed_ms(overall_rank, board, user_id) for user_id in sample])
+            report('my rank, 7 days (snapshot)', [timed_ms(window_rank, board, 7, user_id, snapshot) for user_id in sample])
+            report('my rank, COUNT(*) of higher scores', [
+                timed_ms(lambda s: db.session.query(func.count()).filter(column > s).scalar(), scores[user_id])
+                for user_id in sample
+            ])
+            report('my rank, full sort', [timed_ms(lambda: sorted(
+                db.session.execute(select(UserStats.user_id, column)).all(), key=lambda row: -row[1]
+            )) for _ in range(3)])
+
+            ranks = [overall_rank(board, user_id)[0] for user_id in sample]
+            expected = [db.session.query(func.count()).filter(column > scores[user_id]).scalar() + 1 for user_id in sample]
+            if ranks != expected:
+                print('  histogram ranks disagree with COUNT(*)')
+                sys.exit(1)
+
+        # Upkeep on the write path: one click's counter bump, with and without the histogram
+        users = [rng.randrange(2, args.users + 2) for _ in range(args.writes)]
+        samples = {}
+        for label in ('with histogram', 'without histogram'):
+            moved = score_histogram.moved
+            if label == 'without histogram':
+                score_histogram.moved = lambda changes: None
+            try:
+                samples[label] = []
+                for user_id in users:
+                    started = time.perf_counter()
+                    bump_user_stats(user_id, total_clicks=1)
+                    db.session.commit()
+                    samples[label].append((time.perf_counter() - started) * 1000)
+            finally:
+                score_histogram.moved = moved
+            if label == 'with histogram':
+                drifted = score_histogram.drift()
+        print()
+        for label, values in samples.items():
+            report(f'click counter bump + commit, {label}', values)
+        print(f"  {len(drifted)} histogram buckets out of date after the bumps")
+        sys.exit(1 if drifted else 0)
+
+
+if __name__ == '__main__':
+    main()
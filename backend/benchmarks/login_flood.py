@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Click latency under a login flood
+
+Starts gunicorn on a scratch database, keeps --logins concurrent login
+requests running, and measures /api/referral/<code> latency alongside them.
+Two server setups are compared:
+
+  inline  sync workers with an unbounded hash queue, so every login holds a
+          worker for the whole bcrypt round (the old behaviour)
+  pooled  threaded workers with the bounded hash pool; logins past the queue
+          limit get 503 + Retry-After instead of a worker
+
+Usage: python benchmarks/login_flood.py [--logins 32] [--seconds 10] [--rounds 12]
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, record_every_click, use_scratch_database
+
+SETUPS = {
+    'inline': (['--workers', '4'], {'PASSWORD_HASH_QUEUE_SIZE': '100000'}),
+    'pooled': (['--workers', '4', '--worker-class', 'gthread', '--threads', '8'], {}),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def request(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def run(label, args, env):
+    gunicorn_args, extra_env = SETUPS[label]
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', *gunicorn_args, 'app:app'],
+        cwd=BACKEND_DIR, env=dict(env, **extra_env),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        for _ in range(100):
+            try:
+                if request(f'{base}/api/referral/floodlink') == 200:
+                    break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError('gunicorn did not come up')
+
+        stop = threading.Event()
+        statuses = []
+
+        def flood():
+            while not stop.is_set():
+                statuses.append(request(f'{base}/api/login', {'username': 'flood', 'password': 'flood-password'}))
+
+        flooders = [threading.Thread(target=flood) for _ in range(args.logins)]
+        for thread in flooders:
+            thread.start()
+
+        latencies = []
+        deadline = time.perf_counter() + args.seconds
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            request(f'{base}/api/referral/floodlink')
+            latencies.append((time.perf_counter() - started) * 1000)
+            time.sleep(0.01)
+
+        stop.set()
+        for thread in flooders:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+    ok = statuses.count(200)
+    rejected = statuses.count(503)
+    print(f"{label:<7} clicks p50 {statistics.median(latencies):7.1f} ms  p99 {p99:7.1f} ms  "
+          f"logins {ok / args.seconds:6.1f}/s ok, {rejected / args.seconds:6.1f}/s rejected")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--rounds', type=int, default=12)
+    args = parser.parse_args()
+
+    workdir = use_scratch_database('login-bench-')
+    record_every_click()
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(args.rounds)
+    os.environ['CLICK_BUFFER_SPILL_DIR'] = os.path.join(workdir, 'spill')
+
+    from app import app, db, User, ReferralLink, password_hasher
+    bootstrap(app)
+
+    with app.app_context():
+        user = User(username='flood', email='flood@example.com', referral_code='flood',
+                    password_hash=password_hasher.hash('flood-password'))
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(ReferralLink(user_id=user.id, link_code='floodlink'))
+        db.session.commit()
+
+    print(f"{args.logins} concurrent logins, bcrypt cost {args.rounds}, {args.seconds:.0f}s per setup")
+    for label in SETUPS:
+        run(label, args, dict(os.environ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+/api/network/tree on a synthetic referral tree
+
+Builds a complete k-ary tree of users under the admin account (user k's
+referrer is user k // branching) and times downline queries of increasing
+depth from the root and from a node further down.
+
+Usage: python benchmarks/network_tree.py [--users 1000000] [--branching 8] [--repeat 5]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+CHUNK = 50000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--branching', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    use_scratch_database('network-bench-')
+
+    from app import app, db, User
+    bootstrap(app)
+
+    started = time.perf_counter()
+    with app.app_context():
+        # The admin user created by bootstrap is id 1 and roots the tree
+        for offset in range(2, args.users + 2, CHUNK):
+            db.session.execute(User.__table__.insert(), [
+                {'id': n, 'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': 'x',
+                 'referral_code': f'code{n}', 'referred_by': max(1, n // args.branching)}
+                for n in range(offset, min(offset + CHUNK, args.users + 2))
+            ])
+            db.session.commit()
+    print(f"Seeded {args.users:,} users in {time.perf_counter() - started:.1f}s")
+
+    def login_as(username):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            with app.app_context():
+                user = User.query.filter_by(username=username).first()
+            session['user_id'] = user.id
+            session['is_admin'] = user.is_admin
+        return client
+
+    for username in ('admin', f'user{args.branching ** 2}'):
+        client = login_as(username)
+        print(f"from {username}:")
+        for depth in (1, 2, 3, 5, 10):
+            samples = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                response = client.get('/api/network/tree', query_string={'depth': depth})
+                samples.append((time.perf_counter() - started) * 1000)
+            body = response.get_json()
+            print(f"  depth {depth:>2}: {statistics.median(samples):9.1f} ms  "
+                  f"{body['total']:>7,} nodes{'  (truncated)' if body['truncated'] else ''}")
+
+
+if __name__ == '__main__':
+    main()
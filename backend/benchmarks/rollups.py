@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Activity rollup benchmark: backfill time over synthetic click history and
+trend query latency from the rollups vs. a scan of the raw click table.
+
+Usage: python benchmarks/rollups.py [--clicks 10000000] [--users 1000] [--days 90]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+CHUNK = 50000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clicks', type=int, default=10000000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--links-per-user', type=int, default=3)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    use_scratch_database('rollup-bench-')
+
+    from sqlalchemy import func
+    from app import (
+        app, db, User, ReferralLink, ReferralClick,
+        refresh_activity_rollups, daily_activity, time_bucket, user_agent_cache, TREND_DAYS
+    )
+    bootstrap(app)
+
+    rng = random.Random(42)
+    now = datetime.utcnow()
+
+    with app.app_context():
+        agent_id = user_agent_cache.get_id('bench/1.0')
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x',
+             'referral_code': f'code{i}', 'created_at': now}
+            for i in range(args.users)
+        ])
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).filter(User.username.like('user%'))]
+        db.session.execute(ReferralLink.__table__.insert(), [
+            {'user_id': user_id, 'link_code': f'l{user_id}-{n}', 'clicks': 0, 'conversions': 0,
+             'is_active': True, 'created_at': now}
+            for user_id in user_ids for n in range(args.links_per_user)
+        ])
+        link_ids = [link_id for (link_id,) in db.session.query(ReferralLink.id)]
+        db.session.commit()
+
+        started = time.perf_counter()
+        for offset in range(0, args.clicks, CHUNK):
+            db.session.execute(ReferralClick.__table__.insert(), [
+                {'link_id': rng.choice(link_ids), 'ip_address': '203.0.113.7', 'user_agent_id': agent_id,
+                 'clicked_at': now - timedelta(seconds=rng.randrange(args.days * 86400))}
+                for _ in range(min(CHUNK, args.clicks - offset))
+            ])
+            db.session.commit()
+        print(f"Seeded {args.clicks} clicks in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        refresh_activity_rollups()
+        elapsed = time.perf_counter() - started
+        print(f"Backfill: {elapsed:.1f}s ({args.clicks / elapsed:,.0f} clicks/sec)")
+
+        user_id = user_ids[0]
+        window_start = now - timedelta(days=TREND_DAYS * 2)
+
+        def raw_scan():
+            bucket = time_bucket(ReferralClick.clicked_at, 'day')
+            return db.session.query(bucket, func.count()).join(
+                ReferralLink, ReferralClick.link_id == ReferralLink.id
+            ).filter(
+                ReferralLink.user_id == user_id, ReferralClick.clicked_at >= window_start
+            ).group_by(bucket).all()
+
+        def from_rollups():
+            return daily_activity(TREND_DAYS * 2, user_id=user_id)
+
+        for name, query in (('raw click scan', raw_scan), ('daily rollups', from_rollups)):
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                query()
+            print(f"  {name:<15} {(time.perf_counter() - started) / args.repeat * 1000:8.2f} ms/query")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Multi-process SQLite stress test: stock settings vs. the tuned engine profile
+
+Each worker process mixes click tracking (writes) with dashboard reads against
+one shared database file, the way gunicorn workers do, and records per-request
+latency and "database is locked" failures.
+
+Usage: python benchmarks/sqlite_stress.py [--processes 8] [--seconds 10] [--read-ratio 0.3]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, record_every_click
+
+STOCK_PROFILE = {
+    'SQLITE_JOURNAL_MODE': '', 'SQLITE_SYNCHRONOUS': '', 'SQLITE_BUSY_TIMEOUT_MS': '',
+    'SQLITE_MMAP_SIZE': '', 'SQLITE_CACHE_SIZE': ''
+}
+
+
+def seed(_):
+    from app import app, db, User, ReferralLink
+    bootstrap(app)
+    with app.app_context():
+        user = User(username='stress', email='stress@example.com', password_hash='x', referral_code='stress')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all([ReferralLink(user_id=user.id, link_code=f'stress{n}') for n in range(20)])
+        db.session.commit()
+        return user.id
+
+
+def hammer(job):
+    user_id, seconds, read_ratio, seed_value = job
+    from app import app
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+
+    rng = random.Random(seed_value)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        if rng.random() < read_ratio:
+            path = rng.choice(['/api/stats', '/api/referral-links', '/api/network'])
+        else:
+            path = f'/api/referral/stress{rng.randrange(20)}'
+        started = time.perf_counter()
+        response = client.get(path)
+        latencies.append(time.perf_counter() - started)
+        if response.status_code >= 500:
+            errors += 1
+    return latencies, errors
+
+
+def run(label, profile, args):
+    workdir = tempfile.mkdtemp(prefix='sqlite-stress-')
+    env = dict(profile, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'stress.db')}")
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(1) as pool:
+            user_id = pool.map(seed, [None])[0]
+        with context.Pool(args.processes) as pool:
+            results = pool.map(hammer, [
+                (user_id, args.seconds, args.read_ratio, n) for n in range(args.processes)
+            ])
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    errors = sum(result[1] for result in results)
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(f"{label:<8} {len(latencies) / args.seconds:8.0f} req/s  "
+          f"lock errors {errors / len(latencies) * 100:6.2f}%  "
+          f"p50 {p(0.50):7.1f} ms  p99 {p(0.99):8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--read-ratio', type=float, default=0.3)
+    args = parser.parse_args()
+    record_every_click()
+
+    print(f"{args.processes} processes x {args.seconds:.0f}s, {args.read_ratio:.0%} reads")
+    run('stock', STOCK_PROFILE, args)
+    run('tuned', {}, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Backend benchmark suite: seeds a synthetic referral program and drives every
+main endpoint, in-process and against a real multi-worker gunicorn server
+
+Seeding (deterministic for a given --seed):
+  - --users users in a multi-level referral tree under the admin account
+    (user n's referrer is user n // --branching), created over the last year;
+  - --links-per-user links each, --clicks clicks over the last 90 days and
+    one conversion per 20 clicks, with counters, user summaries and rollups
+    brought up to date.
+
+Scenarios: referral click and conversion, register, login, profile, stats,
+network (direct referrals and tree), achievements, trends, admin users and
+admin trends. Each runs --requests times (--auth-requests for register and
+login, which pay for bcrypt, --admin-requests for the admin-only endpoints)
+from --concurrency threads, first through the Flask test client, then over
+HTTP against gunicorn with the production worker settings. Reported per scenario: throughput, p50/p95/p99 latency and,
+in-process, SQL statements per request.
+
+Click dedup and bot filtering are switched off so every click exercises the
+write path. The HTTP client runs in this process and competes with the
+server for CPU, so compare server numbers between runs on the same machine,
+not against other hardware.
+
+Results are written to --results-dir as JSON named after the commit, and
+compared with --baseline (a results file, or `latest` for the newest one with
+the same data size). With --max-regression PCT the exit status is 1 if any
+scenario's throughput fell or p99 rose by more than PCT percent; p99 over a
+few hundred requests is noisy, so gate on runs with a few thousand.
+
+Usage: python benchmarks/suite.py [--users 100000] [--clicks 1000000] [--mode both] [--baseline latest]
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, record_every_click, use_scratch_database
+
+CHUNK = 50000
+PASSWORD = 'bench-password'
+BROWSER = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+USER_AGENTS = [
+    BROWSER,
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+]
+
+# `who` is 'anonymous', 'user' (a random seeded user) or 'admin'; `route` is
+# the URL rule the request metrics file it under; `load` is 'public', 'auth'
+# or 'admin' and picks the request count and concurrency
+Scenario = namedtuple('Scenario', ['name', 'method', 'route', 'who', 'path', 'body', 'load'])
+
+
+def scenarios(args):
+    links = args.users * args.links_per_user
+    link = lambda rng: f'l{rng.randrange(links)}'
+    return [
+        Scenario('click', 'GET', '/api/referral/<link_code>', 'anonymous',
+                 lambda rng, n: f'/api/referral/{link(rng)}', None, 'public'),
+        Scenario('convert', 'POST', '/api/referral/<link_code>/convert', 'anonymous',
+                 lambda rng, n: f'/api/referral/{link(rng)}/convert', None, 'public'),
+        Scenario('register', 'POST', '/api/register', 'anonymous', lambda rng, n: '/api/register',
+                 lambda rng, n, run: {'username': f'reg-{run}-{n}', 'email': f'reg-{run}-{n}@example.com',
+                                      'password': PASSWORD, 'referralLinkCode': link(rng)}, 'auth'),
+        Scenario('login', 'POST', '/api/login', 'anonymous', lambda rng, n: '/api/login',
+                 lambda rng, n, run: {'username': f'user{2 + n % args.login_users}', 'password': PASSWORD}, 'auth'),
+        Scenario('profile', 'GET', '/api/user/profile', 'user', lambda rng, n: '/api/user/profile', None, 'public'),
+        Scenario('stats', 'GET', '/api/stats', 'user', lambda rng, n: '/api/stats', None, 'public'),
+        Scenario('network', 'GET', '/api/network', 'user', lambda rng, n: '/api/network', None, 'public'),
+        Scenario('network-tree', 'GET', '/api/network/tree', 'user', lambda rng, n: '/api/network/tree?depth=3', None, 'public'),
+        Scenario('achievements', 'GET', '/api/achievements', 'user', lambda rng, n: '/api/achievements', None, 'public'),
+        Scenario('trends', 'GET', '/api/analytics/trends', 'user', lambda rng, n: '/api/analytics/trends', None, 'public'),
+        Scenario('admin-users', 'GET', '/api/admin/users', 'admin', lambda rng, n: '/api/admin/users?limit=50', None, 'admin'),
+        Scenario('admin-trends', 'GET', '/api/analytics/admin-trends', 'admin',
+                 lambda rng, n: '/api/analytics/admin-trends', None, 'admin'),
+    ]
+
+
+def seed(app, args):
+    from app import (
+        db, User, ReferralLink, ReferralClick, ConversionEvent, password_hasher, refresh_activity_rollups,
+        user_agent_cache
+    )
+    from sqlalchemy import text
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    with app.app_context():
+        agent_ids = [user_agent_cache.get_id(agent) for agent in USER_AGENTS]
+        password_hash = password_hasher.hash(PASSWORD)
+
+        # The admin user created by bootstrap is id 1 and roots the tree
+        for offset in range(2, args.users + 2, CHUNK):
+            db.session.execute(User.__table__.insert(), [
+                {'id': n, 'username': f'user{n}', 'email': f'user{n}@example.com',
+                 'password_hash': password_hash if n < 2 + args.login_users else 'x',
+                 'referral_code': f'code{n}', 'referred_by': max(1, n // args.branching),
+                 'created_at': now - timedelta(seconds=rng.randrange(365 * 86400))}
+                for n in range(offset, min(offset + CHUNK, args.users + 2))
+            ])
+            db.session.commit()
+
+        links = args.users * args.links_per_user
+        for offset in range(0, links, CHUNK):
+            db.session.execute(ReferralLink.__table__.insert(), [
+                {'id': n + 1, 'user_id': 2 + n // args.links_per_user, 'link_code': f'l{n}', 'clicks': 0,
+                 'conversions': 0, 'is_active': True, 'created_at': now - timedelta(seconds=rng.randrange(365 * 86400))}
+                for n in range(offset, min(offset + CHUNK, links))
+            ])
+            db.session.commit()
+
+        for offset in range(0, args.clicks, CHUNK):
+            db.session.execute(ReferralClick.__table__.insert(), [
+                {'link_id': 1 + rng.randrange(links), 'ip_address': f'198.51.{rng.randrange(256)}.{rng.randrange(256)}',
+                 'user_agent_id': rng.choice(agent_ids), 'clicked_at': now - timedelta(seconds=rng.randrange(90 * 86400))}
+                for _ in range(min(CHUNK, args.clicks - offset))
+            ])
+            db.session.commit()
+        db.session.execute(ConversionEvent.__table__.insert(), [
+            {'link_id': 1 + rng.randrange(links), 'converted_at': now - timedelta(seconds=rng.randrange(90 * 86400))}
+            for _ in range(args.clicks // 20)
+        ])
+
+        db.session.execute(text(
+            'UPDATE referral_link SET '
+            'clicks = (SELECT count(*) FROM referral_click c WHERE c.link_id = referral_link.id), '
+            'conversions = (SELECT count(*) FROM conversion_event e WHERE e.link_id = referral_link.id)'
+        ))
+        if db.engine.dialect.name == 'postgresql':
+            # Users and links went in with explicit ids, which PostgreSQL
+            # sequences do not follow; move them past the seeded rows
+            for table in ('"user"', 'referral_link'):
+                db.session.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"
+                ))
+        db.session.commit()
+        refresh_activity_rollups()
+
+    result = app.test_cli_runner().invoke(args=['rebuild-user-stats'])
+    if result.exit_code != 0:
+        raise RuntimeError(result.output) from result.exception
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarise(latencies, statuses, elapsed):
+    ordered = sorted(latencies)
+    ok = sum(1 for status in statuses if status < 400)
+    return {
+        'requests': len(statuses),
+        'ok': ok,
+        'rejected': statuses.count(503),
+        'errors': sum(1 for status in statuses if status >= 400 and status != 503),
+        'throughput': round(len(statuses) / elapsed, 1),
+        'p50': round(percentile(ordered, 0.50), 2),
+        'p95': round(percentile(ordered, 0.95), 2),
+        'p99': round(percentile(ordered, 0.99), 2),
+        'mean': round(sum(ordered) / len(ordered), 2)
+    }
+
+
+def drive(scenario, args, send):
+    """Run one scenario: `send(rng, n)` makes request n and returns its status."""
+    count = {'public': args.requests, 'auth': args.auth_requests, 'admin': args.admin_requests}[scenario.load]
+    concurrency = args.auth_concurrency if scenario.load == 'auth' else args.concurrency
+    for n in range(min(args.warmup, count)):
+        send(random.Random(-1 - n), -1 - n)
+
+    latencies, statuses = [], []
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(f'{args.seed}-{scenario.name}-{index}')
+        for n in range(index, count, concurrency):
+            started = time.perf_counter()
+            status = send(rng, n)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                statuses.append(status)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return summarise(latencies, statuses, time.perf_counter() - started)
+
+
+def run_in_process(app, args, run_id):
+    from app import request_metrics
+
+    results = {}
+    for scenario in scenarios(args):
+        clients = threading.local()
+
+        def send(rng, n, scenario=scenario):
+            client = getattr(clients, 'client', None)
+            if client is None:
+                client = clients.client = app.test_client()
+            if scenario.who != 'anonymous':
+                with client.session_transaction() as session:
+                    session['user_id'] = 1 if scenario.who == 'admin' else 2 + rng.randrange(args.users)
+                    session['is_admin'] = scenario.who == 'admin'
+            body = scenario.body(rng, n, run_id) if scenario.body else None
+            response = client.open(
+                scenario.path(rng, n), method=scenario.method, json=body,
+                headers={'User-Agent': BROWSER},
+                environ_base={'REMOTE_ADDR': f'203.0.{rng.randrange(256)}.{rng.randrange(256)}'}
+            )
+            response.close()
+            return response.status_code
+
+        key = f'{scenario.method} {scenario.route}'
+        before = request_metrics.snapshot()['routes'].get(key, {}).get('statements', {'buckets': [0], 'sum': 0})
+        results[scenario.name] = drive(scenario, args, send)
+        after = request_metrics.snapshot()['routes'][key]['statements']
+        requests = sum(after['buckets']) - sum(before['buckets'])
+        results[scenario.name]['sql_per_request'] = round((after['sum'] - before['sum']) / requests, 1)
+        report('in-process', scenario.name, results[scenario.name])
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_against_server(app, args, run_id):
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers),
+               '--worker-class', 'gthread', '--threads', str(args.threads), '--timeout', '120', 'app:app']
+    server = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Session cookies signed with the app's key, so no login is needed per request
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+
+    def cookie(who, rng):
+        if who == 'anonymous':
+            return {}
+        user_id = 1 if who == 'admin' else 2 + rng.randrange(args.users)
+        return {'Cookie': f"{cookie_name}={serializer.dumps({'user_id': user_id, 'is_admin': who == 'admin'})}"}
+
+    def request(url, method='GET', body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(url, data=data, method=method, headers={
+            'Content-Type': 'application/json', 'User-Agent': BROWSER, **(headers or {})
+        })
+        try:
+            with urllib.request.urlopen(req, timeout=120) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+
+    results = {}
+    try:
+        for _ in range(200):
+            try:
+                request(f'{base}/api/referral/no-such-link')
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError('gunicorn did not come up')
+
+        for scenario in scenarios(args):
+            def send(rng, n, scenario=scenario):
+                body = scenario.body(rng, n, f'{run_id}s') if scenario.body else None
+                return request(base + scenario.path(rng, n), scenario.method, body, cookie(scenario.who, rng))
+
+            results[scenario.name] = drive(scenario, args, send)
+            report('server', scenario.name, results[scenario.name])
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def report(mode, name, result):
+    line = (f"  {mode:<10} {name:<13} {result['throughput']:9.1f} req/s  p50 {result['p50']:8.2f}  "
+            f"p95 {result['p95']:8.2f}  p99 {result['p99']:8.2f} ms")
+    if 'sql_per_request' in result:
+        line += f"  {result['sql_per_request']:5.1f} sql/req"
+    if result['rejected'] or result['errors']:
+        line += f"  ({result['rejected']} rejected, {result['errors']} errors)"
+    print(line)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BACKEND_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, dirty
+
+
+DATA_SIZE = ('users', 'branching', 'links_per_user', 'clicks', 'seed')
+
+
+def load_baseline(args, results_dir, current_path):
+    if args.baseline != 'latest':
+        with open(args.baseline) as f:
+            return args.baseline, json.load(f)
+    candidates = []
+    for path in glob.glob(os.path.join(results_dir, '*.json')):
+        if path == current_path:
+            continue
+        with open(path) as f:
+            previous = json.load(f)
+        if all(previous['args'].get(key) == getattr(args, key) for key in DATA_SIZE):
+            candidates.append((previous['timestamp'], path, previous))
+    if not candidates:
+        return None, None
+    _, path, previous = max(candidates)
+    return path, previous
+
+
+def compare(current, baseline, max_regression):
+    regressions = []
+    for mode, scenarios_run in current['results'].items():
+        for name, result in scenarios_run.items():
+            before = baseline['results'].get(mode, {}).get(name)
+            if not before:
+                continue
+            throughput = (result['throughput'] - before['throughput']) / before['throughput'] * 100
+            p99 = (result['p99'] - before['p99']) / before['p99'] * 100 if before['p99'] else 0
+            flag = ''
+            if max_regression is not None and (throughput < -max_regression or p99 > max_regression):
+                flag = '  REGRESSION'
+                regressions.append(f'{mode} {name}')
+            print(f"  {mode:<10} {name:<13} throughput {throughput:+7.1f}%  p99 {p99:+7.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--branching', type=int, default=8, help='referrals per user in the referral tree')
+    parser.add_argument('--links-per-user', type=int, default=2)
+    parser.add_argument('--clicks', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=19)
+    parser.add_argument('--mode', choices=['in-process', 'server', 'both'], default='both')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--auth-requests', type=int, default=60, help='requests for register and login')
+    parser.add_argument('--admin-requests', type=int, default=200, help='requests for the admin endpoints')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests before each scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--auth-concurrency', type=int, default=2,
+                        help='client threads for register/login; above the hash pool capacity they get 503s')
+    parser.add_argument('--login-users', type=int, default=16, help='seeded users with a real password')
+    parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--results-dir', default=os.path.join(BACKEND_DIR, 'benchmarks', 'results'))
+    parser.add_argument('--baseline', help='results file to compare with, or "latest"')
+    parser.add_argument('--max-regression', type=float, help='fail if throughput drops or p99 grows by more than this %%')
+    args = parser.parse_args()
+
+    workdir = use_scratch_database('bench-suite-')
+    record_every_click()
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(args.bcrypt_rounds)
+    os.environ['CLICK_BUFFER_SPILL_DIR'] = os.path.join(workdir, 'spill')
+    os.environ['METRICS_DIR'] = os.path.join(workdir, 'metrics')
+    os.environ['QUERY_BUDGET'] = '0'
+
+    from app import app, db
+    bootstrap(app)
+
+    started = time.perf_counter()
+    seed(app, args)
+    seed_seconds = time.perf_counter() - started
+    links = args.users * args.links_per_user
+    print(f"Seeded {args.users:,} users, {links:,} links and {args.clicks:,} clicks in {seed_seconds:.1f}s")
+
+    run_id = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    results = {}
+    if args.mode in ('in-process', 'both'):
+        results['in-process'] = run_in_process(app, args, run_id)
+    if args.mode in ('server', 'both'):
+        results['server'] = run_against_server(app, args, run_id)
+
+    commit, dirty = git_commit()
+    with app.app_context():
+        dialect = db.engine.dialect.name
+    current = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'database': dialect,
+        'cpus': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('baseline', 'max_regression', 'results_dir')},
+        'seed_seconds': round(seed_seconds, 1),
+        'results': results
+    }
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, f"{run_id}-{commit}{'-dirty' if dirty else ''}.json")
+    with open(path, 'w') as f:
+        json.dump(current, f, indent=2)
+    print(f"Results written to {path}")
+
+    if args.baseline:
+        baseline_path, baseline = load_baseline(args, args.results_dir, path)
+        if baseline is None:
+            print('No earlier results with the same data size to compare with')
+            return
+        print(f"Compared with {baseline_path} ({baseline['commit']}{', dirty' if baseline['dirty'] else ''}):")
+        regressions = compare(current, baseline, args.max_regression)
+        if regressions:
+            print(f"{len(regressions)} scenarios regressed by more than {args.max_regression}%")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
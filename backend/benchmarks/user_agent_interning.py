@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+User-Agent interning: click table size, scan time and insert latency with the
+header stored inline (the old schema) vs. as an id into the user_agent table
+
+Seeds the same clicks into both shapes, with a realistic mix: a few dozen
+browser strings take almost all traffic and a small tail is unique. Sizes
+include the table's indexes (dbstat on SQLite, pg_total_relation_size on
+PostgreSQL).
+
+Usage: python benchmarks/user_agent_interning.py [--clicks 1000000] [--inserts 2000]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, text
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+CHUNK = 50000
+
+# ReferralClick as it was before interning
+LEGACY_CLICKS = Table(
+    'legacy_referral_click', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('link_id', Integer, nullable=False),
+    Column('ip_address', String(45), nullable=False),
+    Column('user_agent', String(500), nullable=True),
+    Column('clicked_at', DateTime),
+    Index('ix_legacy_referral_click_link_clicked_at', 'link_id', 'clicked_at'),
+    Index('ix_legacy_referral_click_clicked_at', 'clicked_at'),
+)
+
+BROWSERS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{v}.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{v}.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_{v} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 14; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{v}.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:{v}.0) Gecko/20100101 Firefox/{v}.0',
+]
+
+
+def user_agents(rng, count):
+    """`count` header values: ~50 common browser builds, weighted, plus a 1% unique tail."""
+    common = [template.format(v=version) for template in BROWSERS for version in range(110, 120)]
+    weights = [1 / (rank + 1) for rank in range(len(common))]
+    picks = rng.choices(common, weights=weights, k=count)
+    for index in rng.sample(range(count), count // 100):
+        picks[index] = f"{picks[index]} Custom/{index}"
+    return picks
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clicks', type=int, default=1000000)
+    parser.add_argument('--links', type=int, default=1000)
+    parser.add_argument('--inserts', type=int, default=2000, help='single-click inserts timed per shape')
+    args = parser.parse_args()
+
+    use_scratch_database('user-agent-bench-')
+    os.environ['CLICK_BUFFER_ENABLED'] = 'false'
+
+    from app import app, db, User, ReferralLink, ReferralClick, user_agent_cache
+    bootstrap(app)
+
+    rng = random.Random(16)
+    now = datetime.utcnow()
+
+    with app.app_context():
+        LEGACY_CLICKS.create(db.engine)
+        sqlite = db.engine.dialect.name == 'sqlite'
+
+        user = User(username='agents', email='agents@example.com', password_hash='x', referral_code='agents')
+        db.session.add(user)
+        db.session.flush()
+        db.session.execute(ReferralLink.__table__.insert(), [
+            {'user_id': user.id, 'link_code': f'agents{n}', 'clicks': 0, 'conversions': 0, 'is_active': True}
+            for n in range(args.links)
+        ])
+        link_ids = [link_id for (link_id,) in db.session.query(ReferralLink.id)]
+        db.session.commit()
+
+        started = time.perf_counter()
+        for offset in range(0, args.clicks, CHUNK):
+            size = min(CHUNK, args.clicks - offset)
+            rows = [
+                {'link_id': rng.choice(link_ids), 'ip_address': f'203.0.113.{rng.randrange(256)}',
+                 'user_agent': agent, 'clicked_at': now - timedelta(seconds=rng.randrange(90 * 86400))}
+                for agent in user_agents(rng, size)
+            ]
+            # Intern before the session starts writing: misses commit on their own connection
+            agent_ids = [user_agent_cache.get_id(row['user_agent']) for row in rows]
+            db.session.execute(LEGACY_CLICKS.insert(), rows)
+            db.session.execute(ReferralClick.__table__.insert(), [
+                {'link_id': row['link_id'], 'ip_address': row['ip_address'], 'user_agent_id': agent_id,
+                 'clicked_at': row['clicked_at']}
+                for row, agent_id in zip(rows, agent_ids)
+            ])
+            db.session.commit()
+        print(f"Seeded {args.clicks:,} clicks into both shapes in {time.perf_counter() - started:.1f}s")
+
+        def table_bytes(table):
+            if sqlite:
+                return db.session.execute(text(
+                    'SELECT sum(pgsize) FROM dbstat WHERE name IN '
+                    '(SELECT name FROM sqlite_master WHERE tbl_name = :table)'
+                ), {'table': table}).scalar()
+            return db.session.execute(text('SELECT pg_total_relation_size(:table)'), {'table': table}).scalar()
+
+        def scan_ms(table):
+            # Forces a full table scan; best of three
+            timings = []
+            for _ in range(3):
+                started = time.perf_counter()
+                db.session.execute(text(f'SELECT count(*) FROM {table} WHERE ip_address = :ip'), {'ip': '198.51.100.1'})
+                timings.append((time.perf_counter() - started) * 1000)
+            return min(timings)
+
+        legacy_bytes = table_bytes('legacy_referral_click')
+        interned_bytes = table_bytes('referral_click') + table_bytes('user_agent')
+        agents = db.session.execute(text('SELECT count(*) FROM user_agent')).scalar()
+        print(f"Storage for {args.clicks:,} clicks ({agents:,} distinct agents), table + indexes:")
+        print(f"  inline header   {legacy_bytes / 2**20:8.1f} MiB  {legacy_bytes / args.clicks:6.1f} B/click  "
+              f"scan {scan_ms('legacy_referral_click'):7.1f} ms")
+        print(f"  interned id     {interned_bytes / 2**20:8.1f} MiB  {interned_bytes / args.clicks:6.1f} B/click  "
+              f"scan {scan_ms('referral_click'):7.1f} ms  (incl. user_agent table)")
+        db.session.commit()
+
+        # One click per transaction, as the unbuffered click path writes them
+        agents = user_agents(rng, args.inserts)
+
+        def insert_legacy(agent):
+            db.session.execute(LEGACY_CLICKS.insert(), {
+                'link_id': link_ids[0], 'ip_address': '203.0.113.9', 'user_agent': agent, 'clicked_at': datetime.utcnow()
+            })
+            db.session.commit()
+
+        def insert_interned(agent):
+            db.session.execute(ReferralClick.__table__.insert(), {
+                'link_id': link_ids[0], 'ip_address': '203.0.113.9',
+                'user_agent_id': user_agent_cache.get_id(agent), 'clicked_at': datetime.utcnow()
+            })
+            db.session.commit()
+
+        print(f"Single-click insert latency, {args.inserts:,} inserts each:")
+        for name, insert in (('inline header', insert_legacy), ('interned id', insert_interned)):
+            samples = []
+            for agent in agents:
+                started = time.perf_counter()
+                insert(agent)
+                samples.append((time.perf_counter() - started) * 1000)
+            print(f"  {name:<15} p50 {statistics.median(samples):6.3f} ms  p99 {percentile(samples, 0.99):6.3f} ms")
+
+        print(f"Intern cache: {user_agent_cache.stats()}")
+
+
+if __name__ == '__main__':
+    main()
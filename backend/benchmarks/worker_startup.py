@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Worker startup cost: importing the app, and gunicorn boot with and without --preload
+
+Reports how long `import app` takes in a fresh interpreter and how many SQL
+statements it issues (should be none: the schema and admin user are set up by
+`flask --app app bootstrap`, not by each worker), then how long gunicorn
+takes from launch until every worker has loaded the app.
+
+Usage: python benchmarks/worker_startup.py [--workers 4] [--repeat 5]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from common import bootstrap, use_scratch_database
+
+IMPORT_PROBE = '''
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+started = time.perf_counter()
+import app
+print(time.perf_counter() - started, len(statements))
+'''
+
+# Each worker reports once it has imported the app and is about to serve
+GUNICORN_HOOKS = '''
+import sys, time
+def post_worker_init(worker):
+    print(f"READY {time.time()}", file=sys.stderr, flush=True)
+'''
+
+
+def import_time():
+    output = subprocess.run(
+        [sys.executable, '-c', IMPORT_PROBE], cwd=BACKEND_DIR,
+        capture_output=True, text=True, check=True
+    ).stdout.split()
+    return float(output[-2]), int(output[-1])
+
+
+def gunicorn_boot(workers, preload, hooks_path):
+    command = [sys.executable, '-m', 'gunicorn', '--bind', '127.0.0.1:0', '--workers', str(workers),
+               '--config', hooks_path, 'app:app']
+    if preload:
+        command.insert(-1, '--preload')
+
+    started = time.time()
+    server = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, text=True)
+    ready = []
+    try:
+        for line in server.stderr:
+            if line.startswith('READY '):
+                ready.append(float(line.split()[1]))
+                if len(ready) == workers:
+                    break
+    finally:
+        server.terminate()
+        server.wait()
+    if len(ready) < workers:
+        raise RuntimeError('gunicorn exited before all workers booted')
+    return max(ready) - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = use_scratch_database('startup-bench-')
+    os.environ['CLICK_BUFFER_SPILL_DIR'] = os.path.join(workdir, 'spill')
+    hooks_path = os.path.join(workdir, 'hooks.py')
+    with open(hooks_path, 'w') as hooks:
+        hooks.write(GUNICORN_HOOKS)
+
+    from app import app
+    bootstrap(app)
+
+    samples = [import_time() for _ in range(args.repeat)]
+    print(f"import app: {statistics.median(seconds for seconds, _ in samples) * 1000:7.1f} ms, "
+          f"{max(count for _, count in samples)} SQL statements")
+
+    for preload in (False, True):
+        boot = statistics.median(gunicorn_boot(args.workers, preload, hooks_path) for _ in range(args.repeat))
+        label = 'gunicorn --preload' if preload else 'gunicorn'
+        print(f"{label:<19} {args.workers} workers ready in {boot * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Click retention regression check
+
+Builds a scratch database with four months of clicks and conversions, takes a
+snapshot of every aggregate (daily rollups, recent hourly rollups, link
+counters, user summaries, dashboard trends), then runs `flask compact-clicks`
+and checks that:
+
+  - no raw click older than the retention window is left;
+  - the archive holds exactly the deleted clicks;
+  - every aggregate is unchanged;
+  - clicks arriving after compaction are still rolled up;
+  - on PostgreSQL, a click whose transaction commits after a higher id has
+    been rolled up is still counted (ids are handed out before commit);
+  - `flask backfill-rollups` afterwards rebuilds the same rollups.
+
+Set CHECK_DATABASE_URL to run against an empty PostgreSQL database (e.g. the
+service from docker-compose.postgres.yml) instead of a scratch SQLite file.
+
+Usage: python check_click_retention.py [--clicks 200000] [--days 30]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clicks', type=int, default=200000)
+    parser.add_argument('--days', type=int, default=30)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='click-retention-')
+    os.environ['DATABASE_URL'] = os.environ.get('CHECK_DATABASE_URL') or f"sqlite:///{os.path.join(workdir, 'retention.db')}"
+    os.environ['CLICK_ARCHIVE_DIR'] = os.path.join(workdir, 'archive')
+    os.environ['CLICK_RETENTION_BATCH_PAUSE'] = '0'
+    os.environ['CLICK_BUFFER_ENABLED'] = 'false'
+
+    from sqlalchemy import func
+    from app import (
+        app, db, User, ReferralLink, ReferralClick, ConversionEvent, ActivityRollup,
+        compute_user_stats, daily_activity, refresh_activity_rollups, retention_cutoff, user_agent_cache, TREND_DAYS
+    )
+
+    runner = app.test_cli_runner()
+
+    def run(*command):
+        result = runner.invoke(args=list(command))
+        assert result.exit_code == 0, (result.output, result.exception)
+        return result.output
+
+    run('bootstrap')
+    rng = random.Random(5)
+    now = datetime.utcnow()
+    cutoff = retention_cutoff(args.days)
+
+    with app.app_context():
+        agent_id = user_agent_cache.get_id('retention-check')
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': 'x', 'referral_code': f'code{n}'}
+            for n in range(20)
+        ])
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+        db.session.execute(ReferralLink.__table__.insert(), [
+            {'user_id': rng.choice(user_ids), 'link_code': f'link{n}', 'clicks': 0, 'conversions': 0, 'is_active': True}
+            for n in range(100)
+        ])
+        link_ids = [link_id for (link_id,) in db.session.query(ReferralLink.id)]
+        db.session.execute(ReferralClick.__table__.insert(), [
+            {'link_id': rng.choice(link_ids), 'ip_address': '203.0.113.7', 'user_agent_id': agent_id,
+             'clicked_at': now - timedelta(seconds=rng.randrange(120 * 86400))}
+            for _ in range(args.clicks)
+        ])
+        db.session.execute(ConversionEvent.__table__.insert(), [
+            {'link_id': rng.choice(link_ids), 'converted_at': now - timedelta(seconds=rng.randrange(120 * 86400))}
+            for _ in range(args.clicks // 20)
+        ])
+        for link_id, clicks in db.session.query(ReferralClick.link_id, func.count()).group_by(ReferralClick.link_id):
+            db.session.query(ReferralLink).filter_by(id=link_id).update({'clicks': clicks})
+        db.session.commit()
+        run('rebuild-user-stats')
+        refresh_activity_rollups()
+
+    def snapshot():
+        with app.app_context():
+            rollups = {
+                (granularity, bucket, link_id): (clicks, conversions)
+                for granularity, bucket, link_id, clicks, conversions in db.session.query(
+                    ActivityRollup.granularity, ActivityRollup.bucket_start, ActivityRollup.link_id,
+                    ActivityRollup.clicks, ActivityRollup.conversions
+                )
+            }
+            return {
+                'daily': {key: value for key, value in rollups.items() if key[0] == 'day'},
+                'recent_hourly': {key: value for key, value in rollups.items() if key[0] == 'hour' and key[1] >= cutoff},
+                'old_hourly': sum(1 for key in rollups if key[0] == 'hour' and key[1] < cutoff),
+                'link_counters': dict(db.session.query(ReferralLink.id, ReferralLink.clicks)),
+                'user_stats': compute_user_stats(),
+                'trends': {user_id: daily_activity(TREND_DAYS * 2, user_id=user_id) for user_id in user_ids},
+                'old_click_ids': {
+                    click_id for (click_id,) in
+                    db.session.query(ReferralClick.id).filter(ReferralClick.clicked_at < cutoff)
+                },
+                'clicks': db.session.query(func.count(ReferralClick.id)).scalar(),
+            }
+
+    failures = []
+
+    def check(label, ok):
+        print(f"{'ok  ' if ok else 'FAIL'} {label}")
+        if not ok:
+            failures.append(label)
+
+    before = snapshot()
+    output = run('compact-clicks', '--days', str(args.days))
+    print(output.rstrip())
+    after = snapshot()
+
+    archived = set()
+    for name in os.listdir(os.environ['CLICK_ARCHIVE_DIR']):
+        with gzip.open(os.path.join(os.environ['CLICK_ARCHIVE_DIR'], name), 'rt') as archive:
+            archived.update(json.loads(line)['id'] for line in archive)
+
+    check(f"{len(before['old_click_ids'])} clicks before {cutoff:%Y-%m-%d} deleted", not after['old_click_ids'])
+    check('archive holds exactly the deleted clicks', archived == before['old_click_ids'])
+    check('newer clicks untouched', after['clicks'] == before['clicks'] - len(before['old_click_ids']))
+    check('daily rollups unchanged', after['daily'] == before['daily'])
+    check('hourly rollups inside the window unchanged', after['recent_hourly'] == before['recent_hourly'])
+    check(f"{before['old_hourly']} hourly rollups before the cutoff dropped", after['old_hourly'] == 0)
+    check('link counters unchanged', after['link_counters'] == before['link_counters'])
+    check('user summaries unchanged', after['user_stats'] == before['user_stats'])
+    check('dashboard trends unchanged', after['trends'] == before['trends'])
+
+    # New traffic after compaction still reaches the rollups
+    with app.app_context():
+        db.session.execute(ReferralClick.__table__.insert(), [
+            {'link_id': link_ids[0], 'ip_address': '203.0.113.8', 'user_agent_id': agent_id, 'clicked_at': now}
+            for _ in range(10)
+        ])
+        db.session.commit()
+        refresh_activity_rollups()
+    today = (('day', now.replace(hour=0, minute=0, second=0, microsecond=0), link_ids[0]))
+    grown = snapshot()
+    check('clicks after compaction are rolled up',
+          grown['daily'][today][0] == before['daily'].get(today, (0, 0))[0] + 10)
+
+    with app.app_context():
+        postgresql = db.engine.dialect.name == 'postgresql'
+    if postgresql:
+        # Hold one click's transaction open while a later id commits and a
+        # rollup runs; the held click must not end up behind the watermark
+        with app.app_context():
+            held = db.engine.connect()
+            transaction = held.begin()
+            held.execute(ReferralClick.__table__.insert(), [
+                {'link_id': link_ids[0], 'ip_address': '203.0.113.9', 'user_agent_id': agent_id, 'clicked_at': now}
+            ])
+            db.session.execute(ReferralClick.__table__.insert(), [
+                {'link_id': link_ids[0], 'ip_address': '203.0.113.10', 'user_agent_id': agent_id, 'clicked_at': now}
+            ])
+            db.session.commit()
+            refresh_activity_rollups()
+            transaction.commit()
+            held.close()
+            refresh_activity_rollups()
+        grown = snapshot()
+        check('clicks committed out of id order are rolled up',
+              grown['daily'][today][0] == before['daily'].get(today, (0, 0))[0] + 12)
+
+    run('backfill-rollups')
+    rebuilt = snapshot()
+    check('backfill-rollups after compaction rebuilds the same daily rollups', rebuilt['daily'] == grown['daily'])
+    check('backfill-rollups rebuilds the same hourly rollups', rebuilt['recent_hourly'] == grown['recent_hourly'])
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Referral/link code allocation check
+
+Builds a scratch database and allocates link codes through the same helpers
+the app uses, checking that:
+
+  - the sequence permutation is a bijection: a code space small enough to
+    exhaust (LINK_CODE_LENGTH=3) is filled completely without a single
+    conflict, and one more code is refused;
+  - --codes links inserted in bulk under each strategy all get distinct
+    codes, with no conflicts under 'sequence';
+  - forced collisions under 'random' (LINK_CODE_LENGTH=4) are retried and
+    every row still lands with a distinct code;
+  - a sequence code already taken by an older link falls back to a random
+    code instead of failing the insert;
+  - forked workers never receive the same numbers.
+
+Usage: python check_code_allocation.py [--codes 2000000]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+BATCH = 20000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--codes', type=int, default=2000000, help='links inserted per strategy')
+    parser.add_argument('--collisions', type=int, default=200000, help='links inserted into the 4-character space')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='code-allocation-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'codes.db')}"
+    os.environ['CLICK_BUFFER_ENABLED'] = 'false'
+
+    from sqlalchemy import func
+    from app import app, db, User, ReferralLink, code_allocator, insert_many_with_unique_codes, insert_with_unique_code
+
+    result = app.test_cli_runner().invoke(args=['bootstrap'])
+    assert result.exit_code == 0, (result.output, result.exception)
+
+    failures = []
+
+    def check(label, ok):
+        print(f"{'ok  ' if ok else 'FAIL'} {label}")
+        if not ok:
+            failures.append(label)
+
+    def configure(strategy, length):
+        app.config['CODE_STRATEGY'] = strategy
+        app.config['LINK_CODE_LENGTH'] = length
+        code_allocator.conflicts.clear()
+
+    def insert_links(count):
+        started = time.perf_counter()
+        for offset in range(0, count, BATCH):
+            rows = [{'user_id': owner_id, 'clicks': 0, 'conversions': 0, 'is_active': True}] * min(BATCH, count - offset)
+            insert_many_with_unique_codes(ReferralLink.__table__, 'link_code', 'link', rows, returning=[ReferralLink.id])
+            db.session.commit()
+        return time.perf_counter() - started
+
+    def distinct_codes(length):
+        total, distinct = db.session.query(
+            func.count(ReferralLink.id), func.count(ReferralLink.link_code.distinct())
+        ).filter(func.length(ReferralLink.link_code) == length).one()
+        return total, distinct
+
+    with app.app_context():
+        owner_id = db.session.query(User.id).scalar()
+
+        # Exhaust a space of 57^3 codes
+        configure('sequence', 3)
+        space = len(app.config['CODE_ALPHABET']) ** 3
+        elapsed = insert_links(space)
+        total, distinct = distinct_codes(3)
+        check(f"sequence fills all {space:,} 3-character codes ({elapsed:.1f}s)", total == distinct == space)
+        check('  without a conflict', not code_allocator.conflicts)
+        try:
+            code_allocator.generate('link')
+            exhausted = False
+        except RuntimeError:
+            exhausted = True
+        check('  and refuses a code once the space is used up', exhausted)
+
+        configure('sequence', 8)
+        elapsed = insert_links(args.codes)
+        total, distinct = distinct_codes(8)
+        check(f"sequence: {args.codes:,} links, {distinct:,} distinct codes ({args.codes / elapsed:,.0f} links/sec)",
+              total == distinct == args.codes)
+        check('  without a conflict', not code_allocator.conflicts)
+
+        configure('random', 4)
+        elapsed = insert_links(args.collisions)
+        total, distinct = distinct_codes(4)
+        conflicts = code_allocator.conflicts.get('link', 0)
+        check(f"random, 4 characters: {args.collisions:,} links, {distinct:,} distinct codes, "
+              f"{conflicts:,} conflicts retried", total == distinct == args.collisions and conflicts > 0)
+
+        configure('random', 9)
+        elapsed = insert_links(args.codes)
+        total, distinct = distinct_codes(9)
+        check(f"random: {args.codes:,} links, {distinct:,} distinct codes ({args.codes / elapsed:,.0f} links/sec), "
+              f"{code_allocator.conflicts.get('link', 0)} conflicts retried", total == distinct == args.codes)
+
+        # Take the next sequence code for an older link, then insert through the app path
+        configure('sequence', 8)
+        taken = code_allocator.generate('link')
+        db.session.execute(ReferralLink.__table__.insert(), {'user_id': owner_id, 'link_code': taken})
+        db.session.commit()
+        permutation = code_allocator._permutation('link')
+        start, _ = code_allocator._blocks['link']
+        code_allocator._blocks['link'] = (start - 1, code_allocator._blocks['link'][1])
+        code, _ = insert_with_unique_code(
+            ReferralLink.__table__, 'link_code', 'link', {'user_id': owner_id}, returning=[ReferralLink.id]
+        )
+        db.session.commit()
+        check('a sequence code already in use falls back to a random one',
+              permutation.encode(permutation.permute(start - 1)) == taken and code != taken
+              and code_allocator.conflicts.get('link') == 1)
+
+    # Forked workers: each drops the parent's block and reserves its own
+    with app.app_context():
+        parent = set(code_allocator.generate_many('link', 10))
+    context = multiprocessing.get_context('fork')
+    with context.Pool(4) as pool:
+        batches = pool.map(allocate_in_worker, [5000] * 4)
+    codes = [code for batch in batches for code in batch]
+    check(f"4 forked workers: {len(codes):,} codes, all distinct and none the parent's",
+          len(set(codes)) == len(codes) and not parent & set(codes))
+
+    sys.exit(1 if failures else 0)
+
+
+def allocate_in_worker(count):
+    from app import app, code_allocator
+    with app.app_context():
+        return code_allocator.generate_many('link', count)
+
+
+if __name__ == '__main__':
+    main()
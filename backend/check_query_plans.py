@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Query-plan regression check
+
+Builds a scratch SQLite database at the latest migration, calls each endpoint
+through the Flask test client, and runs EXPLAIN QUERY PLAN on every SELECT it
+issued. Any full table scan that is not explicitly allowed below fails the
+check, so a query change that stops using an index is caught before it ships.
+
+Set CHECK_DATABASE_URL to an empty PostgreSQL database (e.g. the service from
+docker-compose.postgres.yml) to check its plans instead. The sample is too
+small for PostgreSQL's cost model to prefer an index, so sequential scans are
+discouraged for the EXPLAIN and any that remain mean no index fits the query.
+
+Usage: python check_query_plans.py
+"""
+
+import os
+import re
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+# Full scans that are expected: {(endpoint, table): reason}
+ALLOWED_SCANS = {
+    ('GET /api/analytics/admin-trends', 'referral_link'):
+        'program-wide click/conversion totals; computed at most once per KPI_CACHE_TTL per worker',
+}
+
+# A plain 'SCAN <table>' is a full table scan; 'SCAN <table> USING INDEX'
+# walks an index (e.g. ORDER BY ... LIMIT) and is fine
+SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+
+
+def sqlite_scans(connection, statement, parameters):
+    for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all():
+        match = SCAN.match(row[-1])
+        if match:
+            yield match.group(1), row[-1]
+
+
+def postgresql_scans(connection, statement, parameters):
+    [[plan]] = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).all()
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('Plans', ()))
+        if node['Node Type'] == 'Seq Scan':
+            yield node['Relation Name'], f"Seq Scan on {node['Relation Name']}"
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='query-plans-')
+    os.environ['DATABASE_URL'] = os.environ.get('CHECK_DATABASE_URL') or f"sqlite:///{os.path.join(workdir, 'plans.db')}"
+    os.environ['CLICK_BUFFER_ENABLED'] = 'false'
+
+    from app import app, db, User, ReferralLink, ReferralClick, refresh_activity_rollups, user_agent_cache
+
+    result = app.test_cli_runner().invoke(args=['bootstrap'])
+    assert result.exit_code == 0, result.output
+
+    with app.app_context():
+        agent_id = user_agent_cache.get_id('plan-check')
+
+        # Enough rows that the planner has a choice to make
+        db.session.execute(User.__table__.insert(), [
+            {'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': 'x',
+             'referral_code': f'code{n}', 'referred_by': 1 + n // 4}
+            for n in range(1, 200)
+        ])
+        db.session.execute(ReferralLink.__table__.insert(), [
+            {'user_id': 1 + n % 50, 'link_code': f'link{n}', 'clicks': 0, 'conversions': 0, 'is_active': True}
+            for n in range(200)
+        ])
+        db.session.commit()
+        db.session.execute(ReferralClick.__table__.insert(), [
+            {'link_id': 1 + n % 200, 'ip_address': '203.0.113.7', 'user_agent_id': agent_id}
+            for n in range(1000)
+        ])
+        db.session.commit()
+        refresh_activity_rollups()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['is_admin'] = True
+
+    requests = [
+        ('GET', '/api/user/profile'),
+        ('GET', '/api/referral-links'),
+        ('GET', '/api/referral/link7'),
+        ('POST', '/api/referral/link7/convert'),
+        ('GET', '/api/stats'),
+        ('GET', '/api/achievements'),
+        ('GET', '/api/leaderboard?metric=clicks'),
+        ('GET', '/api/leaderboard?metric=referrals&window=7d'),
+        ('GET', '/api/network'),
+        ('GET', '/api/network/tree?depth=5'),
+        ('GET', '/api/analytics/trends'),
+        ('GET', '/api/analytics/admin-trends'),
+        ('GET', '/api/admin/users?limit=20'),
+        ('GET', '/api/admin/users?limit=20&q=user1'),
+        ('GET', '/api/admin/export/clicks'),
+        ('GET', '/api/admin/export/clicks?link_id=7&start=2020-01-01'),
+        ('GET', '/api/admin/export/links?format=ndjson'),
+        ('GET', '/api/admin/export/referrals'),
+        ('POST', '/api/admin/import/users', [
+            {'username': 'imported1', 'email': 'imported1@example.com', 'password_hash': '$2b$04$' + 'a' * 53,
+             'referralLinkCode': 'link7'}
+        ]),
+        ('POST', '/api/admin/import/conversions', [{'link_code': 'link7'}, {'link_id': 8}]),
+        ('POST', '/api/admin/import/clicks', [{'link_code': 'link7', 'ip_address': '203.0.113.9'}]),
+    ]
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')) and not executemany:
+            captured.append((statement, parameters))
+
+    failures = []
+    with app.app_context():
+        engine = db.engine
+        postgresql = engine.dialect.name == 'postgresql'
+        scans = postgresql_scans if postgresql else sqlite_scans
+        for method, path, *body in requests:
+            captured.clear()
+            event.listen(engine, 'before_cursor_execute', capture)
+            try:
+                response = client.open(path, method=method, json=body[0] if body else None)
+                # Streamed responses only run their queries as the body is read
+                response.get_data()
+            finally:
+                event.remove(engine, 'before_cursor_execute', capture)
+            assert response.status_code < 400, f"{method} {path} -> {response.status_code}"
+
+            endpoint = f"{method} {path.split('?')[0]}"
+            with engine.connect() as connection:
+                if postgresql:
+                    connection.exec_driver_sql('SET enable_seqscan = off')
+                for statement, parameters in list(captured):
+                    for table, detail in scans(connection, statement, parameters):
+                        # CTEs and subqueries show up as scans too; only real tables count
+                        if table not in db.metadata.tables:
+                            continue
+                        if (endpoint, table) not in ALLOWED_SCANS:
+                            failures.append((endpoint, detail, ' '.join(statement.split())))
+
+            print(f"{'FAIL' if any(f[0] == endpoint for f in failures) else 'ok  '} {endpoint}")
+
+    for endpoint, detail, statement in failures:
+        print(f"\n{endpoint}: {detail}\n  {statement}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+Write-behind buffer for referral click ingestion.
+
+Clicks are appended to an in-process queue and written to the database in
+batches by a background thread, either when the queue reaches
+CLICK_BUFFER_MAX_SIZE or every CLICK_BUFFER_FLUSH_INTERVAL seconds. Every buffered click is first appended to
+a per-process spill file so that clicks still in memory when a worker dies are
+replayed by the next worker that starts. Delivery is at-least-once: a worker
+killed between committing a batch and deleting its spill segment will have
+that segment replayed.
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+from datetime import datetime
+
+
+class ClickBuffer:
+    def __init__(self, app=None, writer=None):
+        self.app = None
+        self.writer = writer
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        if app is not None:
+            self.init_app(app, writer)
+
+    def init_app(self, app, writer=None):
+        self.app = app
+        if writer is not None:
+            self.writer = writer
+        app.config.setdefault('CLICK_BUFFER_ENABLED', False)
+        app.config.setdefault('CLICK_BUFFER_MAX_SIZE', 500)
+        app.config.setdefault('CLICK_BUFFER_FLUSH_INTERVAL', 1.0)
+        app.config.setdefault('CLICK_BUFFER_SPILL_DIR', None)
+        app.config.setdefault('CLICK_BUFFER_FSYNC', False)
+        app.extensions['click_buffer'] = self
+        atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return bool(self.app and self.app.config['CLICK_BUFFER_ENABLED'])
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _reset(self):
+        # Called at construction and in every forked child: each gunicorn
+        # worker gets its own queue, spill file and flusher thread.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._segments = []
+        self._spill = None
+        self._spill_seq = 0
+        self._started = False
+        self._wake = threading.Event()
+
+    # Public API
+
+    def add(self, link_id, ip_address, user_agent, clicked_at=None):
+        click = {
+            'link_id': link_id,
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'clicked_at': (clicked_at or datetime.utcnow()).isoformat()
+        }
+
+        with self._lock:
+            if not self._started:
+                self._start()
+            if self._spill is not None:
+                self._spill.write(json.dumps(click) + '\n')
+                self._spill.flush()
+                if self.app.config['CLICK_BUFFER_FSYNC']:
+                    os.fsync(self._spill.fileno())
+            self._pending.append(click)
+            full = len(self._pending) >= self.app.config['CLICK_BUFFER_MAX_SIZE']
+
+        if full:
+            # Hand the batch to the flusher thread instead of making this
+            # request pay for the write.
+            self._wake.set()
+
+    def flush(self):
+        """Write every buffered click to the database; returns the batch size."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                self._rotate_spill()
+                batch, self._pending = self._pending, []
+                segments, self._segments = self._segments, []
+
+            try:
+                with self.app.app_context():
+                    self.writer([self._decode(click) for click in batch])
+            except Exception:
+                # Put the batch back in front of anything queued meanwhile;
+                # its spill segments stay on disk until a flush succeeds.
+                with self._lock:
+                    self._pending = batch + self._pending
+                    self._segments = segments + self._segments
+                raise
+
+            for segment in segments:
+                try:
+                    os.remove(segment)
+                except FileNotFoundError:
+                    pass
+
+            return len(batch)
+
+    # Internals
+
+    @staticmethod
+    def _decode(click):
+        return dict(click, clicked_at=datetime.fromisoformat(click['clicked_at']))
+
+    def _spill_dir(self):
+        return self.app.config['CLICK_BUFFER_SPILL_DIR']
+
+    def _start(self):
+        self._started = True
+        spill_dir = self._spill_dir()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._recover(spill_dir)
+            self._open_spill()
+
+        thread = threading.Thread(target=self._run_flusher, name='click-buffer-flusher', daemon=True)
+        thread.start()
+
+    def _run_flusher(self):
+        while True:
+            self._wake.wait(self.app.config['CLICK_BUFFER_FLUSH_INTERVAL'])
+            self._wake.clear()
+            if not self._pending:
+                continue
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Click buffer flush failed; will retry')
+
+    def _spill_path(self, suffix):
+        return os.path.join(self._spill_dir(), f'clicks-{os.getpid()}{suffix}')
+
+    def _open_spill(self):
+        self._spill = open(self._spill_path('.log'), 'a', encoding='utf-8')
+
+    def _rotate_spill(self):
+        # Seal the active spill file as a segment that belongs to the batch
+        # being flushed, and start a fresh one for clicks that arrive meanwhile.
+        if self._spill is None:
+            return
+        self._spill.close()
+        self._spill_seq += 1
+        segment = self._spill_path(f'-{self._spill_seq}.segment')
+        os.replace(self._spill_path('.log'), segment)
+        self._segments.append(segment)
+        self._open_spill()
+
+    def _recover(self, spill_dir):
+        for path in sorted(glob.glob(os.path.join(spill_dir, 'clicks-*'))):
+            owner = os.path.basename(path).split('-')[1].split('.')[0]
+            if owner.isdigit() and int(owner) != os.getpid() and _pid_alive(int(owner)):
+                continue
+
+            # Claim the orphaned file atomically so that two workers booting
+            # at the same time never replay it twice.
+            self._spill_seq += 1
+            claimed = self._spill_path(f'-{self._spill_seq}.segment')
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+
+            with open(claimed, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._pending.append(json.loads(line))
+                    except ValueError:
+                        # Torn final line from a worker killed mid-write
+                        continue
+            self._segments.append(claimed)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
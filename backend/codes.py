@@ -0,0 +1,193 @@
+"""
+Allocation of public referral and link codes.
+
+Codes are CODE_ALPHABET strings of a fixed length per kind (LINK_CODE_LENGTH,
+REFERRAL_CODE_LENGTH). CODE_STRATEGY picks how they are drawn:
+
+  - 'random': uniform over the whole code space. Collisions are possible
+    and are left to the insert (ON CONFLICT DO NOTHING, retry), so no
+    pre-check query is needed; with the defaults the space is large enough
+    that a retry is rare even at tens of millions of rows.
+  - 'sequence': numbers are reserved from the code_sequence table in blocks
+    of CODE_BLOCK_SIZE (one statement per block) and handed out from memory,
+    each passed through a keyed permutation of the code space so that
+    consecutive codes look unrelated. Distinct numbers give distinct codes,
+    so codes never collide with each other; only codes written before the
+    switch, or under another CODE_SECRET, can still conflict.
+
+A reservation runs in its own transaction on its own connection, so it must
+happen before the caller's transaction starts writing (on SQLite a second
+writer would wait for the first). generate() therefore only reserves on the
+first code of a request; insert retries use random_code(), which never
+touches the database.
+
+Blocks are per process and dropped in a forked child, so gunicorn workers
+never hand out the same numbers; numbers left in a block when a worker exits
+are skipped, which costs nothing in a space of 10^14 codes.
+"""
+
+import hashlib
+import math
+import os
+import secrets
+import threading
+
+# Letters and digits without the look-alikes 0/O, 1/l/I
+DEFAULT_ALPHABET = '23456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+STRATEGIES = ('random', 'sequence')
+
+
+class CodePermutation:
+    """Keyed bijection on [0, len(alphabet) ** length), rendered as fixed-width codes."""
+
+    ROUNDS = 4
+
+    def __init__(self, alphabet, length, key):
+        self.alphabet = alphabet
+        self.length = length
+        self.size = len(alphabet) ** length
+        # Feistel network on [0, half ** 2), cycle-walked back into [0, size)
+        self.half = math.isqrt(self.size - 1) + 1
+        self._width = (self.half.bit_length() + 7) // 8
+        self._key = hashlib.blake2b(key, digest_size=32).digest()
+
+    def _round(self, index, value):
+        digest = hashlib.blake2b(bytes([index]) + value.to_bytes(self._width, 'little'), key=self._key, digest_size=16).digest()
+        return int.from_bytes(digest, 'little') % self.half
+
+    def permute(self, number):
+        while True:
+            left, right = divmod(number, self.half)
+            for index in range(self.ROUNDS):
+                left, right = right, (left + self._round(index, right)) % self.half
+            number = left * self.half + right
+            if number < self.size:
+                return number
+
+    def encode(self, number):
+        base = len(self.alphabet)
+        characters = []
+        for _ in range(self.length):
+            number, digit = divmod(number, base)
+            characters.append(self.alphabet[digit])
+        return ''.join(reversed(characters))
+
+
+class CodeAllocator:
+    def __init__(self, app=None, kinds=None, reserver=None):
+        # kinds: {kind: (length config key, longest code the column holds)}
+        self.kinds = kinds or {}
+        self.reserver = reserver
+        self.generated = {}
+        self.conflicts = {}
+        self.blocks_reserved = 0
+        self._permutations = {}
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, kinds=None, reserver=None):
+        self.app = app
+        if kinds is not None:
+            self.kinds = kinds
+        if reserver is not None:
+            self.reserver = reserver
+        app.config.setdefault('CODE_STRATEGY', 'random')
+        app.config.setdefault('CODE_ALPHABET', DEFAULT_ALPHABET)
+        app.config.setdefault('CODE_BLOCK_SIZE', 1000)
+        app.config.setdefault('CODE_SECRET', None)
+        app.config.setdefault('LINK_CODE_LENGTH', 8)
+        app.config.setdefault('REFERRAL_CODE_LENGTH', 10)
+        self._validate(app.config)
+        app.extensions['code_allocator'] = self
+
+    def _validate(self, config):
+        if config['CODE_STRATEGY'] not in STRATEGIES:
+            raise ValueError(f"CODE_STRATEGY must be one of {', '.join(STRATEGIES)}, not {config['CODE_STRATEGY']!r}")
+        alphabet = config['CODE_ALPHABET']
+        if len(alphabet) < 2 or len(set(alphabet)) != len(alphabet):
+            raise ValueError('CODE_ALPHABET needs at least two distinct characters, each listed once')
+        for kind, (length_key, max_length) in self.kinds.items():
+            if not 1 <= config[length_key] <= max_length:
+                raise ValueError(f'{length_key} must be between 1 and {max_length}')
+
+    def _reset(self):
+        # Called at construction and in every forked child: a block must
+        # never be shared by two processes
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def length(self, kind):
+        return self.app.config[self.kinds[kind][0]]
+
+    def random_code(self, kind):
+        """A uniformly random code; needs no database round trip."""
+        # One draw over the whole space rather than one per character
+        permutation = self._permutation(kind)
+        self._count(self.generated, kind, 1)
+        return permutation.encode(secrets.randbelow(permutation.size))
+
+    def generate(self, kind):
+        """The next code of `kind` under CODE_STRATEGY."""
+        return self.generate_many(kind, 1)[0]
+
+    def generate_many(self, kind, count):
+        """`count` codes of `kind`, distinct from each other, e.g. to pre-generate a batch of links."""
+        if self.app.config['CODE_STRATEGY'] == 'random':
+            codes = set()
+            while len(codes) < count:
+                codes.add(self.random_code(kind))
+            return list(codes)
+
+        permutation = self._permutation(kind)
+        return [permutation.encode(permutation.permute(number)) for number in self._take(kind, count)]
+
+    def record_conflict(self, kind):
+        self._count(self.conflicts, kind, 1)
+
+    def _count(self, counters, kind, amount):
+        with self._lock:
+            counters[kind] = counters.get(kind, 0) + amount
+
+    def _permutation(self, kind):
+        secret = self.app.config['CODE_SECRET'] or self.app.config['SECRET_KEY']
+        key = (kind, self.app.config['CODE_ALPHABET'], self.length(kind), secret)
+        permutation = self._permutations.get(key)
+        if permutation is None:
+            permutation = self._permutations[key] = CodePermutation(
+                key[1], key[2], f'{kind}\0{secret}'.encode('utf-8')
+            )
+        return permutation
+
+    def _take(self, kind, count):
+        # Numbers from this process's current block, reserving more as needed
+        numbers = []
+        with self._lock:
+            while len(numbers) < count:
+                start, end = self._blocks.get(kind, (0, 0))
+                if start == end:
+                    size = max(self.app.config['CODE_BLOCK_SIZE'], count - len(numbers))
+                    start = self.reserver(kind, size)
+                    end = start + size
+                    self.blocks_reserved += 1
+                taken = min(end - start, count - len(numbers))
+                numbers.extend(range(start, start + taken))
+                self._blocks[kind] = (start + taken, end)
+            self.generated[kind] = self.generated.get(kind, 0) + count
+        permutation = self._permutation(kind)
+        if numbers[-1] >= permutation.size:
+            raise RuntimeError(f'The {kind} code space of {permutation.size} codes is used up; raise {self.kinds[kind][0]}')
+        return numbers
+
+    def stats(self):
+        with self._lock:
+            return {
+                'strategy': self.app.config['CODE_STRATEGY'],
+                'lengths': {kind: self.length(kind) for kind in self.kinds},
+                'generated': dict(self.generated),
+                'conflicts': dict(self.conflicts),
+                'blocks_reserved': self.blocks_reserved,
+                'block_remaining': {kind: end - start for kind, (start, end) in self._blocks.items()}
+            }
@@ -0,0 +1,97 @@
+"""
+SQL-side counter increments.
+
+Counters are bumped with a single `UPDATE ... SET col = col + :n` statement so
+concurrent workers never lose increments and no row has to be loaded first.
+Callers own the transaction: nothing here commits.
+"""
+
+from collections import Counter, defaultdict
+
+from sqlalchemy import bindparam, select, update
+
+
+class CounterService:
+    def __init__(self, db, model, columns, key='id'):
+        self.db = db
+        self.model = model
+        self.columns = tuple(columns)
+        self.key = getattr(model, key)
+
+    def increment(self, pk, **deltas):
+        """Increment counters on the row with primary key `pk`; returns the matched row count."""
+        return self.increment_where(self.key == pk, **deltas)
+
+    def increment_where(self, *criteria, returning=None, **deltas):
+        """
+        Increment counters on every row matching `criteria`. Returns the matched
+        row count, or with `returning` a list of rows holding those columns as
+        they are after the update.
+        """
+        values = self._values(deltas)
+        statement = update(self.model).where(*criteria).values(**values)
+
+        if returning is None:
+            return self.db.session.execute(statement).rowcount if values else 0
+
+        if values and self.db.engine.dialect.update_returning:
+            return self.db.session.execute(statement.returning(*returning)).all()
+
+        # No UPDATE ... RETURNING: read back inside the same transaction
+        if values:
+            self.db.session.execute(statement)
+        return self.db.session.execute(select(*returning).where(*criteria)).all()
+
+    def increment_many(self, rows):
+        """
+        Apply (pk, {column: delta}) pairs as one executemany UPDATE, in the
+        given order. Columns a row does not mention are incremented by 0.
+        """
+        rows = [(pk, deltas) for pk, deltas in rows if any(deltas.values())]
+        if not rows:
+            return
+        columns = sorted(set().union(*(deltas for _, deltas in rows)))
+        self._values(dict.fromkeys(columns, 1))
+        table = self.model.__table__
+        statement = update(table).where(table.c[self.key.key] == bindparam('pk_')).values({
+            column: table.c[column] + bindparam(f'delta_{column}') for column in columns
+        })
+        self.db.session.execute(statement, [
+            {'pk_': pk, **{f'delta_{column}': deltas.get(column, 0) for column in columns}}
+            for pk, deltas in rows
+        ])
+
+    def pending(self):
+        return PendingIncrements(self)
+
+    def _values(self, deltas):
+        unknown = set(deltas) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Unknown counter column(s): {', '.join(sorted(unknown))}")
+        return {
+            column: getattr(self.model, column) + delta
+            for column, delta in deltas.items()
+            if delta
+        }
+
+
+class PendingIncrements:
+    """Coalesces many increments into one UPDATE per row, sent as a single executemany."""
+
+    def __init__(self, service):
+        self.service = service
+        self._deltas = defaultdict(Counter)
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def add(self, pk, **deltas):
+        self._deltas[pk].update(deltas)
+
+    def apply(self):
+        """Write the increments; returns them as {pk: {column: delta}}."""
+        # Sorted so concurrent writers on databases with row locks always
+        # take them in the same order.
+        applied, self._deltas = self._deltas, defaultdict(Counter)
+        self.service.increment_many((pk, applied[pk]) for pk in sorted(applied))
+        return applied
@@ -0,0 +1,65 @@
+"""
+Streaming CSV / NDJSON encoding for the admin data exports and click archives.
+
+Rows are encoded as they come off the database cursor and handed out in
+chunks of roughly `chunk_size` bytes, so an export holds one chunk and one
+cursor batch in memory no matter how many rows it covers.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import datetime
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def encode_rows(rows, columns, fmt, chunk_size=64 * 1024):
+    """Yield `rows` encoded as `fmt` in UTF-8 chunks; CSV output starts with a header row."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = lambda row: writer.writerow([_plain(value) for value in row])
+    else:
+        write = lambda row: buffer.write(json.dumps(dict(zip(columns, map(_plain, row)))) + '\n')
+
+    for row in rows:
+        write(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def write_gzip(path, chunks):
+    """
+    Write encoded chunks to a gzip file at `path`; returns its size in bytes.
+
+    The file is written under a temporary name, fsynced and then renamed, so
+    `path` only ever exists complete.
+    """
+    partial = path + '.partial'
+    with open(partial, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as compressed:
+            for chunk in chunks:
+                compressed.write(chunk)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(partial, path)
+    return os.path.getsize(path)
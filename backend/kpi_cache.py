@@ -0,0 +1,99 @@
+"""
+Per-process cache for the global admin KPIs, with stale-while-revalidate.
+
+The snapshot is fresh for KPI_CACHE_TTL seconds. After that, and for up to
+KPI_CACHE_MAX_STALE more seconds, readers keep getting the old snapshot
+immediately while a single background thread recomputes it. Only an empty
+cache, or one older than both limits, makes readers wait, and even then
+concurrent readers share one computation instead of each running the
+aggregate queries.
+"""
+
+import threading
+import time
+
+
+class KpiCache:
+    def __init__(self, app=None, compute=None):
+        self.compute = compute
+        self._lock = threading.Lock()
+        self._compute_lock = threading.Lock()
+        self._value = None
+        self._computed_at = None
+        self._refreshing = False
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.computations = 0
+        if app is not None:
+            self.init_app(app, compute)
+
+    def init_app(self, app, compute=None):
+        self.app = app
+        if compute is not None:
+            self.compute = compute
+        app.config.setdefault('KPI_CACHE_TTL', 30)
+        app.config.setdefault('KPI_CACHE_MAX_STALE', 300)
+        app.extensions['kpi_cache'] = self
+
+    def get(self):
+        """Return the KPI snapshot, recomputing it if it is missing or too old."""
+        ttl = self.app.config['KPI_CACHE_TTL']
+        max_stale = self.app.config['KPI_CACHE_MAX_STALE']
+
+        with self._lock:
+            age = time.monotonic() - self._computed_at if self._computed_at is not None else None
+            if age is not None and age < ttl:
+                self.hits += 1
+                return self._value
+            if age is not None and age < ttl + max_stale:
+                self.stale_hits += 1
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, name='kpi-refresh', daemon=True).start()
+                return self._value
+            self.misses += 1
+            computed_at = self._computed_at
+
+        with self._compute_lock:
+            # Someone else may have finished the computation while we waited
+            with self._lock:
+                if self._computed_at != computed_at:
+                    return self._value
+            return self._refresh()
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._computed_at = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'age': round(time.monotonic() - self._computed_at, 1) if self._computed_at is not None else None,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'computations': self.computations
+            }
+
+    # Internals
+
+    def _refresh(self):
+        # Caller holds _compute_lock
+        value = self.compute()
+        with self._lock:
+            self._value = value
+            self._computed_at = time.monotonic()
+            self.computations += 1
+        return value
+
+    def _refresh_in_background(self):
+        try:
+            with self._compute_lock, self.app.app_context():
+                self._refresh()
+        except Exception:
+            self.app.logger.exception('KPI refresh failed; serving the previous snapshot')
+        finally:
+            with self._lock:
+                self._refreshing = False
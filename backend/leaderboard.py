@@ -0,0 +1,122 @@
+"""
+Score histograms for the referral leaderboard.
+
+A board ranks users by one counter column of the per-user summary table
+(referrals, clicks, conversions). Sorting every user to find one rank is
+what the leaderboard must not do, so next to the summaries the database
+keeps, per board, how many users hold each score:
+
+    leaderboard_score(board, score, users)
+
+A user's rank (competition ranking: ties share a rank) is one plus the users
+at higher scores, a single range read over the primary key that touches one
+row per distinct score above the user, not one per user. Distinct scores
+stay few even with millions of users, since most users share the small ones.
+The top of a board is read from a (score DESC, user_id) index on the
+summaries, so neither lookup sorts.
+
+The write paths keep the histogram in step inside their own transaction:
+new summary rows enter() at their scores, and after counters move, moved()
+reads the new scores of the users touched (one query) and shifts each user
+from their old bucket to the new one with a single executemany upsert,
+in key order like the counter updates. rebuild() recounts everything from
+the summaries.
+"""
+
+from collections import Counter
+
+from sqlalchemy import bindparam, delete, func, literal, select
+
+
+class ScoreHistogram:
+    def __init__(self, db, model, source, boards, insert, key='user_id'):
+        # model: (board, score, users) table; source: summary model holding
+        # the scores; boards: {board: source column}; insert: dialect insert
+        # construct with on_conflict_do_update()
+        self.db = db
+        self.model = model
+        self.source = source
+        self.boards = dict(boards)
+        self.insert = insert
+        self.key = getattr(source, key)
+        # Built once: constructing them costs more than running them on the
+        # one-click write paths
+        self._scores = select(self.key, *[getattr(source, column) for column in self.boards.values()]).where(
+            self.key.in_(bindparam('keys', expanding=True))
+        )
+        self._upsert = None
+
+    def enter(self, summaries):
+        """Count new summary rows, given as dicts of column values (missing columns are 0)."""
+        counts = Counter()
+        for summary in summaries:
+            for board, column in self.boards.items():
+                counts[board, summary.get(column) or 0] += 1
+        self._apply(counts)
+
+    def moved(self, changes):
+        """Move users whose counters just changed by `changes` ({pk: {column: delta}}) to their new buckets."""
+        shifted = {}
+        for pk, deltas in changes.items():
+            boards = {board: deltas[column] for board, column in self.boards.items() if deltas.get(column)}
+            if boards:
+                shifted[pk] = boards
+        if not shifted:
+            return
+
+        counts = Counter()
+        for row in self.db.session.execute(self._scores, {'keys': list(shifted)}):
+            scores = dict(zip(self.boards, row[1:]))
+            for board, delta in shifted[row[0]].items():
+                counts[board, scores[board]] += 1
+                counts[board, scores[board] - delta] -= 1
+        self._apply(counts)
+
+    def rank(self, board, score):
+        """1 + the number of users on `board` with a higher score."""
+        above = self.db.session.execute(
+            select(func.coalesce(func.sum(self.model.users), 0))
+            .where(self.model.board == board, self.model.score > score)
+        ).scalar()
+        return above + 1
+
+    def drift(self):
+        """(board, score) buckets whose stored user count differs from a recount of the summaries."""
+        expected = Counter()
+        for board, column in self.boards.items():
+            score = getattr(self.source, column)
+            for value, users in self.db.session.execute(select(score, func.count()).group_by(score)):
+                expected[board, value] = users
+        stored = Counter({
+            (board, score): users
+            for board, score, users in self.db.session.execute(
+                select(self.model.board, self.model.score, self.model.users)
+            )
+        })
+        return sorted(key for key in set(expected) | set(stored) if expected[key] != stored[key])
+
+    def rebuild(self):
+        """Recount every board from the summaries; the caller commits."""
+        self.db.session.execute(delete(self.model))
+        for board, column in self.boards.items():
+            score = getattr(self.source, column)
+            self.db.session.execute(self.insert(self.model.__table__).from_select(
+                ['board', 'score', 'users'],
+                select(literal(board), score, func.count()).group_by(score)
+            ))
+
+    def _apply(self, counts):
+        rows = [
+            {'board': board, 'score': score, 'users': users}
+            for (board, score), users in sorted(counts.items()) if users
+        ]
+        if not rows:
+            return
+        if self._upsert is None:
+            # insert() picks the dialect from the engine, so not before the first write
+            table = self.model.__table__
+            statement = self.insert(table)
+            self._upsert = statement.on_conflict_do_update(
+                index_elements=['board', 'score'], set_={'users': table.c.users + statement.excluded.users}
+            )
+        self.db.session.execute(self._upsert, rows)
@@ -0,0 +1,94 @@
+"""
+Per-process LRU/TTL cache for referral link code resolution.
+
+Maps a link code to the handful of fields the public click and conversion
+endpoints need, so hot links skip the database lookup entirely. Unknown codes
+are cached too (for LINK_CACHE_NEGATIVE_TTL seconds) so that scans of random
+codes do not reach the database either. Invalidation is local to the worker
+that performs the write; other workers pick up changes when their entry
+expires.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+ResolvedLink = namedtuple('ResolvedLink', ['id', 'user_id', 'is_active', 'referrer'])
+
+_MISSING = object()
+
+
+class LinkCodeCache:
+    def __init__(self, app=None, loader=None):
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app, loader)
+
+    def init_app(self, app, loader=None):
+        self.app = app
+        if loader is not None:
+            self.loader = loader
+        app.config.setdefault('LINK_CACHE_SIZE', 10000)
+        app.config.setdefault('LINK_CACHE_TTL', 60)
+        app.config.setdefault('LINK_CACHE_NEGATIVE_TTL', 10)
+        app.extensions['link_cache'] = self
+
+    def get(self, link_code):
+        """Return the ResolvedLink for `link_code`, or None if no such link exists."""
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(link_code, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(link_code)
+                    if value is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    return value
+                del self._entries[link_code]
+            self.misses += 1
+
+        value = self.loader(link_code)
+        ttl = self.app.config['LINK_CACHE_TTL' if value is not None else 'LINK_CACHE_NEGATIVE_TTL']
+
+        with self._lock:
+            self._entries[link_code] = (value, now + ttl)
+            self._entries.move_to_end(link_code)
+            while len(self._entries) > self.app.config['LINK_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return value
+
+    def invalidate(self, link_code):
+        with self._lock:
+            if self._entries.pop(link_code, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.app.config['LINK_CACHE_SIZE'],
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0
+            }
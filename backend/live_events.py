@@ -0,0 +1,272 @@
+"""
+Live click, conversion and registration updates for server-sent event streams.
+
+Every gunicorn worker and async click service process can take writes, and
+any of them can hold a user's stream, so updates have to cross processes.
+The database already orders them: referral_click, conversion_event and user
+ids only grow. One reader thread per process (started with the first stream,
+stopped after the last) asks `reader(cursor, limit)` every
+EVENTS_POLL_INTERVAL seconds for what was committed past its cursor. That
+is one small range read per table, however many streams the process holds,
+and the request paths write nothing extra.
+
+The reader returns (cursor, events, more), events being (user_id, link_id,
+counts) tuples. publish() folds them into each matching subscription:
+a user's stream gets the counts for their links, and a firehose subscription
+(user_id None) gets every event. Counts are coalesced, never queued: a
+subscription holds at most one pending update, summed until it goes out.
+An update goes out at most every EVENTS_MIN_INTERVAL seconds per stream.
+A client that stops reading blocks only its own writes, and its pending
+update keeps absorbing new counts in constant space. The firehose lists at
+most EVENTS_FIREHOSE_MAX_USERS users per update; past that only the totals
+move and the update is marked truncated.
+
+Frames: `event: activity` with JSON {"totals": {...}, "links": {...}} for a
+user, or {"totals": {...}, "users": {...}, "truncated": bool} for the
+firehose, a `ready` event once subscribed, and a comment line every
+EVENTS_HEARTBEAT seconds so proxies keep idle streams open. Updates are
+deltas; clients that reconnect should reload their totals.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict
+
+# Seconds a client should wait before reconnecting, or retrying a full server
+RETRY_AFTER = 5
+
+READY = f'retry: {RETRY_AFTER * 1000}\nevent: ready\ndata: {{}}\n\n'.encode('ascii')
+PING = b': ping\n\n'
+
+# Keep proxies from caching or buffering the stream
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def encode_event(payload):
+    return b'event: activity\ndata: ' + json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8') + b'\n\n'
+
+
+def add_counts(into, counts):
+    for name, value in counts.items():
+        into[name] = into.get(name, 0) + value
+
+
+class Subscription:
+    def __init__(self, hub, user_id):
+        self.hub = hub
+        self.user_id = user_id
+        self.closed = False
+        self._pending = None
+        self._ready_at = 0.0
+        self._wake = None
+
+    def next_payload(self):
+        """
+        (update, None) when an update may go out now, (None, seconds) while
+        the pending one is held back by EVENTS_MIN_INTERVAL, (None, None)
+        when nothing is pending.
+        """
+        now = time.monotonic()
+        with self.hub._lock:
+            if self._pending is None:
+                return None, None
+            if now < self._ready_at:
+                return None, self._ready_at - now
+            payload, self._pending = self._pending, None
+            self._ready_at = now + self.hub.app.config['EVENTS_MIN_INTERVAL']
+        self.hub._count_message()
+        return payload, None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+        self.closed = True
+        if self._wake is not None:
+            self._wake()
+
+    def frames(self):
+        """SSE frames for a thread-per-connection server; unsubscribes when the client goes away."""
+        woken = threading.Event()
+        self._wake = woken.set
+        try:
+            yield READY
+            last_write = time.monotonic()
+            while not self.closed:
+                frame, timeout = self._next_frame(last_write)
+                if frame is not None:
+                    yield frame
+                    last_write = time.monotonic()
+                    continue
+                # Wakes that land after _next_frame() leave the event set,
+                # so the wait returns at once
+                woken.wait(timeout)
+                woken.clear()
+        finally:
+            self.close()
+
+    async def async_frames(self):
+        """The same frames for an asyncio server; call close() from another task to end them."""
+        woken = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self._wake = lambda: loop.call_soon_threadsafe(woken.set)
+        yield READY
+        last_write = time.monotonic()
+        while not self.closed:
+            frame, timeout = self._next_frame(last_write)
+            if frame is not None:
+                yield frame
+                last_write = time.monotonic()
+                continue
+            try:
+                await asyncio.wait_for(woken.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            woken.clear()
+
+    # Internals
+
+    def _next_frame(self, last_write):
+        # (frame, None) to write now, or (None, seconds) to wait for a wake
+        payload, delay = self.next_payload()
+        if payload is not None:
+            return encode_event(payload), None
+        timeout = self.hub.app.config['EVENTS_HEARTBEAT'] - (time.monotonic() - last_write)
+        if delay is not None:
+            timeout = min(timeout, delay)
+        if timeout <= 0:
+            return PING, None
+        return None, timeout
+
+    def _add(self, user_id, link_id, counts, max_users):
+        # Caller holds the hub lock
+        if self._pending is None:
+            self._pending = {'totals': {}, 'links': {}} if self.user_id is not None else {'totals': {}, 'users': {}, 'truncated': False}
+        add_counts(self._pending['totals'], counts)
+        if self.user_id is not None:
+            if link_id is not None:
+                add_counts(self._pending['links'].setdefault(link_id, {}), counts)
+        elif user_id is not None:
+            users = self._pending['users']
+            if user_id in users or len(users) < max_users:
+                add_counts(users.setdefault(user_id, {}), counts)
+            else:
+                self._pending['truncated'] = True
+
+
+class LiveEvents:
+    def __init__(self, app=None, reader=None):
+        self.reader = reader
+        self._lock = threading.Lock()
+        self._by_user = defaultdict(set)
+        self._firehose = set()
+        self._streams = 0
+        self._thread = None
+        self.events = 0
+        self.messages = 0
+        self.reads = 0
+        self.rejected = 0
+        if app is not None:
+            self.init_app(app, reader)
+
+    def init_app(self, app, reader=None):
+        self.app = app
+        if reader is not None:
+            self.reader = reader
+        app.config.setdefault('EVENTS_POLL_INTERVAL', 0.5)
+        app.config.setdefault('EVENTS_READ_BATCH', 10000)
+        app.config.setdefault('EVENTS_MIN_INTERVAL', 1.0)
+        app.config.setdefault('EVENTS_HEARTBEAT', 15)
+        app.config.setdefault('EVENTS_FIREHOSE_MAX_USERS', 1000)
+        app.extensions['live_events'] = self
+
+    def subscribe(self, user_id, max_streams):
+        """A Subscription to `user_id`'s updates (None: everyone's); TooManyStreams past `max_streams`."""
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            if self._streams >= max_streams:
+                self.rejected += 1
+                raise TooManyStreams()
+            if user_id is None:
+                self._firehose.add(subscription)
+            else:
+                self._by_user[user_id].add(subscription)
+            self._streams += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='live-events', daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.user_id is None:
+                subscribers = self._firehose
+            else:
+                subscribers = self._by_user.get(subscription.user_id, set())
+            if subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            if subscription.user_id is not None and not subscribers:
+                del self._by_user[subscription.user_id]
+            self._streams -= 1
+
+    def publish(self, events):
+        """Fold (user_id, link_id, counts) events into the pending updates of matching subscriptions."""
+        woken = set()
+        max_users = self.app.config['EVENTS_FIREHOSE_MAX_USERS']
+        with self._lock:
+            self.events += len(events)
+            for user_id, link_id, counts in events:
+                for subscription in self._by_user.get(user_id, ()):
+                    subscription._add(user_id, link_id, counts, max_users)
+                    woken.add(subscription)
+                for subscription in self._firehose:
+                    subscription._add(user_id, link_id, counts, max_users)
+                    woken.add(subscription)
+        for subscription in woken:
+            if subscription._wake is not None:
+                subscription._wake()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': self._streams,
+                'users': len(self._by_user),
+                'firehose': len(self._firehose),
+                'reads': self.reads,
+                'events': self.events,
+                'messages': self.messages,
+                'rejected': self.rejected
+            }
+
+    # Internals
+
+    def _count_message(self):
+        with self._lock:
+            self.messages += 1
+
+    def _run(self):
+        # Stops once the last stream is gone; the next subscriber starts a
+        # new reader from the current ids, so nothing old is replayed
+        cursor = None
+        while True:
+            with self._lock:
+                if not self._streams:
+                    self._thread = None
+                    return
+            more = False
+            try:
+                with self.app.app_context():
+                    cursor, events, more = self.reader(cursor, self.app.config['EVENTS_READ_BATCH'])
+                with self._lock:
+                    self.reads += 1
+                if events:
+                    self.publish(events)
+            except Exception:
+                self.app.logger.exception('Reading live events failed; retrying')
+            if not more:
+                time.sleep(self.app.config['EVENTS_POLL_INTERVAL'])
@@ -0,0 +1,144 @@
+"""
+Versioned schema migrations.
+
+db.create_all() creates missing tables but never alters tables that already
+exist, so any change to an existing table is added here as a numbered step
+and applied with `flask --app app db-upgrade`. Each step runs in its own
+transaction and is recorded in the schema_migrations table. Steps must be
+idempotent: a fresh database built by create_all() already has the final
+schema and only needs the steps recorded.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(step):
+        MIGRATIONS.append((version, description, step))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return step
+    return register
+
+
+def _create_indexes(connection, indexes):
+    for name, table, columns in indexes:
+        connection.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({", ".join(columns)})'))
+
+
+@migration(1, 'Index referral tree, link ownership and click history lookups')
+def add_query_indexes(connection):
+    _create_indexes(connection, [
+        ('ix_user_referred_by', 'user', ['referred_by']),
+        ('ix_user_created_at', 'user', ['created_at']),
+        ('ix_referral_link_user_active', 'referral_link', ['user_id', 'is_active']),
+        ('ix_referral_link_created_at', 'referral_link', ['created_at']),
+        ('ix_referral_click_link_clicked_at', 'referral_click', ['link_id', 'clicked_at']),
+        ('ix_referral_click_clicked_at', 'referral_click', ['clicked_at']),
+        ('ix_conversion_event_link_id', 'conversion_event', ['link_id']),
+    ])
+
+
+@migration(2, 'Move click user agents into the user_agent lookup table')
+def intern_user_agents(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('referral_click')}
+    if 'user_agent' not in columns:
+        return
+
+    id_type = 'SERIAL' if connection.dialect.name == 'postgresql' else 'INTEGER'
+    connection.execute(text(
+        f'CREATE TABLE IF NOT EXISTS user_agent (id {id_type} PRIMARY KEY, value VARCHAR(500) NOT NULL UNIQUE)'
+    ))
+    if 'user_agent_id' not in columns:
+        connection.execute(text('ALTER TABLE referral_click ADD COLUMN user_agent_id INTEGER REFERENCES user_agent (id)'))
+
+    # Same 500-character truncation as the click path applies
+    connection.execute(text(
+        'INSERT INTO user_agent (value) '
+        'SELECT DISTINCT substr(user_agent, 1, 500) FROM referral_click c '
+        "WHERE user_agent IS NOT NULL AND user_agent <> '' "
+        'AND NOT EXISTS (SELECT 1 FROM user_agent a WHERE a.value = substr(c.user_agent, 1, 500))'
+    ))
+    connection.execute(text(
+        'UPDATE referral_click SET user_agent_id = '
+        '(SELECT id FROM user_agent WHERE value = substr(referral_click.user_agent, 1, 500)) '
+        'WHERE user_agent IS NOT NULL'
+    ))
+    # SQLite 3.35+; the freed pages are handed back by the next compact-clicks
+    connection.execute(text('ALTER TABLE referral_click DROP COLUMN user_agent'))
+
+
+@migration(3, 'Index user summaries by score and count them into the leaderboard histogram')
+def add_leaderboard(connection):
+    if 'user_stats' not in inspect(connection).get_table_names():
+        return
+
+    _create_indexes(connection, [
+        ('ix_user_stats_referrals_rank', 'user_stats', ['referrals_count DESC', 'user_id']),
+        ('ix_user_stats_clicks_rank', 'user_stats', ['total_clicks DESC', 'user_id']),
+        ('ix_user_stats_conversions_rank', 'user_stats', ['total_conversions DESC', 'user_id']),
+    ])
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS leaderboard_score ('
+        'board VARCHAR(20) NOT NULL, score INTEGER NOT NULL, users INTEGER NOT NULL, PRIMARY KEY (board, score))'
+    ))
+    # Recounted from scratch, so a rerun gives the same buckets
+    connection.execute(text('DELETE FROM leaderboard_score'))
+    for board, column in (('referrals', 'referrals_count'), ('clicks', 'total_clicks'), ('conversions', 'total_conversions')):
+        connection.execute(text(
+            f"INSERT INTO leaderboard_score (board, score, users) "
+            f"SELECT '{board}', {column}, count(*) FROM user_stats GROUP BY {column}"
+        ))
+
+
+@migration(4, 'Add a data version to user summaries for dashboard ETags')
+def add_user_stats_version(connection):
+    inspector = inspect(connection)
+    if 'user_stats' not in inspector.get_table_names():
+        return
+    if 'version' not in {column['name'] for column in inspector.get_columns('user_stats')}:
+        connection.execute(text('ALTER TABLE user_stats ADD COLUMN version INTEGER NOT NULL DEFAULT 0'))
+
+
+@migration(5, 'Index referrals by (referred_by, id) for ordered downline walks')
+def add_referral_tree_order_index(connection):
+    _create_indexes(connection, [('ix_user_referred_by_id', 'user', ['referred_by', 'id'])])
+    # Its leading column serves every lookup the old index did
+    connection.execute(text('DROP INDEX IF EXISTS ix_user_referred_by'))
+
+
+def _ensure_version_table(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'version INTEGER PRIMARY KEY, description VARCHAR(200) NOT NULL, applied_at TIMESTAMP NOT NULL)'
+        ))
+
+
+def applied_versions(engine):
+    _ensure_version_table(engine)
+    with engine.connect() as connection:
+        return {row[0] for row in connection.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def pending_migrations(engine):
+    applied = applied_versions(engine)
+    return [entry for entry in MIGRATIONS if entry[0] not in applied]
+
+
+def upgrade(engine, echo=print):
+    """Apply every pending migration in order; returns the versions applied."""
+    applied = []
+    for version, description, step in pending_migrations(engine):
+        with engine.begin() as connection:
+            step(connection)
+            connection.execute(
+                text('INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)'),
+                {'v': version, 'd': description, 't': datetime.utcnow()}
+            )
+        echo(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
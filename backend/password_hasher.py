@@ -0,0 +1,96 @@
+"""
+Bounded worker pool for bcrypt password hashing and verification.
+
+bcrypt is deliberately slow, so hashes run on a small per-process thread pool
+(PASSWORD_HASH_WORKERS threads) instead of on whichever request thread asked
+for them. At most PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_SIZE hashes are
+admitted at once; past that, `hash`/`check` raise HasherBusy straight away so
+the caller can answer 503 instead of tying up a worker behind a login flood.
+The cost factor comes from BCRYPT_LOG_ROUNDS, and `needs_rehash` reports
+hashes made with a different cost so they can be upgraded on the next login.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HasherBusy(Exception):
+    """Raised when the hash queue is full."""
+
+
+class PasswordHasher:
+    def __init__(self, app=None, bcrypt=None):
+        self.app = None
+        self.bcrypt = bcrypt
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        if app is not None:
+            self.init_app(app, bcrypt)
+
+    def init_app(self, app, bcrypt=None):
+        self.app = app
+        if bcrypt is not None:
+            self.bcrypt = bcrypt
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 1)
+        app.config.setdefault('PASSWORD_HASH_QUEUE_SIZE', 2)
+        app.extensions['password_hasher'] = self
+
+    def _reset(self):
+        # The pool is created on first use, so a gunicorn --preload master
+        # never forks a live executor; each worker builds its own.
+        self._lock = threading.Lock()
+        self._executor = None
+        self._in_flight = 0
+        self.rejected = 0
+
+    # Public API
+
+    def hash(self, password):
+        """Hash `password` with the configured cost; returns the hash as text."""
+        return self._run(self.bcrypt.generate_password_hash, password).decode('utf-8')
+
+    def check(self, pw_hash, password):
+        return self._run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        try:
+            cost = int(pw_hash.split('$')[2])
+        except (IndexError, ValueError):
+            return True
+        return cost != self.app.config['BCRYPT_LOG_ROUNDS']
+
+    @property
+    def capacity(self):
+        return self.app.config['PASSWORD_HASH_WORKERS'] + self.app.config['PASSWORD_HASH_QUEUE_SIZE']
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.app.config['PASSWORD_HASH_WORKERS'],
+                'capacity': self.capacity,
+                'in_flight': self._in_flight,
+                'rejected': self.rejected
+            }
+
+    # Internals
+
+    def _run(self, fn, *args):
+        with self._lock:
+            if self._in_flight >= self.capacity:
+                self.rejected += 1
+                raise HasherBusy()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.app.config['PASSWORD_HASH_WORKERS'],
+                    thread_name_prefix='password-hash'
+                )
+            self._in_flight += 1
+            executor = self._executor
+
+        try:
+            return executor.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
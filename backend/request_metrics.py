@@ -0,0 +1,288 @@
+"""
+Per-route request instrumentation, exported in the Prometheus text format.
+
+For every request the Flask hooks record, under "METHOD /url/rule":
+
+  - latency (histogram), from before_request until the request context is
+    torn down, so a streamed response is timed until its last chunk;
+  - SQL statements issued and time spent in them, counted by SQLAlchemy
+    cursor events on every engine while the request context is active;
+  - response size in bytes;
+  - requests whose statement count exceeded QUERY_BUDGET, which are also
+    logged as a warning with the route and count (0 disables the check).
+
+Each gunicorn worker keeps its own totals and, when METRICS_DIR is set, a
+background thread writes them to a per-worker file there every
+METRICS_FLUSH_INTERVAL seconds. The worker answering a scrape adds up the
+files of every worker started by the same gunicorn master, so /api/metrics
+shows the whole server, at most one interval behind for the other workers.
+Files of workers that have exited are kept so counters never go backwards.
+
+Other extensions contribute counters with add_collector().
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['request_metrics_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('request_metrics_started', None)
+    if started is None or not has_request_context():
+        return
+    state = g.get('request_metrics')
+    if state is not None:
+        state['statements'] += 1
+        state['db_seconds'] += time.perf_counter() - started
+
+
+def _histogram(buckets):
+    return {'buckets': [0] * (len(buckets) + 1), 'sum': 0}
+
+
+def _observe(histogram, bounds, value):
+    index = next((i for i, bound in enumerate(bounds) if value <= bound), len(bounds))
+    histogram['buckets'][index] += 1
+    histogram['sum'] += value
+
+
+def _merge(into, other):
+    # Adds a snapshot into another: nested dicts key by key, lists element-wise
+    for key, value in other.items():
+        if isinstance(value, dict):
+            _merge(into.setdefault(key, {}), value)
+        elif isinstance(value, list):
+            current = into.setdefault(key, [0] * len(value))
+            for index, item in enumerate(value):
+                current[index] += item
+        elif isinstance(value, str):
+            into[key] = value
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def _labels(**labels):
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class RequestMetrics:
+    def __init__(self, app=None):
+        self.collectors = []
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 5.0)
+        app.config.setdefault('QUERY_BUDGET', 0)
+        app.extensions['request_metrics'] = self
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        atexit.register(self.flush)
+
+    def add_collector(self, name, description, collect):
+        """Export counter `name`; `collect()` returns {((label, value), ...): count}, summed across workers."""
+        self.collectors.append((name, description, collect))
+
+    def _reset(self):
+        # Called at construction and in every forked child: each gunicorn
+        # worker counts its own requests and writes its own file
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._started = False
+
+    # Flask hooks
+
+    def _before_request(self):
+        g.request_metrics = {'started': time.perf_counter(), 'statements': 0, 'db_seconds': 0.0, 'bytes': 0, 'status': None}
+
+    def _after_request(self, response):
+        state = g.get('request_metrics')
+        if state is None:
+            return response
+        state['status'] = response.status_code
+        if response.is_streamed:
+            response.response = self._count_bytes(response.response, state)
+        else:
+            state['bytes'] = response.calculate_content_length() or 0
+        return response
+
+    @staticmethod
+    def _count_bytes(chunks, state):
+        for chunk in chunks:
+            state['bytes'] += len(chunk)
+            yield chunk
+
+    def _teardown_request(self, error):
+        state = g.pop('request_metrics', None)
+        if state is None:
+            return
+        elapsed = time.perf_counter() - state['started']
+        route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        key = f"{request.method} {route}"
+        status = str(state['status'] or 500)
+        budget = self.app.config['QUERY_BUDGET']
+        over_budget = budget > 0 and state['statements'] > budget
+
+        with self._lock:
+            metrics = self._routes.get(key)
+            if metrics is None:
+                metrics = self._routes[key] = {
+                    'requests': {},
+                    'duration': _histogram(LATENCY_BUCKETS),
+                    'statements': _histogram(STATEMENT_BUCKETS),
+                    'size': _histogram(SIZE_BUCKETS),
+                    'db_seconds': 0.0,
+                    'over_budget': 0
+                }
+            metrics['requests'][status] = metrics['requests'].get(status, 0) + 1
+            _observe(metrics['duration'], LATENCY_BUCKETS, elapsed)
+            _observe(metrics['statements'], STATEMENT_BUCKETS, state['statements'])
+            _observe(metrics['size'], SIZE_BUCKETS, state['bytes'])
+            metrics['db_seconds'] += state['db_seconds']
+            metrics['over_budget'] += over_budget
+            if not self._started and self.app.config['METRICS_DIR']:
+                self._start()
+
+        if over_budget:
+            self.app.logger.warning(
+                '%s issued %d SQL statements (budget %d) in %.1f ms, %.1f ms of it in the database',
+                key, state['statements'], budget, elapsed * 1000, state['db_seconds'] * 1000
+            )
+
+    # Aggregation
+
+    def snapshot(self):
+        """This worker's totals, including collector counters, as plain JSON-able data."""
+        with self._lock:
+            routes = json.loads(json.dumps(self._routes))
+        counters = {}
+        for name, description, collect in self.collectors:
+            samples = {json.dumps(sorted(labels)): value for labels, value in collect().items()}
+            counters[name] = {'help': description, 'samples': samples}
+        return {'routes': routes, 'counters': counters}
+
+    def flush(self):
+        """Write this worker's snapshot to METRICS_DIR (atomically)."""
+        metrics_dir = self.app.config['METRICS_DIR'] if getattr(self, 'app', None) else None
+        if not metrics_dir:
+            return
+        os.makedirs(metrics_dir, exist_ok=True)
+        path = self._path(os.getpid())
+        with open(path + '.partial', 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.partial', path)
+
+    def collect(self):
+        """Totals across every worker of this server: this worker's live numbers plus the others' files."""
+        merged = self.snapshot()
+        metrics_dir = self.app.config['METRICS_DIR']
+        if metrics_dir:
+            own = self._path(os.getpid())
+            for path in glob.glob(self._path('*')):
+                if path == own:
+                    continue
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        _merge(merged, json.load(f))
+                except (OSError, ValueError):
+                    # Replaced or removed while we read it; skip this scrape
+                    continue
+        return merged
+
+    def render(self):
+        """Prometheus text exposition of collect()."""
+        merged = self.collect()
+        lines = []
+
+        def family(name, kind, description):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def histogram(name, field, bounds):
+            for key, metrics in sorted(merged['routes'].items()):
+                method, route = key.split(' ', 1)
+                data = metrics[field]
+                cumulative = 0
+                for bound, count in zip(bounds + ('+Inf',), data['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(method=method, route=route, le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{_labels(method=method, route=route)} {data["sum"]}')
+                lines.append(f'{name}_count{_labels(method=method, route=route)} {cumulative}')
+
+        family('http_requests_total', 'counter', 'Requests handled, by route and status.')
+        for key, metrics in sorted(merged['routes'].items()):
+            method, route = key.split(' ', 1)
+            for status, count in sorted(metrics['requests'].items()):
+                lines.append(f'http_requests_total{_labels(method=method, route=route, status=status)} {count}')
+
+        family('http_request_duration_seconds', 'histogram', 'Request latency in seconds.')
+        histogram('http_request_duration_seconds', 'duration', LATENCY_BUCKETS)
+        family('http_request_db_statements', 'histogram', 'SQL statements issued per request.')
+        histogram('http_request_db_statements', 'statements', STATEMENT_BUCKETS)
+        family('http_response_size_bytes', 'histogram', 'Response body size in bytes.')
+        histogram('http_response_size_bytes', 'size', SIZE_BUCKETS)
+
+        family('http_request_db_seconds_total', 'counter', 'Seconds spent executing SQL statements.')
+        for key, metrics in sorted(merged['routes'].items()):
+            method, route = key.split(' ', 1)
+            lines.append(f'http_request_db_seconds_total{_labels(method=method, route=route)} {metrics["db_seconds"]}')
+
+        family('http_request_query_budget_exceeded_total', 'counter', 'Requests that issued more SQL statements than QUERY_BUDGET.')
+        for key, metrics in sorted(merged['routes'].items()):
+            method, route = key.split(' ', 1)
+            lines.append(f'http_request_query_budget_exceeded_total{_labels(method=method, route=route)} {metrics["over_budget"]}')
+
+        for name, counter in sorted(merged['counters'].items()):
+            family(name, 'counter', counter['help'])
+            for labels, value in sorted(counter['samples'].items()):
+                lines.append(f'{name}{_labels(**dict(json.loads(labels)))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    # Internals
+
+    def _path(self, pid):
+        # Keyed by the gunicorn master too, so a restarted server starts from zero
+        return os.path.join(self.app.config['METRICS_DIR'], f'metrics-{os.getppid()}-{pid}.json')
+
+    def _start(self):
+        # Caller holds _lock
+        self._started = True
+        threading.Thread(target=self._run_flusher, name='metrics-flusher', daemon=True).start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.app.config['METRICS_FLUSH_INTERVAL'])
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Writing request metrics failed; will retry')
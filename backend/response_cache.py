@@ -0,0 +1,85 @@
+"""
+Per-process cache of dashboard responses, keyed by the user's data version.
+
+The dashboard endpoints only change when one of the user's counters does, so
+each response is stored under (user id, path) together with the tag it was
+built for: the user's UserStats.version plus anything else the endpoint
+depends on. A lookup with the current tag returns the stored body; any other
+tag is a miss and the next store replaces the entry, so a user never holds
+more than one body per endpoint. Versions live in the database, so every
+worker sees a write the moment it commits and nothing needs invalidating.
+
+Memory is bounded by RESPONSE_CACHE_MAX_BYTES of bodies, least recently
+used first out; 0 turns the cache off.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        app.extensions['response_cache'] = self
+
+    def get(self, key, tag):
+        """Return the body stored for `key` if it was built for `tag`, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == tag:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, tag, body):
+        max_bytes = self.app.config['RESPONSE_CACHE_MAX_BYTES']
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[1])
+            if len(body) > max_bytes:
+                return
+            self._entries[key] = (tag, body)
+            self._bytes += len(body)
+            while self._bytes > max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def count_not_modified(self):
+        # Polls answered with a 304 never reach get(); counted here for stats()
+        with self._lock:
+            self.not_modified += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.app.config['RESPONSE_CACHE_MAX_BYTES'],
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0
+            }
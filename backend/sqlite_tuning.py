@@ -0,0 +1,126 @@
+"""
+Database engine profile.
+
+Pool settings come from DB_* environment variables and, for SQLite, a set of
+PRAGMAs is applied to every new connection: WAL so readers never block the
+writer, synchronous=NORMAL (durable at checkpoints, safe with WAL), a busy
+timeout so concurrent gunicorn workers wait for the write lock instead of
+failing with "database is locked", and larger mmap and page caches. New
+database files are created in incremental auto-vacuum mode so that space freed
+by deleting rows can be handed back with reclaim_free_pages(). Set any
+SQLITE_* variable to an empty string to leave that PRAGMA at SQLite's default.
+"""
+
+import os
+
+from sqlalchemy import event
+
+SQLITE_PRAGMAS = {
+    # Only takes effect before the first table is created
+    'auto_vacuum': ('SQLITE_AUTO_VACUUM', 'INCREMENTAL'),
+    'journal_mode': ('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': ('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': ('SQLITE_BUSY_TIMEOUT_MS', '5000'),
+    'mmap_size': ('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)),
+    'cache_size': ('SQLITE_CACHE_SIZE', '-65536'),  # negative: KiB, so 64 MiB
+}
+
+
+def database_url(url):
+    """
+    Normalise DATABASE_URL: hosting providers still hand out the postgres://
+    scheme, and a bare postgresql:// means psycopg 3 to SQLAlchemy 2.1, while
+    requirements.txt installs psycopg2.
+    """
+    for scheme in ('postgres://', 'postgresql://'):
+        if url.startswith(scheme):
+            url = 'postgresql+psycopg2://' + url[len(scheme):]
+    return url
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+
+def configure_engine(app):
+    """Fill SQLALCHEMY_ENGINE_OPTIONS and SQLITE_PRAGMAS; call before the engine is created."""
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    options.setdefault('pool_pre_ping', _env_bool('DB_POOL_PRE_PING', True))
+    if 'DB_POOL_RECYCLE' in os.environ:
+        options.setdefault('pool_recycle', int(os.environ['DB_POOL_RECYCLE']))
+
+    # Pool sizing only applies to QueuePool; SQLite memory databases use a
+    # SingletonThreadPool that does not accept these arguments
+    if ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI']:
+        for option, variable, cast in (
+            ('pool_size', 'DB_POOL_SIZE', int),
+            ('max_overflow', 'DB_MAX_OVERFLOW', int),
+            ('pool_timeout', 'DB_POOL_TIMEOUT', float),
+        ):
+            if variable in os.environ:
+                options.setdefault(option, cast(os.environ[variable]))
+
+    pragmas = {}
+    for pragma, (variable, default) in SQLITE_PRAGMAS.items():
+        value = os.environ.get(variable, default)
+        if value != '':
+            pragmas[pragma] = value
+    app.config['SQLITE_PRAGMAS'] = pragmas
+
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') and pragmas.get('busy_timeout'):
+        # pysqlite's own lock wait, in seconds; keep it in line with the PRAGMA
+        connect_args = options.setdefault('connect_args', {})
+        connect_args.setdefault('timeout', int(pragmas['busy_timeout']) / 1000)
+
+
+def install_sqlite_pragmas(engine, pragmas):
+    """
+    Apply `pragmas` to every new connection of `engine`. Listens on this one
+    engine, so each app (and test app) gets exactly one hook.
+    """
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def apply_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma, value in pragmas.items():
+                cursor.execute(f'PRAGMA {pragma}={value}')
+        finally:
+            cursor.close()
+
+
+def sqlite_storage(connection):
+    """Size and free space of the SQLite database behind `connection`, in bytes."""
+    pragma = lambda name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+    page_size = pragma('page_size')
+    return {
+        'size': page_size * pragma('page_count'),
+        'free': page_size * pragma('freelist_count'),
+        'auto_vacuum': ('none', 'full', 'incremental')[pragma('auto_vacuum')]
+    }
+
+
+def reclaim_free_pages(engine, full=False, step=2048):
+    """
+    Give free pages back to the filesystem; returns storage stats before and after.
+
+    In incremental auto-vacuum mode this frees `step` pages per write
+    transaction, so the write lock is never held for long. Other databases can
+    only shrink through a full VACUUM, which rewrites the file under an
+    exclusive lock; with `full=True` that is done once, switching the file to
+    incremental mode for later runs.
+    """
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        before = sqlite_storage(connection)
+        if before['auto_vacuum'] == 'incremental':
+            raw = connection.connection.dbapi_connection
+            while sqlite_storage(connection)['free']:
+                # The pragma frees one page per step; fetchall() runs it to completion
+                raw.execute(f'PRAGMA incremental_vacuum({step})').fetchall()
+        elif full:
+            connection.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+            connection.exec_driver_sql('VACUUM')
+        after = sqlite_storage(connection)
+    return before, after
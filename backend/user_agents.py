@@ -0,0 +1,78 @@
+"""
+Per-process intern cache for click User-Agent strings.
+
+A handful of browsers account for almost all traffic, so ReferralClick keeps
+a small integer id into the user_agent lookup table instead of the header
+itself. This cache maps header strings to those ids so the click path
+resolves known agents without a query. A new agent goes through the
+resolver, which inserts it (or finds the row another worker inserted first)
+in its own short transaction, so an id is only cached once its row is
+committed. Ids never change, so entries need no TTL; the cache is bounded by
+USER_AGENT_CACHE_SIZE and evicts the least recently used agent.
+"""
+
+import threading
+from collections import OrderedDict
+
+# Longest User-Agent stored; longer headers are truncated before interning
+MAX_USER_AGENT_LENGTH = 500
+
+
+class UserAgentCache:
+    def __init__(self, app=None, resolver=None):
+        self.resolver = resolver
+        self._lock = threading.Lock()
+        self._ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if app is not None:
+            self.init_app(app, resolver)
+
+    def init_app(self, app, resolver=None):
+        self.app = app
+        if resolver is not None:
+            self.resolver = resolver
+        app.config.setdefault('USER_AGENT_CACHE_SIZE', 1000)
+        app.extensions['user_agent_cache'] = self
+
+    def get_id(self, user_agent):
+        """Return the user_agent row id for a header value, or None for a missing header."""
+        if not user_agent:
+            return None
+        user_agent = user_agent[:MAX_USER_AGENT_LENGTH]
+
+        with self._lock:
+            agent_id = self._ids.get(user_agent)
+            if agent_id is not None:
+                self._ids.move_to_end(user_agent)
+                self.hits += 1
+                return agent_id
+            self.misses += 1
+
+        agent_id = self.resolver(user_agent)
+
+        with self._lock:
+            self._ids[user_agent] = agent_id
+            self._ids.move_to_end(user_agent)
+            while len(self._ids) > self.app.config['USER_AGENT_CACHE_SIZE']:
+                self._ids.popitem(last=False)
+                self.evictions += 1
+
+        return agent_id
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._ids),
+                'max_size': self.app.config['USER_AGENT_CACHE_SIZE'],
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0
+            }